@@ -12,4 +12,9 @@ from . import niio
 from . import filenames
 from . import meants
 from . import report
+from . import geodesic
+from . import smoothing
+from . import compute
+from . import pint_store
+from . import cleaning
 #from commands import *
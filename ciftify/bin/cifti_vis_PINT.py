@@ -13,7 +13,7 @@ Arguments:
                                ciftify_PINT_vertices.py map
     <subject>                  Subject ID for HCP surfaces
     <PINT_summary.csv>         The output csv (*_summary.csv) from the PINT
-                               analysis step
+                               analysis step (or a PINT results store, see details)
 
 Options:
   --qcdir PATH             Full path to location of QC directory
@@ -24,6 +24,8 @@ Options:
   --roi-radius MM          Specify the radius [default: 6] of the plotted rois
                            (in mm)
   --pvertex-col COLNAME    The column [default: pvertex] to read the personlized vertices
+  --pint-subid ID          The subid to read from a PINT results store
+                           (default is the <subject>)
   --hcp-data-dir PATH      DEPRECATED, use --ciftify-work-dir instead
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
@@ -45,6 +47,10 @@ There are two subfunctions:
 
     index: will make an index out of all the subjects in the qcdir
 
+Instead of a *_summary.csv, the PINT outputs can be read from a PINT results
+store (a .h5 file written by ciftify_postPINT1_concat --store). The outputs of
+--pint-subid (or of the <subject> if not given) are read from the store.
+
 Note: this script requires the seaborn package to make the correlation
 heatmaps...
 
@@ -79,12 +85,7 @@ config_path = os.path.join(os.path.dirname(__file__), "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
-PINTnets = [{ 'NETWORK': 2, 'network':'VI', 'roiidx': 72, 'best_view': "APDV", 'Order': 6},
-                { 'NETWORK': 3, 'network': 'DA', 'roiidx': 2, 'best_view': "APDV", 'Order': 1},
-                { 'NETWORK': 4, 'network': 'VA', 'roiidx': 44, 'best_view': "LM", 'Order': 4},
-                { 'NETWORK': 5, 'network': 'SM', 'roiidx': 62, 'best_view': "LM", 'Order': 5},
-                { 'NETWORK': 6, 'network': 'FP', 'roiidx': 28, 'best_view': "LM", 'Order': 3},
-                { 'NETWORK': 7, 'network': 'DM', 'roiidx': 14, 'best_view': "LM", 'Order': 2}]
+PINTnets = ciftify.pint_store.PINT_NETWORKS
 
 class UserSettings(VisSettings):
     def __init__(self, arguments):
@@ -95,12 +96,14 @@ class UserSettings(VisSettings):
             self.func = self.__get_input_file(arguments['<func.dtseries.nii>'])
             self.pint_summary = self.__get_input_file(
                     arguments['<PINT_summary.csv>'])
+            self.pint_subid = arguments['--pint-subid'] or self.subject
             self.left_surface = self.__get_surface('L')
             self.right_surface = self.__get_surface('R')
         else:
             self.subject = None
             self.func = None
             self.pint_summary = None
+            self.pint_subid = None
         self.pvertex_name = arguments['--pvertex-col']
         self.subject_filter = arguments['--subjects-filter']
         self.roi_radius = arguments['--roi-radius']
@@ -126,7 +129,7 @@ class FakeNifti(object):
         self.template = func_path
 
     def __make_fake_nifti(self, func_path, tmp_dir):
-        nifti_path = os.path.join(tmp_dir, 'func.nii.gz')
+        nifti_path = ciftify.niio.temp_nifti(tmp_dir, 'func')
         command_list = ['wb_command', '-cifti-convert', '-to-nifti', func_path,
                         nifti_path]
         run(command_list)
@@ -152,21 +155,37 @@ class PDDataframe(object):
 
 class SummaryData(PDDataframe):
 
-    def __init__(self, summary_csv, pvertex_name):
-        self.dataframe = self.make_dataframe(summary_csv)
+    def __init__(self, summary_csv, pvertex_name, pint_subid = None):
         self.vertex_types = ['tvertex', pvertex_name]
-        self.vertices = self.__make_vertices(summary_csv)
+        if ciftify.pint_store.is_pint_store(summary_csv):
+            self.__read_pint_store(summary_csv, pint_subid)
+        else:
+            self.dataframe = self.make_dataframe(summary_csv)
+            self.vertices = self.__make_vertices(summary_csv)
 
-    def __make_vertices(self, summary_csv):
+    def __make_vertices(self, summary_csv, all_meants = None):
         vert_list = []
         for vertex in self.vertex_types:
-            vert_list.append(Vertex(summary_csv, vertex))
+            meants = all_meants[vertex] if all_meants else None
+            vert_list.append(Vertex(summary_csv, vertex, meants))
         return vert_list
 
+    def __read_pint_store(self, store_file, pint_subid):
+        with ciftify.pint_store.PINTStore(store_file) as store:
+            self.dataframe = store.summary(pint_subid).drop(columns = 'subid')
+            ## the store names the meants tvertex and pvertex
+            all_meants = {vertex: store.meants(store_vertex, pint_subid)[pint_subid]
+                          for vertex, store_vertex in zip(self.vertex_types,
+                                            ciftify.pint_store.VERTEX_TYPES)}
+        self.vertices = self.__make_vertices(store_file, all_meants)
+
 class Vertex(PDDataframe):
-    def __init__(self, summary_csv, vert_type):
+    def __init__(self, summary_csv, vert_type, meants = None):
         self.vert_type = vert_type
-        self.dataframe = self.__get_dataframe_type(summary_csv)
+        if meants is not None:
+            self.dataframe = meants.reset_index(drop = True).transpose()
+        else:
+            self.dataframe = self.__get_dataframe_type(summary_csv)
 
     def __get_dataframe_type(self, csv_path):
         new_path = csv_path.replace('_summary',
@@ -257,8 +276,8 @@ class Vertex(PDDataframe):
         meants = self.dataframe.loc[:, summary_df.loc[:, 'NETWORK'] ==
                 network].mean(axis=1)
 
-        temp_nifti_seed = os.path.join(temp_dir, 'seedcorr{}.nii.gz'.format(
-                network))
+        temp_nifti_seed = ciftify.niio.temp_nifti(temp_dir,
+                'seedcorr{}'.format(network))
         ## correlated the mean timeseries with the func data
         out = np.zeros([func_fnifti.dims[0]*func_fnifti.dims[1]*func_fnifti.dims[2],
                 1])
@@ -266,8 +285,8 @@ class Vertex(PDDataframe):
         std_array = np.std(func_fnifti.data, axis=1)
         std_nonzero = np.where(std_array > 0)[0]
         mask_indices = std_nonzero
-        for i in mask_indices:
-            out[i] = np.corrcoef(meants, func_fnifti.data[i, :])[0][1]
+        out[mask_indices, 0] = ciftify.compute.masked_corr(meants.values,
+                                    func_fnifti.data, mask = mask_indices)
         ## reshape data and write it out to a fake nifti file
         out = out.reshape([func_fnifti.dims[0], func_fnifti.dims[1],
                 func_fnifti.dims[2], 1])
@@ -336,7 +355,8 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
     ciftify.utils.make_dir(qc_subdir, dry_run=DRYRUN)
 
     func_nifti = FakeNifti(settings.func, temp_dir)
-    summary_data = SummaryData(settings.pint_summary, settings.pvertex_name)
+    summary_data = SummaryData(settings.pint_summary, settings.pvertex_name,
+            settings.pint_subid)
 
     qc_sub_html = os.path.join(qc_subdir, 'qc_sub.html')
     with open(qc_sub_html,'w') as qc_sub_page:
@@ -4,13 +4,18 @@ Beta version of script find PINT (Personal Instrisic Network Topography)
 
 Usage:
   ciftify_PINT_vertices [options] <func.dtseries.nii> <left-surface.gii> <right-surface.gii> <input-vertices.csv> <outputprefix>
+  ciftify_PINT_vertices [options] --batch <manifest.csv> <left-surface.gii> <right-surface.gii> <input-vertices.csv> <outputdir>
+  ciftify_PINT_vertices [options] --sweep <sweep.csv> <func.dtseries.nii> <left-surface.gii> <right-surface.gii> <input-vertices.csv> <outputdir>
 
 Arguments:
     <func.dtseries.nii>    Paths to directory source image
+    <manifest.csv>         Table of func files to run (with --batch, see details)
+    <sweep.csv>            Table of radii to run (with --sweep, see details)
     <left-surface.gii>     Path to template for the ROIs of network regions
     <right-surface.gii>    Surface file .surf.gii to read coordinates from
     <input-vertices.csv>   Table of template vertices from which to Start
     <outputprefix>         Output csv file
+    <outputdir>            Output directory (with --batch or --sweep, see details)
 
 Options:
   --outputall            Output vertices from each iteration.
@@ -23,6 +28,17 @@ Options:
   --pcorr                Use maximize partial correlation within network (instead of pearson).
   --corr                 Use full correlation instead of partial (default debehviour is --pcorr)
 
+  --max-iterations INT   Maximum number [default: 50] of PINT iterations
+  --stop-oscillating N   Stop once every vertex still moving has been oscillating between
+                         two vertices for N iterations (see details)
+  --stop-plateau N       Stop once the number of vertices moved has not reached a new
+                         minimum for N iterations (see details)
+  --trace                Write a per-iteration trace to <outputprefix>_pint_trace.json
+
+  --parallel-moves       Score the vertex moves of each iteration in parallel (see details)
+  --n_cpus INT           Number of processes for --batch, --sweep or --parallel-moves
+                         (default will read from the OMP_NUM_THREADS environment variable)
+
   -v,--verbose           Verbose logging
   --debug                Debug logging in Erin's very verbose style
   -h,--help              Print help
@@ -30,17 +46,65 @@ Options:
 DETAILS:
 The pre-smooth option will add smoothing in order to make larger resting state gradients
 more visible in noisy data. Final extration of the timeseries use the original (un-smoothed)
-functional input.
+functional input. The smoothing is a geodesic gaussian (weighted by vertex area, as in
+wb_command -metric-smoothing) applied in memory, the smoothing kernel of each surface is
+built from the cached neighbourhood index (see below).
+
+The sampling, search and padding rois are built from a geodesic neighbourhood
+index of each surface. The index is built on the first run and cached (keyed
+by the hash of the surface file) in the directory given by the CIFTIFY_CACHE
+environment variable, or alongside the surface (or in ~/.cache/ciftify if the
+surface directory is not writable). Later runs on the same surfaces read the
+index instead of recomputing geodesic distances.
+
+PINT iterates until no vertex moves more than 1mm (or --max-iterations is reached).
+A vertex is oscillating when it moves back to the vertex it held two iterations
+before. --stop-oscillating and --stop-plateau end the run early for subjects that
+cycle between vertices instead of converging; the final vertices are those of the
+last iteration. With --trace, the time spent in each phase (rois, meants,
+correlation and distance), the number of vertices moved, a histogram of the
+distances moved and the oscillating rois are written for every iteration.
+
+In each iteration every vertex is moved based on the rois and meants from the
+start of that iteration (Jacobi-style updates), so the result does not depend
+on the order of the updates and runs are reproducible. With --parallel-moves
+these moves are scored in parallel by --n_cpus processes (this gives the same
+result as the default one-at-a-time updates, and is ignored within --batch or
+--sweep workers, or any other daemon process).
+
+With --batch, PINT is run for every func file listed in <manifest.csv>. The
+manifest is either a plain list (one func file per line) or a csv with a "func"
+column and an optional "outputprefix" column (the default output prefix is
+<outputdir>/<func basename>, func files with the same basename need their own
+"outputprefix"). The template vertices and the surfaces (with their
+neighbourhood indices) are loaded once and shared by a pool of --n_cpus worker
+processes. A failed run is logged and does not stop the others, the status of
+every run is written to <outputdir>/PINT_batch_status.csv.
+
+With --sweep, PINT is run on one func file for every configuration of radii
+listed in <sweep.csv> (a csv with any of the columns sampling_radius,
+search_radius and padding_radius, the options give the values of missing
+columns). The func file is read once, and the configurations are run by a pool
+of --n_cpus worker processes that share the func data and the neighbourhood
+indices (of the largest radius). The summary of every roi for every
+configuration, with the convergence statistics of each configuration
+(iterations, stop reason, final max distance, vertices moved and oscillating,
+mean distance from the template and runtime), is written to one table:
+<outputdir>/PINT_sweep_results.csv
 
 Written by Erin W Dickie, April 2016
 """
-import random
 import os
+import copy
+import json
+import collections
 import sys
+import time
 import logging
+import multiprocessing
+from multiprocessing import shared_memory
 import pandas as pd
 import nibabel.gifti.giftiio
-from scipy import stats, linalg
 import numpy as np
 import nibabel as nib
 from docopt import docopt
@@ -51,103 +115,415 @@ import ciftify
 logger = logging.getLogger('ciftify')
 logger.setLevel(logging.DEBUG)
 
+class UserSettings(object):
+    '''the PINT settings shared by every func file that is run'''
+    def __init__(self, arguments):
+        self.pcorr = self.__get_pcorr(arguments['--pcorr'], arguments['--corr'])
+        self.pre_smooth_fwhm = arguments['--pre-smooth']
+        self.pre_smooth_sigma = ciftify.utils.FWHM2Sigma(self.pre_smooth_fwhm)
+        self.sampling_radius = float(arguments['--sampling-radius'])
+        self.search_radius = float(arguments['--search-radius'])
+        self.padding_radius = float(arguments['--padding-radius'])
+        self.outputall = arguments['--outputall']
+        self.max_iterations = self.__get_int(arguments['--max-iterations'], '--max-iterations')
+        self.stop_oscillating = self.__get_int(arguments['--stop-oscillating'], '--stop-oscillating')
+        self.stop_plateau = self.__get_int(arguments['--stop-plateau'], '--stop-plateau')
+        self.trace = arguments['--trace']
+        self.parallel_moves = arguments['--parallel-moves']
+        self.n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
+
+    def __get_int(self, user_arg, option):
+        '''read an integer option (or None if it was not given)'''
+        if user_arg is None:
+            return None
+        try:
+            return int(user_arg)
+        except ValueError:
+            logger.critical("Could not read {} {} as an integer".format(option, user_arg))
+            sys.exit(1)
+
+    def __get_pcorr(self, pcorr, corr):
+        '''partial correlation is used unless --corr is given'''
+        if corr and pcorr:
+            logger.critical("Error: --corr and --pcorr options cannot be used together")
+            sys.exit(1)
+        return not corr
+
+    @property
+    def max_radius(self):
+        return max(self.sampling_radius, self.search_radius, self.padding_radius)
+
+    def log_settings(self):
+        '''report the settings to the log (info)'''
+        if self.pre_smooth_sigma > 0:
+            logger.info('Pre-smoothing FWHM: {} (Sigma {})'.format(self.pre_smooth_fwhm,
+                                                                   self.pre_smooth_sigma))
+        else:
+            logger.info('Pre-smoothing: None')
+
+        logger.info('    Sampling ROI radius (mm): {}'.format(self.sampling_radius))
+        logger.info('    Search ROI radius (mm): {}'.format(self.search_radius))
+        logger.info('    Paddding ROI radius (mm): {}'.format(self.padding_radius))
+
+        if self.pcorr:
+            logger.info('    Maximizing partial correlation')
+        else:
+            logger.info('    Maximizing full correlation')
+        logger.info('    Maximum iterations: {}'.format(self.max_iterations))
+        if self.stop_oscillating:
+            logger.info('    Stop after {} oscillating iterations'.format(self.stop_oscillating))
+        if self.stop_plateau:
+            logger.info('    Stop after a {} iteration plateau'.format(self.stop_plateau))
+
 ############################## maub starts here ######################
 def run_PINT(arguments, tmpdir):
-    global RADIUS_SAMPLING
-    global RADIUS_SEARCH
-    global RADIUS_PADDING
 
     func          = arguments['<func.dtseries.nii>']
     surfL         = arguments['<left-surface.gii>']
     surfR         = arguments['<right-surface.gii>']
     origcsv       = arguments['<input-vertices.csv>']
     output_prefix = arguments['<outputprefix>']
-    pcorr         = arguments['--pcorr']
-    corr         = arguments['--corr']
-    pre_smooth_fwhm = arguments['--pre-smooth']
-    outputall     = arguments['--outputall']
-    RADIUS_SAMPLING = arguments['--sampling-radius']
-    RADIUS_SEARCH = arguments['--search-radius']
-    RADIUS_PADDING = arguments['--padding-radius']
+
+    settings = UserSettings(arguments)
 
     logger.debug(arguments)
 
     logger.info("Arguments: ")
-    logger.info('    functional data: {}'.format(func))
+    if arguments['--batch']:
+        logger.info('    batch manifest: {}'.format(arguments['<manifest.csv>']))
+    else:
+        logger.info('    functional data: {}'.format(func))
+    if arguments['--sweep']:
+        logger.info('    sweep table: {}'.format(arguments['<sweep.csv>']))
     logger.info('    left surface: {}'.format(surfL))
     logger.info('    right surface: {}'.format(surfR))
     logger.info('    pint template csv: {}'.format(origcsv))
-    logger.info('    output prefix: {}'.format(output_prefix))
-
-    ## calc and report the pre-smoothing
-    pre_smooth_sigma = ciftify.utils.FWHM2Sigma(pre_smooth_fwhm)
-    if pre_smooth_sigma > 0:
-        logger.info('Pre-smoothing FWHM: {} (Sigma {})'.format(pre_smooth_fwhm,
-                                                               pre_smooth_sigma))
+    if arguments['--batch'] or arguments['--sweep']:
+        logger.info('    output directory: {}'.format(arguments['<outputdir>']))
     else:
-        logger.info('Pre-smoothing: None')
+        logger.info('    output prefix: {}'.format(output_prefix))
 
-    logger.info('    Sampling ROI radius (mm): {}'.format(RADIUS_SAMPLING))
-    logger.info('    Search ROI radius (mm): {}'.format(RADIUS_SEARCH))
-    logger.info('    Paddding ROI radius (mm): {}'.format(RADIUS_PADDING))
-
-    if corr and pcorr:
-        logger.critical("Error: --corr and --pcorr options cannot be used together")
-        sys.exit(1)
+    settings.log_settings()
 
-    if corr: pcorr == False
+    template_df = read_template_vertices(origcsv)
+    if arguments['--sweep']:
+        sweep_grid = read_sweep_grid(arguments['<sweep.csv>'], settings)
+        max_radius = max(settings.max_radius, sweep_grid[SWEEP_RADII].values.max())
+    else:
+        max_radius = settings.max_radius
+    surfL, surfR = prepare_surfaces(surfL, surfR, max_radius, tmpdir)
 
-    if not pcorr and not corr: pcorr = True
+    if arguments['--sweep']:
+        return run_PINT_sweep(sweep_grid, func, arguments['<outputdir>'],
+                              template_df, surfL, surfR, settings, settings.n_cpus)
 
-    if pcorr:
-        logger.info('    Maximizing partial correlation')
-    else:
-        logger.info('    Maximizing full correlation')
+    if arguments['--batch']:
+        return run_PINT_batch(arguments['<manifest.csv>'], arguments['<outputdir>'],
+                              template_df, surfL, surfR, settings, settings.n_cpus)
 
     logger.info(ciftify.utils.section_header('Starting PINT'))
+    pint_subject(func, surfL, surfR, template_df, output_prefix, settings)
 
-    ## loading the dataframe
+def read_template_vertices(origcsv):
+    '''read the template vertices, adding a roiidx column if it is missing'''
     df = pd.read_csv(origcsv)
     if 'roiidx' not in df.columns:
         df.loc[:,'roiidx'] = pd.Series(np.arange(1,len(df.index)+1), index=df.index)
+    return df
+
+def prepare_surfaces(surfL, surfR, max_radius, tmpdir):
+    '''
+    build (or read from the cache) the geodesic neighbourhood index for the
+    largest radius (the smaller radii are restricted from it), then
+    cp the surfaces to the tmpdir - this will cut down on i-o is tmpdir is ramdisk
+    '''
+    for surf in [surfL, surfR]:
+        ciftify.geodesic.get_neighbourhood_index(surf, max_radius)
 
-    ## cp the surfaces to the tmpdir - this will cut down on i-o is tmpdir is ramdisk
     tmp_surfL = os.path.join(tmpdir, 'surface.L.surf.gii')
     tmp_surfR = os.path.join(tmpdir, 'surface.R.surf.gii')
     docmd(['cp', surfL, tmp_surfL])
     docmd(['cp', surfR ,tmp_surfR])
-    surfL = tmp_surfL
-    surfR = tmp_surfR
+    return tmp_surfL, tmp_surfR
 
+def pint_subject(func, surfL, surfR, template_df, output_prefix, settings):
+    '''run PINT on one func file and write the summary and meants outputs'''
     ## run the main iteration
-    df, max_distance, distance_outcol, iter_num = iterate_pint(df, 'tvertex',
-                                                        func, surfL, surfR,
-                                                        pcorr, pre_smooth_sigma)
-
-    if outputall:
+    func_data, func_zeros, num_Lverts, unsmoothed_data = read_func_data(func,
+            settings.pre_smooth_sigma, surfL, surfR, keep_unsmoothed = True)
+    state, max_distance, trace = iterate_pint_data(template_df, 'tvertex',
+            func_data, func_zeros, num_Lverts, surfL, surfR, settings)
+    del func_data
+    df = state.to_dataframe()
+    if settings.trace:
+        trace.write('{}_pint_trace.json'.format(output_prefix), func)
+
+    if settings.outputall:
         cols_to_export = list(df.columns.values)
     else:
         cols_to_export = ['hemi','NETWORK','roiidx','tvertex','pvertex','distance']
         if max_distance > 1:
-            cols_to_export.extend([distance_outcol, 'vertex_{}'.format(iter_num - 2)])
+            ## (runs stopped before a second iteration have no vertex before the last move)
+            cols_to_export.extend([col for col in ['dist_{}'.format(state.iter_num - 1),
+                                   'vertex_{}'.format(state.iter_num - 2)]
+                                   if col in df.columns])
 
     df.to_csv('{}_summary.csv'.format(output_prefix), columns = cols_to_export, index = False)
 
-    ## load the sampling data
-    func_data, func_zeros, _ = read_func_data(func,
-                                    smooth_sigma = 0, surfL = None, surfR = None)
+    ## output the tvertex and pvertex meants of the unsmoothed data, from the
+    ## sampling rois of the first and the last iteration
+    for vertex_type in ['tvertex', 'pvertex']:
+        calc_sampling_meants(unsmoothed_data,
+            state.roiidx_labels(state.sampling_labels[vertex_type]),
+            outputcsv_name="{}_{}_meants.csv".format(output_prefix, vertex_type))
 
-    ## output the tvertex meants
-    sampling_rois = rois_bilateral(df, 'tvertex', RADIUS_SAMPLING, surfL, surfR)
-    sampling_rois[func_zeros] = 0
-    calc_sampling_meants(func_data, sampling_rois,
-    outputcsv_name="{}_tvertex_meants.csv".format(output_prefix))
-    ## output the pvertex meants
-    sampling_rois = rois_bilateral(df, 'pvertex', RADIUS_SAMPLING, surfL, surfR)
-    sampling_rois[func_zeros] = 0
-    calc_sampling_meants(func_data, sampling_rois,
-    outputcsv_name="{}_pvertex_meants.csv".format(output_prefix))
+def read_batch_manifest(manifest, outputdir):
+    '''
+    read the func files (and optional outputprefix) to run from the manifest
+    the default outputprefix is <outputdir>/<func basename>, exits if two runs
+    would write to the same outputprefix
+    '''
+    batch_df = pd.read_csv(manifest)
+    if 'func' not in batch_df.columns:
+        batch_df = pd.read_csv(manifest, header = None, names = ['func'])
+    if 'outputprefix' not in batch_df.columns:
+        batch_df['outputprefix'] = [os.path.join(outputdir,
+            ciftify.niio.determine_filetype(func)[1]) for func in batch_df.func]
+    duplicates = batch_df.outputprefix[batch_df.outputprefix.duplicated()].unique()
+    if len(duplicates):
+        logger.critical('More than one run of {} would write to the output prefix(es) {}, '
+            'give each run its own "outputprefix" in the manifest'.format(manifest,
+            ', '.join(duplicates)))
+        sys.exit(1)
+    return batch_df.loc[:, ['func', 'outputprefix']]
 
+def run_PINT_batch(manifest, outputdir, template_df, surfL, surfR, settings, n_cpus):
+    '''
+    run PINT for every func file in the manifest with a pool of worker processes
+    the neighbourhood indices are passed to the workers in shared memory
+    '''
+    batch_df = read_batch_manifest(manifest, outputdir)
+    num_runs = len(batch_df.index)
+    logger.info(ciftify.utils.section_header('Starting PINT batch of {} runs '
+        'with {} processes'.format(num_runs, n_cpus)))
+
+    shared_blocks = []
+    index_descriptions = []
+    for surf in [surfL, surfR]:
+        blocks, description = ciftify.geodesic.get_neighbourhood_index(surf,
+                                    settings.max_radius).to_shared_memory()
+        shared_blocks.extend(blocks)
+        index_descriptions.append(description)
+
+    results = []
+    try:
+        with multiprocessing.Pool(n_cpus, initializer = init_batch_worker,
+                initargs = (index_descriptions, template_df, surfL, surfR,
+                            settings)) as pool:
+            jobs = pool.imap_unordered(run_batch_subject,
+                        batch_df.itertuples(index = False, name = None))
+            for num_done, result in enumerate(jobs, 1):
+                results.append(result)
+                func, _, status, message, runtime = result
+                if status == 'done':
+                    logger.info('[{}/{}] Done {} ({:.0f}s)'.format(num_done,
+                        num_runs, func, runtime))
+                else:
+                    logger.error('[{}/{}] Failed {}: {}'.format(num_done,
+                        num_runs, func, message))
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+    status_df = pd.DataFrame(results, columns = ['func', 'outputprefix',
+                                    'status', 'message', 'runtime_s'])
+    status_df.to_csv(os.path.join(outputdir, 'PINT_batch_status.csv'), index = False)
+    num_failed = (status_df.status != 'done').sum()
+    logger.info('PINT batch finished: {} done, {} failed'.format(
+        num_runs - num_failed, num_failed))
+    return 1 if num_failed else 0
+
+## the shared inputs of each batch worker process (set by init_batch_worker)
+BATCH_INPUTS = {}
+
+def init_batch_worker(index_descriptions, template_df, surfL, surfR, settings):
+    '''attach the shared neighbourhood indices and keep the shared inputs'''
+    for description in index_descriptions:
+        ciftify.geodesic.register_neighbourhood_index(
+            ciftify.geodesic.NeighbourhoodIndex.from_shared_memory(description))
+    ## each run logs to its own file, not to the batch log
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.FileHandler):
+            logger.removeHandler(handler)
+    BATCH_INPUTS.update(template_df = template_df, surfL = surfL, surfR = surfR,
+                        settings = settings)
+
+def run_batch_subject(job):
+    '''
+    run PINT for one (func, outputprefix) in a batch worker
+    errors are caught and returned, so that one run cannot stop the batch
+    '''
+    func, output_prefix = job
+    start_time = time.time()
+    fh = None
+    try:
+        ciftify.utils.make_dir(os.path.dirname(os.path.abspath(output_prefix)),
+                               suppress_exists_error = True)
+        fh = logging.FileHandler('{}_pint.log'.format(output_prefix))
+        fh.setLevel(logging.INFO)
+        fh.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(fh)
+        logger.info(ciftify.utils.section_header('Starting PINT'))
+        logger.info('    functional data: {}'.format(func))
+        pint_subject(func, BATCH_INPUTS['surfL'], BATCH_INPUTS['surfR'],
+                     BATCH_INPUTS['template_df'], output_prefix,
+                     BATCH_INPUTS['settings'])
+        logger.info(ciftify.utils.section_header("Done PINT"))
+        status, message = 'done', ''
+    except (Exception, SystemExit) as err:
+        logger.exception('PINT failed for {}'.format(func))
+        status, message = 'failed', repr(err)
+    finally:
+        if fh:
+            logger.removeHandler(fh)
+            fh.close()
+    return func, output_prefix, status, message, time.time() - start_time
+
+## the settings that can be varied in a --sweep
+SWEEP_RADII = ['sampling_radius', 'search_radius', 'padding_radius']
+
+def read_sweep_grid(sweep_csv, settings):
+    '''
+    read the configurations to run from the sweep csv (any of the SWEEP_RADII
+    columns, missing columns take the value from the options)
+    '''
+    try:
+        grid = pd.read_csv(sweep_csv)
+    except Exception:
+        logger.critical("Could not read the sweep table {}".format(sweep_csv))
+        sys.exit(1)
+    unknown = set(grid.columns) - set(SWEEP_RADII)
+    if unknown:
+        logger.critical("Unknown columns {} in the sweep table {}, the columns "
+            "should be from {}".format(sorted(unknown), sweep_csv, SWEEP_RADII))
+        sys.exit(1)
+    for radius in SWEEP_RADII:
+        if radius not in grid.columns:
+            grid[radius] = getattr(settings, radius)
+    grid = grid.loc[:, SWEEP_RADII].astype(float).drop_duplicates().reset_index(drop = True)
+    grid.insert(0, 'config', ['sampling{:g}_search{:g}_padding{:g}'.format(*radii)
+                              for radii in grid[SWEEP_RADII].values])
+    return grid
+
+def run_PINT_sweep(sweep_grid, func, outputdir, template_df, surfL, surfR,
+                   settings, n_cpus):
+    '''
+    run PINT on one func file for every configuration (row) of the sweep grid
+    the func data is read once and shared (with the neighbourhood indices)
+    by a pool of worker processes, the results are written to one table
+    '''
+    num_configs = len(sweep_grid.index)
+    n_cpus = min(n_cpus, num_configs)
+    logger.info(ciftify.utils.section_header('Starting PINT sweep of {} '
+        'configurations with {} processes'.format(num_configs, n_cpus)))
+    func_data, func_zeros, num_Lverts = read_func_data(func,
+                                        settings.pre_smooth_sigma, surfL, surfR)
+    jobs = [(config, dict(zip(SWEEP_RADII, radii)), outputdir) for config, radii in
+                zip(sweep_grid.config, sweep_grid[SWEEP_RADII].values.tolist())]
+
+    results = []
+    if n_cpus < 2:
+        SWEEP_INPUTS.update(func_data = func_data, func_zeros = func_zeros,
+                            num_Lverts = num_Lverts, template_df = template_df,
+                            surfL = surfL, surfR = surfR, settings = settings)
+        for job in jobs:
+            results.append(run_sweep_config(job))
+            log_sweep_progress(results[-1], len(results), num_configs)
+    else:
+        shared_blocks = []
+        index_descriptions = []
+        for surf in [surfL, surfR]:
+            blocks, description = ciftify.geodesic.get_neighbourhood_index(surf,
+                                    sweep_grid[SWEEP_RADII].values.max()).to_shared_memory()
+            shared_blocks.extend(blocks)
+            index_descriptions.append(description)
+        func_block, func_description = share_array(func_data)
+        shared_blocks.append(func_block)
+        try:
+            with multiprocessing.Pool(n_cpus, initializer = init_sweep_worker,
+                    initargs = (func_description, func_zeros, num_Lverts,
+                                index_descriptions, template_df, surfL, surfR,
+                                settings)) as pool:
+                for result in pool.imap_unordered(run_sweep_config, jobs):
+                    results.append(result)
+                    log_sweep_progress(result, len(results), num_configs)
+        finally:
+            for block in shared_blocks:
+                block.close()
+                block.unlink()
+
+    ## one tidy table, a row per configuration and roi, in the order of the grid
+    order = {config: i for i, config in enumerate(sweep_grid.config)}
+    results_df = pd.concat(sorted(results, key = lambda r: order[r.config.iloc[0]]),
+                           ignore_index = True)
+    results_df.to_csv(os.path.join(outputdir, 'PINT_sweep_results.csv'), index = False)
+    return 0
+
+def log_sweep_progress(result, num_done, num_configs):
+    stats = result.iloc[0]
+    logger.info('[{}/{}] {}: {} iterations ({}), max distance {:.2f} ({:.0f}s)'
+        ''.format(num_done, num_configs, stats.config, stats.iterations,
+                  stats.stop_reason, stats.max_distance, stats.runtime_s))
+
+## the shared inputs of each sweep worker process (set by init_sweep_worker)
+SWEEP_INPUTS = {}
+
+def init_sweep_worker(func_description, func_zeros, num_Lverts,
+                      index_descriptions, template_df, surfL, surfR, settings):
+    '''attach the shared func data and neighbourhood indices and keep the shared inputs'''
+    for description in index_descriptions:
+        ciftify.geodesic.register_neighbourhood_index(
+            ciftify.geodesic.NeighbourhoodIndex.from_shared_memory(description))
+    func_block, func_data = attach_array(func_description)
+    SWEEP_INPUTS.update(func_block = func_block, func_data = func_data,
+                        func_zeros = func_zeros, num_Lverts = num_Lverts,
+                        template_df = template_df, surfL = surfL, surfR = surfR,
+                        settings = settings)
+
+def run_sweep_config(job):
+    '''
+    run the PINT iterations for one configuration of a sweep
+    returns the summary of every roi, with the configuration and its
+    convergence statistics
+    '''
+    config, radii, outputdir = job
+    start_time = time.time()
+    settings = copy.copy(SWEEP_INPUTS['settings'])
+    for radius, value in radii.items():
+        setattr(settings, radius, value)
+    state, max_distance, trace = iterate_pint_data(SWEEP_INPUTS['template_df'],
+                'tvertex', SWEEP_INPUTS['func_data'], SWEEP_INPUTS['func_zeros'],
+                SWEEP_INPUTS['num_Lverts'], SWEEP_INPUTS['surfL'],
+                SWEEP_INPUTS['surfR'], settings)
+    if settings.trace:
+        trace.write(os.path.join(outputdir,
+                    'PINT_sweep_{}_pint_trace.json'.format(config)))
+    last_iteration = trace.iterations[-1] if trace.iterations else {}
+    result = state.to_dataframe().loc[:, ['hemi', 'NETWORK', 'roiidx', 'tvertex',
+                                          'pvertex', 'distance']]
+    stats = pd.Series(collections.OrderedDict([('config', config)] +
+        [(radius, radii[radius]) for radius in SWEEP_RADII] +
+        [('iterations', state.iter_num),
+         ('stop_reason', trace.stop_reason),
+         ('max_distance', max_distance),
+         ('vertices_moved', last_iteration.get('vertices_moved', 0)),
+         ('oscillating', last_iteration.get('oscillating', 0)),
+         ('mean_distance', result.distance.mean()),
+         ('runtime_s', time.time() - start_time)]))
+    for i, (column, value) in enumerate(stats.items()):
+        result.insert(i, column, value)
+    return result
 
 ### Erin's little function for running things in the shell
 def docmd(cmdlist):
@@ -175,8 +551,12 @@ def log_build_environment():
     logger.info("---### End of Environment Settings ###---{}".format(os.linesep))
 ## measuring distance
 
-def read_func_data(func, smooth_sigma, surfL, surfR):
-    ''' read in the functional surface data (with or without pre-smoothing)'''
+def read_func_data(func, smooth_sigma, surfL, surfR, keep_unsmoothed = False):
+    '''
+    read in the functional surface data (with or without pre-smoothing)
+    with keep_unsmoothed, the unsmoothed data is also returned (as the same
+    array when there is no smoothing)
+    '''
 
     ## separate the cifti file into left and right surfaces
     with ciftify.utils.TempDir() as lil_tempdir:
@@ -189,29 +569,27 @@ def read_func_data(func, smooth_sigma, surfL, surfR):
             '-metric', 'CORTEX_LEFT', L_data_surf, '-roi', L_roi,
             '-metric', 'CORTEX_RIGHT', R_data_surf, '-roi', R_roi])
 
-        ## do the optional smoothing
-        if smooth_sigma > 0:
-            # smooth the data using the roi output from the cifti file
-            L_data_sm = os.path.join(lil_tempdir, 'Ldata_sm.func.gii')
-            R_data_sm = os.path.join(lil_tempdir, 'Rdata_sm.func.gii')
-            docmd(['wb_command', '-metric-smoothing',
-                surfL, L_data_surf, str(smooth_sigma), L_data_sm, '-roi', L_roi])
-            docmd(['wb_command', '-metric-smoothing',
-                surfR, R_data_surf, str(smooth_sigma), R_data_sm, '-roi', R_roi])
-        else:
-            # if no smoothing use the un-smoothed data for the next step
-            L_data_sm = L_data_surf
-            R_data_sm = R_data_surf
-
         ## load both surfaces and concatenate them together
-        func_dataL = ciftify.niio.load_gii_data(L_data_sm)
-        func_dataR = ciftify.niio.load_gii_data(R_data_sm)
+        func_dataL = ciftify.niio.load_gii_data(L_data_surf)
+        func_dataR = ciftify.niio.load_gii_data(R_data_surf)
         Lroi_data = ciftify.niio.load_gii_data(L_roi)
         Rroi_data = ciftify.niio.load_gii_data(R_roi)
 
+    unsmoothed_data = np.vstack((func_dataL, func_dataR)) if keep_unsmoothed else None
+
+    ## do the optional smoothing (in memory, using the roi from the cifti file)
+    if smooth_sigma > 0:
+        func_dataL = ciftify.smoothing.smooth_surface_data(func_dataL, surfL,
+                                                smooth_sigma, roi = Lroi_data[:,0])
+        func_dataR = ciftify.smoothing.smooth_surface_data(func_dataR, surfR,
+                                                smooth_sigma, roi = Rroi_data[:,0])
+
     ## stack the left and right surfaces
     num_Lverts = func_dataL.shape[0]
-    func_data = np.vstack((func_dataL, func_dataR))
+    if smooth_sigma > 0 or unsmoothed_data is None:
+        func_data = np.vstack((func_dataL, func_dataR))
+    else:
+        func_data = unsmoothed_data
 
     ## determiner the roi
     func_zeros1 = np.where(func_data[:,5]<5)[0]
@@ -222,61 +600,201 @@ def read_func_data(func, smooth_sigma, surfL, surfR):
     func_zeros = np.intersect1d(func_zeros1, func_zeros2)
     logger.debug('Shape of func_zeros: {}'.format(func_zeros.shape))
 
+    if keep_unsmoothed:
+        return func_data, func_zeros, num_Lverts, unsmoothed_data
     return func_data, func_zeros, num_Lverts
 
 
-def calc_surf_distance(surf, orig_vertex, target_vertex, radius_search):
+def calc_distances(hemis, orig_vertices, target_vertices, radius_search, surfL, surfR):
     '''
-    uses wb_command -surface-geodesic-distance command to measure
-    distance between two vertices on the surface
+    the geodesic distance between each pair of orig and target vertices
+    (on the surface of the hemisphere given in hemis) as a 1D array,
+    pairs further apart than radius_search are -1 (as from wb_command)
     '''
-    if int(orig_vertex) == int(target_vertex):
-        distance = 0
-    else:
-        distances = ciftify.niio.get_surf_distances(surf, orig_vertex,
-                                                         radius_search = radius_search,
-                                                         suppress_echo = True)
-        distance = distances[target_vertex,0]
-    return(distance)
-
-def calc_distance_column(df, orig_vertex_col, target_vertex_col,distance_outcol,
-                         radius_search, surfL, surfR):
-    df.loc[:,distance_outcol] = -99.9
-    for idx in df.index.tolist():
-        orig_vertex = df.loc[idx, orig_vertex_col]
-        target_vertex = df.loc[idx, target_vertex_col]
-        hemi = df.loc[idx,'hemi']
-        if hemi == "L":
-            df.loc[idx, distance_outcol] = calc_surf_distance(surfL, orig_vertex,
-                                            target_vertex, radius_search)
-        if hemi == "R":
-            df.loc[idx, distance_outcol] = calc_surf_distance(surfR, orig_vertex,
-                                            target_vertex, radius_search)
-    return df
-
-def roi_surf_data(df, vertex_colname, surf, hemisphere, roi_radius):
+    hemis = np.asarray(hemis)
+    distances = np.zeros(len(hemis))
+    for hemi, surf in [('L', surfL), ('R', surfR)]:
+        rows = np.flatnonzero(hemis == hemi)
+        if rows.size:
+            distances[rows] = ciftify.geodesic.get_vertex_distances(surf,
+                                np.asarray(orig_vertices)[rows],
+                                np.asarray(target_vertices)[rows], radius_search)
+    distances[np.isinf(distances)] = -1
+    return distances
+
+## the per roi state of a PINT run (network is an id into PINTState.networks)
+PINT_STATE_DTYPE = np.dtype([('roiidx', np.int32),
+                             ('network', np.int32),
+                             ('hemi', 'U1'),
+                             ('vertex', np.int32)])
+
+class PINTState(object):
     '''
-    uses wb_command -surface-geodesic-rois to build rois (3D files)
-    then load and collasp that into 1D array
+    the state of a PINT run kept in numpy arrays (one row per roi of the
+    template dataframe), the summary dataframe is only built by to_dataframe()
+
+    rois: structured array (PINT_STATE_DTYPE) of roiidx, network id, hemi
+          and the current vertex
+    networks: the NETWORK names, indexed by network id
+    network_rows: for each network id, the rows of its rois (sorted by roiidx)
+    vertex_history: (iterations x rois) int32 array of the vertex chosen on
+          every iteration (only kept if keep_history is True)
+    sampling_labels: the labels (row + 1) of the sampling rois around the
+          tvertex and the pvertex, kept by pint_iterations
     '''
-    ## right the L and R hemisphere vertices from the table out to temptxt
-    with ciftify.utils.TempDir() as lil_tmpdir:
-        ## write a temp vertex list file
-        vertex_list = os.path.join(lil_tmpdir, 'vertex_list.txt')
-        df.loc[df.hemi == hemisphere, vertex_colname].to_csv(vertex_list,sep='\n',index=False)
-
-        ## from the temp text build - func masks and target masks
-        roi_surf = os.path.join(lil_tmpdir,'roi_surf.func.gii')
-        docmd(['wb_command', '-surface-geodesic-rois', surf,
-            str(roi_radius),  vertex_list, roi_surf,
-            '-overlap-logic', 'EXCLUDE'])
-        rois_data = ciftify.niio.load_gii_data(roi_surf)
+    def __init__(self, df, vertex_colname, keep_history = False):
+        self.template_df = df.reset_index(drop = True)
+        network_ids, self.networks = pd.factorize(self.template_df.NETWORK)
+        self.rois = np.zeros(len(self.template_df), dtype = PINT_STATE_DTYPE)
+        self.rois['roiidx'] = self.template_df.roiidx.values
+        self.rois['network'] = network_ids
+        self.rois['hemi'] = self.template_df.hemi.values
+        self.rois['vertex'] = self.template_df[vertex_colname].values
+        by_roiidx = np.argsort(self.rois['roiidx'], kind = 'stable')
+        self.network_rows = [by_roiidx[network_ids[by_roiidx] == network]
+                             for network in range(len(self.networks))]
+        self.start_vertex = self.rois['vertex'].copy()
+        self.previous_vertex = self.rois['vertex'].copy()
+        self.last_distance = np.zeros(len(self.rois))
+        self.distance = np.zeros(len(self.rois))
+        self.iter_num = 0
+        self.keep_history = keep_history
+        self.sampling_labels = {}
+        self._vertex_history = []
+        self._distance_history = []
+
+    def __len__(self):
+        return len(self.rois)
+
+    @property
+    def vertex_history(self):
+        if not self.keep_history:
+            return None
+        return np.array(self._vertex_history, dtype = np.int32).reshape(-1, len(self))
+
+    def roiidx_labels(self, labels):
+        '''converts roi labels of state rows (row + 1) to roiidx labels'''
+        return np.where(labels > 0, self.rois['roiidx'][labels - 1], 0)
+
+    def record_iteration(self, vertices, distances):
+        '''move the rois to the vertices chosen in this iteration'''
+        self.previous_vertex = self.rois['vertex'].copy()
+        self.rois['vertex'] = vertices
+        self.last_distance = distances
+        if self.keep_history:
+            self._vertex_history.append(self.rois['vertex'].copy())
+            self._distance_history.append(distances)
+        self.iter_num += 1
+
+    def to_dataframe(self):
+        '''
+        the summary dataframe, the template columns plus the vertex and distance
+        of every iteration (if the history was kept, otherwise only the last
+        distance and the vertex before the last move), pvertex and distance
+        '''
+        df = self.template_df.copy()
+        if self.keep_history:
+            for iter_num in range(self.iter_num):
+                df['vertex_{}'.format(iter_num)] = self._vertex_history[iter_num]
+                df['dist_{}'.format(iter_num)] = self._distance_history[iter_num]
+        elif self.iter_num > 0:
+            if self.iter_num > 1:
+                df['vertex_{}'.format(self.iter_num - 2)] = self.previous_vertex
+            df['dist_{}'.format(self.iter_num - 1)] = self.last_distance
+        df['pvertex'] = self.rois['vertex']
+        df['distance'] = self.distance
+        return df
+
+## the (lower) edges in mm of the distance histogram of the PINT trace
+TRACE_DISTANCE_BINS = [0, 1, 2, 4, 6, 8, 12]
+
+class PINTTrace(object):
+    '''
+    a per-iteration record of a PINT run (phase timings, vertices moved, a
+    histogram of the distances moved and the rois oscillating between two
+    vertices) that also decides when to stop on an oscillation or plateau
 
-    ## multiply by labels and reduce to 1 vector
-    vlabels = df[df.hemi == hemisphere].roiidx.tolist()
-    rois_data = np.multiply(rois_data, vlabels)
-    rois_data1D = np.max(rois_data, axis=1)
+    iterations: one dict per iteration (written as json by write())
+    stop_reason: why the iterations stopped ('converged', 'max_iterations',
+                 'oscillating' or 'plateau')
+    '''
+    def __init__(self, state, stop_oscillating = None, stop_plateau = None):
+        self.roiidx = state.rois['roiidx'].copy()
+        self.stop_oscillating = stop_oscillating
+        self.stop_plateau = stop_plateau
+        self.iterations = []
+        self.stop_reason = None
+        self._two_back = None
+        self._oscillating_run = 0
+        self._fewest_moved = None
+        self._plateau_run = 0
+
+    def record(self, old_vertices, new_vertices, distances, timings):
+        '''add the record of one iteration'''
+        moved = distances > 0
+        if self._two_back is None:
+            oscillating = np.zeros(len(distances), dtype = bool)
+        else:
+            oscillating = moved & (new_vertices == self._two_back)
+        self._two_back = old_vertices.copy()
+        n_moved = int(np.count_nonzero(moved))
+
+        ## runs of iterations where every moving vertex is oscillating,
+        ## and since the number of moving vertices last reached a new minimum
+        if n_moved and np.all(oscillating[moved]):
+            self._oscillating_run += 1
+        else:
+            self._oscillating_run = 0
+        if self._fewest_moved is None or n_moved < self._fewest_moved:
+            self._fewest_moved = n_moved
+            self._plateau_run = 0
+        else:
+            self._plateau_run += 1
+
+        counts, _ = np.histogram(distances,
+                                 bins = TRACE_DISTANCE_BINS + [np.inf])
+        record = {'iteration': len(self.iterations)}
+        record.update({'{}_seconds'.format(phase): round(seconds, 4)
+                       for phase, seconds in timings.items()})
+        record.update({'vertices_moved': n_moved,
+                       'max_distance': float(np.max(distances)),
+                       'distance_histogram': counts.tolist(),
+                       'oscillating': int(np.count_nonzero(oscillating)),
+                       'oscillating_rois': self.roiidx[oscillating].tolist()})
+        self.iterations.append(record)
+        return record
+
+    def check_stop(self):
+        '''the reason to stop early (or None to keep iterating)'''
+        if self.stop_oscillating and self._oscillating_run >= self.stop_oscillating:
+            return 'oscillating'
+        if self.stop_plateau and self._plateau_run >= self.stop_plateau:
+            return 'plateau'
+        return None
+
+    def write(self, filename, func = None):
+        '''write the trace to a json sidecar'''
+        bins = ['{}-{}'.format(lo, hi) for lo, hi in
+                    zip(TRACE_DISTANCE_BINS[:-1], TRACE_DISTANCE_BINS[1:])]
+        bins.append('{}+'.format(TRACE_DISTANCE_BINS[-1]))
+        trace = {'func': func,
+                 'stop_reason': self.stop_reason,
+                 'iterations_run': len(self.iterations),
+                 'distance_histogram_bins_mm': bins,
+                 'iterations': self.iterations}
+        with open(filename, 'w') as fp:
+            json.dump(trace, fp, indent=4)
 
+def roi_surf_data(df, vertex_colname, surf, hemisphere, roi_radius):
+    '''
+    builds the rois (as a 1D array of roiidx labels) from the cached geodesic
+    neighbourhood index of the surface. Vertices within the radius of more than
+    one roi are excluded (as in wb_command -surface-geodesic-rois -overlap-logic EXCLUDE)
+    '''
+    neighbourhoods = ciftify.geodesic.get_neighbourhood_index(surf, roi_radius)
+    hemi_df = df.loc[df.hemi == hemisphere, :]
+    rois_data1D = neighbourhoods.roi_labels(hemi_df[vertex_colname].values.astype(int),
+                                            hemi_df.roiidx.values)
     return rois_data1D
 
 def rois_bilateral(df, vertex_colname, roi_radius, surfL, surfR):
@@ -288,30 +806,95 @@ def rois_bilateral(df, vertex_colname, roi_radius, surfL, surfR):
     rois = np.hstack((rois_L, rois_R))
     return rois
 
-def calc_network_meants(sampling_meants, df):
+class BilateralRois(object):
     '''
-    calculate the network mean timeseries from many sub rois
+    geodesic rois of one radius around the current vertex of every roi of a
+    PINTState (on both hemispheres) that are updated in place as vertices move,
+    so that only the rois near a moved vertex change
+
+    labels: the 1D array of roi labels (left vertices stacked on top of right),
+            where the label of an roi is its PINTState row + 1
     '''
-    netmeants = pd.DataFrame(np.nan,
-                                index = list(range(sampling_meants.shape[1])),
-                                columns = df['NETWORK'].unique())
-    for network in netmeants.columns:
-        netlabels = df[df.NETWORK == network].roiidx.tolist()
-        netmeants.loc[:,network] = np.mean(sampling_meants[(np.array(netlabels)-1), :], axis=0)
+    def __init__(self, state, roi_radius, surfL, surfR, func_zeros = None):
+        self.hemis = {}
+        self.row_hemis = state.rois['hemi'].copy()
+        offset = 0
+        for hemisphere, surf in [('L', surfL), ('R', surfR)]:
+            neighbourhoods = ciftify.geodesic.get_neighbourhood_index(surf, roi_radius)
+            rows = np.flatnonzero(self.row_hemis == hemisphere)
+            rois = ciftify.geodesic.GeodesicRois(neighbourhoods,
+                                    state.rois['vertex'][rows], rows + 1)
+            self.hemis[hemisphere] = (rois, offset, rows)
+            offset += neighbourhoods.n_vertices
+        self.excluded = np.zeros(offset, dtype = bool)
+        if func_zeros is not None:
+            self.excluded[func_zeros] = True
+        self.labels = np.hstack((self.hemis['L'][0].labels, self.hemis['R'][0].labels))
+        self.labels[self.excluded] = 0
+
+    def update(self, vertices):
+        '''
+        move the rois to vertices (one per PINTState row)
+        returns the (sorted) rows of the rois whose vertices changed
+        '''
+        changed = set()
+        for hemisphere, (rois, offset, rows) in self.hemis.items():
+            for row, vertex in zip(rows.tolist(), vertices[rows].tolist()):
+                touched = rois.move(row + 1, vertex)
+                if not touched.size:
+                    continue
+                changed.update(self.labels[touched + offset].tolist())
+                self.labels[touched + offset] = np.where(self.excluded[touched + offset],
+                                                         0, rois.labels[touched])
+                changed.update(self.labels[touched + offset].tolist())
+        changed.discard(0)
+        return np.array(sorted(changed), dtype = int) - 1
+
+    def members(self, row):
+        '''the (bilateral) vertex indices that belong to the roi of one row'''
+        rois, offset, _ = self.hemis[self.row_hemis[row]]
+        members = rois.members(row + 1) + offset
+        return members[~self.excluded[members]]
+
+def update_sampling_meants(func_data, sampling_rois, sampling_meants, rows):
+    '''
+    recalculate (in place) the rows of the sampling meants array
+    (one row per PINTState row) for the rois given in rows
+    '''
+    for row in rows:
+        members = sampling_rois.members(row)
+        if members.size:
+            sampling_meants[row, :] = np.mean(func_data[members, :], axis=0)
+        else:
+            sampling_meants[row, :] = np.nan
+    return sampling_meants
+
+def update_network_meants(netmeants, sampling_meants, state, rows):
+    '''
+    recalculate (in place) the columns of the network meants array of the
+    networks that contain the rois given in rows
+    '''
+    for network in np.unique(state.rois['network'][rows]):
+        netrows = state.network_rows[network]
+        netmeants[:, network] = np.nanmean(sampling_meants[netrows, :], axis=0)
     return netmeants
 
+def calc_network_meants(sampling_meants, state):
+    '''
+    calculate the network mean timeseries from many sub rois
+    returns a timepoints x networks array (columns indexed by network id)
+    '''
+    netmeants = np.zeros((sampling_meants.shape[1], len(state.networks)))
+    return update_network_meants(netmeants, sampling_meants, state,
+                                 np.arange(len(state)))
+
 def calc_sampling_meants(func_data, sampling_roi_mask, outputcsv_name=None):
     '''
     output a np.arrary of the meants for every index in the sampling_roi_mask
     '''
-    # init output vector
+    # get mean seed dataistic from each roi
     rois = np.unique(sampling_roi_mask)[1:]
-    out_data = np.zeros((len(rois), func_data.shape[1]))
-
-    # get mean seed dataistic from each, append to output
-    for i, roi in enumerate(rois):
-        idx = np.where(sampling_roi_mask == roi)[0]
-        out_data[i,:] = np.mean(func_data[idx, :], axis=0)
+    out_data = ciftify.compute.roi_means(func_data, sampling_roi_mask, rois)
 
     ## if the outputfile argument was given, then output the file
     if outputcsv_name:
@@ -348,156 +931,312 @@ def mass_partial_corr(X,massY,Z):
     assert X.shape[0]==massY.shape[1]
     assert massY.shape[1]==Z.shape[0]
 
-    ## stack X and Y together to prepare to regress
-    pre_res = np.vstack((X,massY))
-
-    ## loop over all signals and to regress out confounds
-    res_by_z = np.zeros(pre_res.shape) -1
-    for i in range(pre_res.shape[0]):
-        res_by_z[i,:] = linalg_calc_residulals(Z, pre_res[i,:])
-
-    ## correlate all the residuals, take the relevant values from the first row
-    mass_pcorrs = np.corrcoef(res_by_z)[0, 1:]
+    ## regress Z from X and all the signals and correlate the residuals
+    mass_pcorrs = ciftify.compute.partial_corr(X, massY, Z)
 
     assert len(mass_pcorrs)==massY.shape[0]
 
     return(mass_pcorrs)
 
-def pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
-                     func_data, sampling_meants,
+def pint_vertex_search_inputs(state, row, sampling_meants,
+                              search_rois, padding_rois, pcorr, netmeants = None):
+    '''
+    gather what is needed to move the vertex of one roi (PINTState row)
+    returns:
+      meants: the network meants (excluding this roi)
+      idx_mask: the (sorted) vertices this roi can move to
+      confounds: the other network meants to regress (None unless pcorr)
+    '''
+    network = state.rois['network'][row]
+
+    ## get the meants - excluding this roi from the network
+    netrows = state.network_rows[network]
+    meants = np.nanmean(sampling_meants[netrows[netrows != row], :], axis=0)
+
+    # the search space is the intersection of the search radius roi and the padding rois
+    # (the padding rois creates and exclusion mask if rois are to close to one another)
+    idx_mask = np.intersect1d(search_rois.members(row), padding_rois.members(row),
+                              assume_unique=True)
+
+    if pcorr:
+        confounds = np.delete(netmeants, network, axis=1)
+    else:
+        confounds = None
+    return meants, idx_mask, confounds
+
+def find_peak_vertex(func_data, meants, idx_mask, confounds = None):
+    '''
+    the vertex (row of func_data) in idx_mask with the highest correlation to
+    meants (partial correlation, regressing the confounds, if they are given)
+    '''
+    # calculate r for the time series in the mask
+    if confounds is not None:
+        seed_corrs = ciftify.compute.partial_corr(meants, func_data, confounds,
+                                                  mask = idx_mask)
+    else:
+        seed_corrs = ciftify.compute.masked_corr(meants, func_data, mask = idx_mask)
+    ## record the vertex with the highest correlation in the mask
+    return idx_mask[np.argmax(seed_corrs, axis=0)]
+
+def pint_move_vertex(state, row, func_data, sampling_meants,
                      search_rois, padding_rois, pcorr,
                      num_Lverts, netmeants = None):
     '''
     move one vertex in the pint algorithm
     inputs:
-      df: the result dataframe
-      idx: this vertices row index
+      state: the PINTState
+      row: this vertices row in the state
       sampling_meants: the meants matrix calculated from the sampling rois
       search_rois: the search rois (the extent of the search radius)
       padding_rois: the padding rois (the mask that prevent search spaces from overlapping)
       pcorr : wether or not to use partial corr
-      netmeants: netmeants object if running pcorr (if set to None, regular correlation is run)
+      netmeants: netmeants array if running pcorr (if set to None, regular correlation is run)
+    returns the new vertex (on its own hemisphere)
     '''
-    vlabel = df.loc[idx,'roiidx']
-    network = df.loc[idx,'NETWORK']
-    hemi = df.loc[idx,'hemi']
-    orig_vertex = df.loc[idx, vertex_incol]
-
-    ## get the meants - excluding this roi from the network
-    netlabels = list(set(df[df.NETWORK == network].roiidx.tolist()) - set([vlabel]))
-    meants = np.mean(sampling_meants[(np.array(netlabels) - 1), :], axis=0)
-
-    # the search space is the intersection of the search radius roi and the padding rois
-    # (the padding rois creates and exclusion mask if rois are to close to one another)
-    idx_search = np.where(search_rois == vlabel)[0]
-    idx_pad = np.where(padding_rois == vlabel)[0]
-    idx_mask = np.intersect1d(idx_search, idx_pad, assume_unique=True)
+    meants, idx_mask, confounds = pint_vertex_search_inputs(state, row,
+                                        sampling_meants, search_rois, padding_rois,
+                                        pcorr, netmeants)
 
     # if there padding mask and the search mask have no overlap - size is 0
     # there is nowhere for this vertex to move to so return the orig vertex id
     if not idx_mask.size:
-        df.loc[idx,vertex_outcol] = orig_vertex
+        return state.rois['vertex'][row]
+    peakvert = find_peak_vertex(func_data, meants, idx_mask, confounds)
+    if state.rois['hemi'][row] == 'R': peakvert = peakvert - num_Lverts
+    return peakvert
 
-    else:
-        # create output array
-        seed_corrs = np.zeros(func_data.shape[0]) - 1
-
-        # loop through each time series, calculating r
-        if pcorr:
-            o_networks = set(netmeants.columns.tolist()) - set([network])
-            seed_corrs[idx_mask] = mass_partial_corr(meants,
-                                      func_data[idx_mask, :],
-                                      netmeants.loc[:,o_networks].as_matrix())
-        else:
-            seed_corrs[idx_mask] = np.corrcoef(meants,
-                                                  func_data[idx_mask, :])[0, 1:]
-        ## record the vertex with the highest correlation in the mask
-        peakvert = np.argmax(seed_corrs, axis=0)
-        if hemi =='R': peakvert = peakvert - num_Lverts
-        df.loc[idx,vertex_outcol] = peakvert
-
-    ## return the df
-    return df
-
-def iterate_pint(df, vertex_incol, func, surfL, surfR, pcorr, smooth_sigma = 0):
+class ParallelMover(object):
+    '''
+    scores the moves of all vertices in an iteration (against the same snapshot
+    of the rois and meants) in parallel, with a pool of worker processes that
+    read the func data from shared memory
+    '''
+    def __init__(self, func_data, n_cpus):
+        self.block, description = share_array(func_data)
+        self.n_cpus = n_cpus
+        self.pool = multiprocessing.Pool(n_cpus, initializer = init_parallel_mover,
+                                         initargs = (description,))
+
+    def move_vertices(self, state, order, new_vertices, sampling_meants,
+                      search_rois, padding_rois, pcorr,
+                      num_Lverts, netmeants = None):
+        '''
+        the parallel version of running pint_move_vertex for each row in order
+        (the moves are written to new_vertices)
+        '''
+        tasks = []
+        for row in order:
+            meants, idx_mask, confounds = pint_vertex_search_inputs(state, row,
+                                            sampling_meants, search_rois,
+                                            padding_rois, pcorr, netmeants)
+            if not idx_mask.size:
+                new_vertices[row] = state.rois['vertex'][row]
+            else:
+                tasks.append((row, meants, idx_mask, confounds))
+        chunksize = max(1, len(tasks) // (self.n_cpus * 4))
+        for row, peakvert in self.pool.imap(parallel_find_peak_vertex, tasks, chunksize):
+            if state.rois['hemi'][row] == 'R': peakvert = peakvert - num_Lverts
+            new_vertices[row] = peakvert
+        return new_vertices
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.block.close()
+        self.block.unlink()
+
+## the func data of each ParallelMover worker process (set by init_parallel_mover)
+PARALLEL_FUNC_DATA = {}
+
+def init_parallel_mover(description):
+    '''attach the shared func data in a ParallelMover worker'''
+    block, func_data = attach_array(description)
+    PARALLEL_FUNC_DATA.update(block = block, func_data = func_data)
+
+def share_array(array):
+    '''
+    copy an array into a new shared memory block
+    returns the block and a (picklable) description to attach it with
+    '''
+    block = shared_memory.SharedMemory(create = True, size = max(1, array.nbytes))
+    np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[:] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def attach_array(description):
+    '''attach an array shared by share_array, returns the block and the array'''
+    block_name, shape, dtype = description
+    block = shared_memory.SharedMemory(name = block_name)
+    return block, np.ndarray(shape, dtype = dtype, buffer = block.buf)
+
+def parallel_find_peak_vertex(task):
+    row, meants, idx_mask, confounds = task
+    return row, find_peak_vertex(PARALLEL_FUNC_DATA['func_data'], meants,
+                                 idx_mask, confounds)
+
+def iterate_pint(df, vertex_incol, func, surfL, surfR, settings):
     '''
     The main bit of pint
 
     Args:
       df : the summary dataframe
       vertex_incol: the name of the column to use as the template rois
-      func_data: the numpy array of the data
-      func_data_mask: a mask of non-zero values from the func data
-      pcorr: wether or not to use partial correlation
-      smooth_sigma: the pre-smoothing sigma
+      func: the functional data file
+      surfL, surfR: the left and right surface files
+      settings: the UserSettings (radii, pcorr, pre-smoothing sigma and
+                parallel moves)
 
     Return:
-        the summary dataframe
+        the PINTState (with the vertex history kept if --outputall),
+        the max distance moved in the last iteration and the PINTTrace
     '''
 
-    func_data, func_zeros, num_Lverts = read_func_data(func, smooth_sigma,
-                                                        surfL, surfR)
-
-    iter_num = 0
+    func_data, func_zeros, num_Lverts = read_func_data(func,
+                                        settings.pre_smooth_sigma, surfL, surfR)
+    return iterate_pint_data(df, vertex_incol, func_data, func_zeros, num_Lverts,
+                             surfL, surfR, settings)
+
+def iterate_pint_data(df, vertex_incol, func_data, func_zeros, num_Lverts,
+                      surfL, surfR, settings):
+    '''iterate_pint for func data that has already been read (see read_func_data)'''
+    state = PINTState(df, vertex_incol, keep_history = settings.outputall)
+    trace = PINTTrace(state, settings.stop_oscillating, settings.stop_plateau)
+    mover = get_parallel_mover(func_data, settings)
+    try:
+        max_distance = pint_iterations(state, func_data, func_zeros, num_Lverts,
+                                       surfL, surfR, settings, trace, mover)
+    finally:
+        if mover: mover.close()
+
+    ## calc a final distance
+    state.distance = calc_distances(state.rois['hemi'], state.start_vertex,
+                                    state.rois['vertex'], 150, surfL, surfR)
+
+    return state, max_distance, trace
+
+def get_parallel_mover(func_data, settings):
+    '''start a ParallelMover if --parallel-moves was asked for (and is possible)'''
+    if not settings.parallel_moves or settings.n_cpus < 2:
+        return None
+    if multiprocessing.current_process().daemon:
+        logger.warning('--parallel-moves is ignored inside daemon worker processes '
+                       '(i.e. of --batch or --sweep)')
+        return None
+    logger.info('Scoring vertex moves in parallel with {} processes'.format(settings.n_cpus))
+    return ParallelMover(func_data, settings.n_cpus)
+
+def pint_iterations(state, func_data, func_zeros, num_Lverts,
+                    surfL, surfR, settings, trace, mover = None):
+    '''
+    iterate the pint vertex moves (updating the state and the trace) until no
+    vertex moves more than 1mm, the maximum number of iterations is reached or
+    the trace finds an oscillation or plateau to stop on
+    returns the max distance moved in the last iteration
+    '''
+    pcorr = settings.pcorr
     max_distance = 10
+    sampling_rois = None
 
-    while iter_num < (50) and max_distance > 1:
-        vertex_outcol = 'vertex_{}'.format(iter_num)
-        distance_outcol = 'dist_{}'.format(iter_num)
-        df.loc[:,vertex_outcol] = -999
-        df.loc[:,distance_outcol] = -99.9
-
-        ## load the sampling data
-        sampling_rois = rois_bilateral(df, vertex_incol, RADIUS_SAMPLING, surfL, surfR)
-        sampling_rois[func_zeros] = 0
-
-        ## load the search data
-        search_rois = rois_bilateral(df, vertex_incol, RADIUS_SEARCH, surfL, surfR)
-        search_rois[func_zeros] = 0
-
-        ## load the padding-radius data
-        padding_rois = rois_bilateral(df, vertex_incol, RADIUS_PADDING, surfL, surfR)
+    while True:
+        if max_distance <= 1:
+            trace.stop_reason = 'converged'
+        elif state.iter_num >= settings.max_iterations:
+            trace.stop_reason = 'max_iterations'
+        else:
+            trace.stop_reason = trace.check_stop()
+        if trace.stop_reason:
+            break
+        iter_num = state.iter_num
+        timings = {}
+        start_time = time.time()
+
+        ## build the rois on the first iteration, after that only the rois
+        ## near the vertices that moved (and their meants) need updating
+        if iter_num == 0:
+            sampling_rois = BilateralRois(state, settings.sampling_radius,
+                                          surfL, surfR, func_zeros)
+            search_rois = BilateralRois(state, settings.search_radius,
+                                        surfL, surfR, func_zeros)
+            padding_rois = BilateralRois(state, settings.padding_radius,
+                                         surfL, surfR)
+            state.sampling_labels['tvertex'] = sampling_rois.labels.copy()
+            changed_rows = np.arange(len(state))
+            sampling_meants = np.zeros((len(state), func_data.shape[1]))
+            netmeants = None
+        else:
+            changed_rows = sampling_rois.update(state.rois['vertex'])
+            search_rois.update(state.rois['vertex'])
+            padding_rois.update(state.rois['vertex'])
+        logger.debug('Iteration {} \tRois updated: {}'.format(iter_num, len(changed_rows)))
+        timings['rois'] = time.time() - start_time
+        start_time = time.time()
 
-        ## calculate the sampling meants array
-        sampling_meants = calc_sampling_meants(func_data, sampling_rois)
+        ## calculate the sampling meants of the changed rois
+        sampling_meants = update_sampling_meants(func_data, sampling_rois,
+                                                 sampling_meants, changed_rows)
 
         ## if we are doing partial corr create a matrix of the network
         if pcorr:
-            netmeants = calc_network_meants(sampling_meants, df)
-        else:
-            netmeants = None
+            if netmeants is None:
+                netmeants = calc_network_meants(sampling_meants, state)
+            else:
+                netmeants = update_network_meants(netmeants, sampling_meants,
+                                                  state, changed_rows)
+        timings['meants'] = time.time() - start_time
+        start_time = time.time()
 
         ## run the pint_move_vertex function for each vertex
-        thisorder = df.index.tolist()
-        random.shuffle(thisorder)
-        for idx in thisorder:
-            df = pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
-                                  func_data, sampling_meants,
-                                  search_rois, padding_rois, pcorr,
-                                  num_Lverts, netmeants)
+        thisorder = list(range(len(state)))
+        new_vertices = state.rois['vertex'].copy()
+        if mover:
+            new_vertices = mover.move_vertices(state, thisorder, new_vertices,
+                                     sampling_meants, search_rois,
+                                     padding_rois, pcorr,
+                                     num_Lverts, netmeants)
+        else:
+            for row in thisorder:
+                new_vertices[row] = pint_move_vertex(state, row,
+                                      func_data, sampling_meants,
+                                      search_rois, padding_rois, pcorr,
+                                      num_Lverts, netmeants)
+        timings['correlation'] = time.time() - start_time
+        start_time = time.time()
 
         ## calc the distances
-        df = calc_distance_column(df, vertex_incol, vertex_outcol, distance_outcol, RADIUS_SEARCH, surfL, surfR)
-        numNotDone = df.loc[df.loc[:,distance_outcol] > 0, 'roiidx'].count()
+        distances = calc_distances(state.rois['hemi'], state.rois['vertex'],
+                                   new_vertices, settings.search_radius, surfL, surfR)
+        timings['distance'] = time.time() - start_time
+        record = trace.record(state.rois['vertex'], new_vertices, distances, timings)
+        state.record_iteration(new_vertices, distances)
 
         ## print the max distance as things continue..
-        max_distance = max(df[distance_outcol])
-        logger.info('Iteration {} \tmax distance: {}\tVertices Moved: {}'.format(iter_num, max_distance, numNotDone))
-        vertex_incol = vertex_outcol
-        iter_num += 1
-
-    ## calc a final distance column
-    df.loc[:,"pvertex"] = df.loc[:,vertex_outcol]
-    df  = calc_distance_column(df, 'tvertex', 'pvertex', 'distance', 150, surfL, surfR)
-
-    ## return the df
-    return df, max_distance, distance_outcol, iter_num
+        max_distance = record['max_distance']
+        logger.info('Iteration {} \tmax distance: {}\tVertices Moved: {}'.format(iter_num, max_distance, record['vertices_moved']))
+        if record['oscillating']:
+            logger.debug('Iteration {} \tOscillating rois: {}'.format(iter_num,
+                                                        record['oscillating_rois']))
+
+    if trace.stop_reason in ('oscillating', 'plateau'):
+        logger.info('Stopped after {} iterations ({})'.format(state.iter_num, trace.stop_reason))
+
+    ## move the sampling rois to the final vertices (for the meants outputs)
+    if sampling_rois is None:
+        sampling_rois = BilateralRois(state, settings.sampling_radius,
+                                      surfL, surfR, func_zeros)
+        state.sampling_labels['tvertex'] = sampling_rois.labels.copy()
+    else:
+        sampling_rois.update(state.rois['vertex'])
+    state.sampling_labels['pvertex'] = sampling_rois.labels.copy()
+    return max_distance
 
 def main():
     arguments  = docopt(__doc__)
     verbose      = arguments['--verbose']
     debug        = arguments['--debug']
     output_prefix = arguments['<outputprefix>']
+    if arguments['--batch']:
+        output_prefix = os.path.join(arguments['<outputdir>'], 'PINT_batch')
+    if arguments['--sweep']:
+        output_prefix = os.path.join(arguments['<outputdir>'], 'PINT_sweep')
 
     ch = logging.StreamHandler()
     ch.setLevel(logging.WARNING)
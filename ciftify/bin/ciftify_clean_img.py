@@ -5,12 +5,16 @@ to user settings. Optional smoothing can also be added
 
 Usage:
     ciftify_clean_img [options] <func_input>
+    ciftify_clean_img [options] --batch-manifest=<tsv>
 
 Options:
   --output-file=<filename>  Path to output cleaned image
                             (default will append _clean to input)
   --clean-config=<json>     A json file to override/specify all cleaning settings
   --drop-dummy-TRs=<int>    Discard the indicated number of TR's from the begginning before
+  --drop-trailing-TRs=<int> Discard the indicated number of TR's from the end
+  --segment-length=<int>    Clean the kept TR's in separate segments of this many TR's
+                            (see details)
   --no-cleaning             No filtering, detrending or confound regression steps
   --detrend                 If detrending should be not applied to timeseries
   --standardize             If indicated, returned signals not are set to unit variance.
@@ -22,21 +26,101 @@ Options:
   --low-pass=<Hz>           Lowpass filter cut-offs
   --high-pass=<Hz>          Highpass filter cut-offs
   --tr=<tr>                Indicate the TR for filtering in seconds (default will read from file)
+  --censor-fd=<mm>          Censor TR's with a framewise displacement above this (see details)
+  --censor-dvars=<value>    Censor TR's with a DVARS above this
+  --fd-col=<col>            The framewise displacement column of the confounds
+                            (default framewise_displacement)
+  --dvars-col=<col>         The DVARS column of the confounds (default std_dvars)
+  --interpolation=<method>  How censored TR's are interpolated before filtering,
+                            cubic or lombscargle (default cubic)
+  --drop-censored-TRs       Drop the censored TR's from the output
+  --profile                 Record the time and memory use of each stage (see details)
+  --cache-dir=<dir>         Reuse (and store) cleaned outputs in this result cache (see details)
+  --chunk-size=<int>        Clean the data this many greyordinates (or voxels) at a time
+                            to limit memory use (see details)
   --smooth-fwhm=<FWHM>      The full width half max of the smoothing kernel if desired
   --left-surface=<gii>      Left surface file (required for smoothing)
   --right-surface=<GII>     Right surface file (required for smoothing)
+  --batch-manifest=<tsv>    Clean all the runs listed in this tsv (see details)
+  --n_cpus INT              Number of processes to clean batch runs in parallel
 
   -v,--verbose              Verbose logging
   --debug                   Debug logging
   -h, --help                Prints this message
 
 DETAILS:
-
-
+CIFTI (dtseries) inputs are cleaned in memory as a timepoints x greyordinates
+matrix (with nilearn.signal.clean) and written straight to the output dtseries,
+with the TR and the start time of the first kept TR. When smoothing, each brain
+structure is cleaned and then smoothed (the surfaces with a geodesic gaussian,
+the subcortical structures with a volume gaussian, as wb_command -cifti-smoothing
+does) in memory, so the output is only written once.
+
+The TR's kept (after --drop-dummy-TRs and --drop-trailing-TRs) are read as a
+slice of the input, without loading or copying the whole run first. With
+--segment-length, the kept TR's are split into consecutive segments (the last
+one may be shorter, a last TR on its own is added to the segment before) that are each cleaned (and smoothed) on their own and
+written to the output name with _seg-<n> added (for example
+func_clean_s0_seg-1.dtseries.nii), the json sidecar lists the segments.
+
+With --censor-fd and/or --censor-dvars, the TR's (after dropping dummy TR's)
+whose framewise displacement (or DVARS) in the confounds tsv is above the
+threshold are censored: the detrending, confound regression and standardizing
+are fit to the kept TR's only, and the censored TR's are replaced by a cubic
+spline (or lomb-scargle) interpolation of the kept TR's before filtering
+(Power et al. 2014). The censored TR's are listed in the json sidecar and, with
+--drop-censored-TRs, left out of the output. Censored runs are cleaned by
+ciftify.cleaning in chunks of --chunk-size (default 20000) greyordinates.
+
+With --cache-dir, each output is stored in a content addressed cache, keyed
+by the hashes of the input, the confounds tsv and the surfaces (if smoothing)
+and by the cleaning settings (not by file names or logging options). A
+request that matches a cached output hardlinks (or copies) it to the output
+instead of cleaning again. Cached outputs are hardlinked, so an existing output
+is removed (not overwritten) before it is cleaned again, and outputs should
+not be modified in place by other tools.
+
+With --profile, the wall time, cpu time (including child processes) and peak
+resident memory of each stage (confounds, load, clean, smooth, write and
+cache) are written to the "profile" entry of the json sidecar. The peak memory
+is the high-water mark of the process at the end of the stage. In batch mode
+the stages are also summed over the runs in the log and in a
+<manifest>_profile.json next to the manifest.
+
+With --chunk-size, the data is cleaned (by ciftify.cleaning, with the same steps
+as nilearn) in blocks of greyordinates (or of voxels for nifti inputs). The
+filter and the confound regression are set up once and each block is read
+from the input, cleaned, and written to a temporary file, so that long runs
+can be cleaned without holding several float64 copies in memory. Nifti
+inputs are read in slabs of slices (along the last spatial axis), except
+gzipped (.nii.gz) inputs, which are read once, as reading a slab of a
+gzipped file means decompressing the file up to it. For these only the
+cleaning (not the input data) is kept within the chunk size.
+
+With --batch-manifest, the runs listed in a tab separated manifest are all
+cleaned with the same settings (options and --clean-config, which is read
+once) by a pool of --n_cpus processes. The manifest has a "func" column and,
+optionally, a "confounds" (tsv) and an "output" (file) column, empty cells
+meaning no confounds (--confounds-tsv is not used) or the default output name. Batch runs are cleaned by
+ciftify.cleaning in chunks of --chunk-size (default 20000) greyordinates, and
+the butterworth filter of each TR is designed once per process. Each run
+writes its own json sidecar, with a "batch" entry for its status; a run
+that fails is logged and the other runs carry on (the exit status is 1 if
+any run failed).
+
+Nifti outputs are gzipped at the zlib level given by the CIFTIFY_COMPRESSION_LEVEL
+environment variable, using CIFTIFY_COMPRESSION_THREADS threads (default 1).
 
 """
 import os
 import sys
+import copy
+import shutil
+import contextlib
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
 import pandas as pd
 import json
 import yaml
@@ -44,20 +128,31 @@ import logging
 from docopt import docopt
 
 import ciftify.niio
+import ciftify.smoothing
+import ciftify.cleaning
 from ciftify.meants import NibInput
 import ciftify.utils
 import nilearn.image
+import nilearn.signal
 
 import nibabel as nib
 
 logger = logging.getLogger('ciftify')
 logger.setLevel(logging.DEBUG)
 
+## the greyordinates (or voxels) cleaned at a time in batch and censored runs
+DEFAULT_CHUNK_SIZE = 20000
+
+## part of every result cache key, increase it when the cleaning results change
+CACHE_VERSION = 1
+
 class UserSettings(object):
     def __init__(self, arguments):
         self.args = self.__update_clean_config(arguments)
         self.func = self.__get_input_file(self.args['<func_input>'])
         self.start_from_tr = self.__get_dummy_trs(self.args['--drop-dummy-TRs'])
+        self.drop_trailing_trs = self.__get_dummy_trs(self.args['--drop-trailing-TRs'])
+        self.segment_length = self.__get_segment_length(self.args['--segment-length'])
         self.cf_cols = self.__split_list_arg(self.args['--cf-cols'])
         self.cf_sq_cols = self.__split_list_arg(self.args['--cf-sq-cols'])
         self.cf_td_cols = self.__split_list_arg(self.args['--cf-td-cols'])
@@ -68,20 +163,16 @@ class UserSettings(object):
         self.high_pass = self.__parse_bandpass_filter_flag(self.args['--high-pass'])
         self.low_pass = self.__parse_bandpass_filter_flag(self.args['--low-pass'])
         self.func.tr = self.__get_tr(self.args['--tr'])
+        self.censor = self.__get_censoring(self.args)
+        self.chunk_size = self.__get_chunk_size(self.args['--chunk-size'])
         self.smooth = Smoothing(self.args['--smooth-fwhm'], self.func.type, self.args['--left-surface'], self.args['--right-surface'])
         self.output_func, self.output_json = self.__get_output_file(self.args['--output-file'])
+        self.cache_dir = self.args['--cache-dir']
+        self.profile = ciftify.utils.StageProfiler() if self.args['--profile'] else None
 
     def __update_clean_config(self, user_args):
         '''merge a json config, if specified into the user_args dict'''
-        if not user_args['--clean-config']:
-            return user_args
-        try:
-            user_config = load_json_file(user_args['--clean-config'])
-        except:
-            logger.critical("Could not load the json config file")
-            sys.exit(1)
-        clean_config = merge(user_args, user_config)
-        return clean_config
+        return update_clean_config(user_args)
 
     def __get_input_file(self, user_func_input):
         '''check that input is readable and either cifti or nifti'''
@@ -101,6 +192,16 @@ class UserSettings(object):
         else:
             return 0
 
+    def __get_segment_length(self, segment_length_arg):
+        '''the number of TR's in each segment (None to clean the run at once)'''
+        if not segment_length_arg:
+            return None
+        segment_length = int(segment_length_arg)
+        if segment_length < 2:
+            logger.error("--segment-length must be at least 2 TR's, {} given".format(segment_length))
+            sys.exit(1)
+        return segment_length
+
     def __split_list_arg(self, list_arg):
         '''split list arguments that were comma separated into lists'''
         if list_arg:
@@ -121,7 +222,7 @@ class UserSettings(object):
         except:
             logger.critical("Failed to read confounds tsv {}".format(args['--confounds-tsv']))
             sys.exit(1)
-        for args_cols_list in [self.cf_cols, self.cf_sq_cols, self.cf_sq_cols, self.cf_sqtd_cols]:
+        for args_cols_list in [self.cf_cols, self.cf_sq_cols, self.cf_td_cols, self.cf_sqtd_cols]:
             for colname_arg in args_cols_list:
                 if colname_arg not in confounddf.columns:
                     logger.error('Indicated column {} not in confounds'.format(colname_arg))
@@ -145,6 +246,26 @@ class UserSettings(object):
             logger.warning("TR should be specified in seconds, improbable value {} given".format(tr))
         return tr
 
+    def __get_censoring(self, args):
+        '''the Censoring of the fd and dvars thresholds (None if neither is given)'''
+        if not any((args['--censor-fd'], args['--censor-dvars'])):
+            return None
+        return Censoring(args, self.confounds)
+
+    def __get_chunk_size(self, chunk_size_arg):
+        '''the number of greyordinates to clean at a time (None for all at once)'''
+        if not chunk_size_arg:
+            return DEFAULT_CHUNK_SIZE if self.censor else None
+        try:
+            chunk_size = int(chunk_size_arg)
+        except ValueError:
+            logger.error("--chunk-size must be an integer, {} given".format(chunk_size_arg))
+            sys.exit(1)
+        if chunk_size < 1:
+            logger.error("--chunk-size must be positive, {} given".format(chunk_size))
+            sys.exit(1)
+        return chunk_size
+
     def __parse_bandpass_filter_flag(self, user_arg):
         '''import the bandpass filtering argument as float value or None'''
         if not user_arg:
@@ -183,6 +304,39 @@ class UserSettings(object):
             json.dump(self.args, fp, indent=4)
         logger.info(yaml.dump(self.args, default_flow_style=False))
 
+    def segments(self):
+        '''
+        copies of the settings for each segment of --segment-length TR's (with
+        their own dropped TR's and outputs), or just these settings, a last
+        segment of one TR (too short to clean) is merged into the one before
+        '''
+        if not self.segment_length:
+            return [self]
+        window = tr_window(self, func_n_timepoints(self.func))
+        out_type, outbase = ciftify.niio.determine_filetype(self.output_func)
+        output_ext = output_extension(self.output_func)
+        starts = list(range(window.start, window.stop, self.segment_length))
+        if len(starts) > 1 and window.stop - starts[-1] < 2:
+            starts.pop()
+        stops = starts[1:] + [window.stop]
+        segments = []
+        for number, (start, stop) in enumerate(zip(starts, stops), 1):
+            segment = copy.copy(self)
+            segment.start_from_tr = start
+            segment.drop_trailing_trs = window.stop + self.drop_trailing_trs - stop
+            segment.segment_length = None
+            segment.output_func = os.path.join(os.path.dirname(self.output_func),
+                    '{}_seg-{}{}'.format(outbase, number, output_ext))
+            segments.append(segment)
+        return segments
+
+    def update_sidecar(self, key, value):
+        '''add (or replace) an entry of the json sidecar written by print_settings'''
+        sidecar = load_json_file(self.output_json)
+        sidecar[key] = value
+        with open(self.output_json, 'w') as fp:
+            json.dump(sidecar, fp, indent=4)
+
 class Smoothing(object):
     '''
     a class holding smoothing as both FWHM and Sigma value
@@ -211,74 +365,484 @@ class Smoothing(object):
                         logger.error("For cifti smoothing, --left-surface and --right-surface inputs are required! Exiting")
                         sys.exit(1)
 
+class Censoring(object):
+    '''
+    a class holding the censoring (scrubbing) of TR's with a high framewise
+    displacement and/or DVARS (read from the confounds)
+    will be nested inside the settings
+    '''
+    def __init__(self, args, confounds):
+        self.fd_threshold = self.__parse_threshold(args['--censor-fd'], '--censor-fd')
+        self.dvars_threshold = self.__parse_threshold(args['--censor-dvars'], '--censor-dvars')
+        self.fd_col = args['--fd-col'] or 'framewise_displacement'
+        self.dvars_col = args['--dvars-col'] or 'std_dvars'
+        self.interpolation = args['--interpolation'] or 'cubic'
+        self.drop = bool(args['--drop-censored-TRs'])
+        if confounds is None:
+            logger.error("Censoring requires a --confounds-tsv with the fd or dvars column")
+            sys.exit(1)
+        for colname, threshold in ((self.fd_col, self.fd_threshold),
+                                   (self.dvars_col, self.dvars_threshold)):
+            if threshold is not None and colname not in confounds.columns:
+                logger.error('Censoring column {} not in confounds'.format(colname))
+                sys.exit(1)
+        if self.interpolation not in ciftify.cleaning.INTERPOLATIONS:
+            logger.error("--interpolation must be one of {}, {} given".format(
+                ', '.join(ciftify.cleaning.INTERPOLATIONS), self.interpolation))
+            sys.exit(1)
+        self.confounds = confounds
+
+    def __parse_threshold(self, threshold_arg, option):
+        if not threshold_arg:
+            return None
+        try:
+            return float(threshold_arg)
+        except ValueError:
+            logger.error("Unable to parse {} {}".format(option, threshold_arg))
+            sys.exit(1)
+
+    def censored(self, window):
+        '''a boolean array, True for the censored TR's of the window (a slice)'''
+        censored = np.zeros(len(self.confounds), dtype = bool)
+        for colname, threshold in ((self.fd_col, self.fd_threshold),
+                                   (self.dvars_col, self.dvars_threshold)):
+            if threshold is not None:
+                ## missing values (the first TR) are not censored
+                censored |= (self.confounds[colname].values > threshold)
+        return censored[window]
+
 def load_json_file(filepath):
     '''just loads the json'''
     with open(filepath, 'r') as f:
         data = json.load(f)
     return data
 
+def update_clean_config(user_args):
+    '''merge a json config, if specified into the user_args dict'''
+    if not user_args['--clean-config']:
+        return user_args
+    try:
+        user_config = load_json_file(user_args['--clean-config'])
+    except:
+        logger.critical("Could not load the json config file")
+        sys.exit(1)
+    clean_config = merge(user_args, user_config)
+    return clean_config
+
 def run_ciftify_clean_img(arguments,tmpdir):
 
     settings = UserSettings(arguments)
     settings.print_settings()
+    clean_func(settings, tmpdir)
+
+def read_batch_manifest(manifest_tsv):
+    '''
+    reads the (func, confounds, output) of each run from a batch manifest,
+    missing confounds or output are None
+    '''
+    try:
+        manifest = pd.read_csv(manifest_tsv, sep='\t', dtype = str)
+    except:
+        logger.critical("Failed to read batch manifest {}".format(manifest_tsv))
+        sys.exit(1)
+    if 'func' not in manifest.columns:
+        logger.critical('The batch manifest {} needs a "func" column'.format(manifest_tsv))
+        sys.exit(1)
+    for column in ('confounds', 'output'):
+        if column not in manifest.columns:
+            manifest[column] = None
+    manifest = manifest.loc[:, ['func', 'confounds', 'output']]
+    return [tuple(None if pd.isnull(value) else value for value in row)
+            for row in manifest.itertuples(index = False)]
+
+def batch_run_arguments(arguments, func, confounds, output):
+    '''the arguments of one batch run (the clean config is already merged in)'''
+    run_arguments = dict(arguments)
+    run_arguments.update({'<func_input>': func,
+                          '--confounds-tsv': confounds,
+                          '--output-file': output,
+                          '--clean-config': None,
+                          '--batch-manifest': None})
+    if not run_arguments['--chunk-size']:
+        run_arguments['--chunk-size'] = str(DEFAULT_CHUNK_SIZE)
+    return run_arguments
+
+def clean_batch_run(run_arguments):
+    '''
+    clean one run of a batch, any error (or exit) is logged and returned
+    in the run's status instead of stopping the batch
+    '''
+    status = {'func': run_arguments['<func_input>'], 'output': None,
+              'status': 'failed', 'error': None}
+    settings = None
+    try:
+        with ciftify.utils.TempDir() as tmpdir:
+            settings = UserSettings(run_arguments)
+            status['output'] = settings.output_func
+            settings.print_settings()
+            clean_func(settings, tmpdir)
+        status['status'] = 'succeeded'
+    except (Exception, SystemExit) as err:
+        status['error'] = '{}: {}'.format(type(err).__name__, err)
+        logger.error('Cleaning {} failed with {}'.format(status['func'], status['error']))
+    if settings is not None and os.path.exists(settings.output_json):
+        settings.update_sidecar('batch', status)
+    if settings is not None and settings.profile:
+        status['profile'] = settings.profile.as_dict()
+    return status
+
+def run_batch(arguments):
+    '''
+    clean every run of the batch manifest with the same settings in a pool of
+    n_cpus processes, returns 1 if any run failed
+    '''
+    arguments = update_clean_config(arguments)
+    runs = read_batch_manifest(arguments['--batch-manifest'])
+    jobs = [batch_run_arguments(arguments, *run) for run in runs]
+    n_cpus = min(int(ciftify.utils.get_number_cpus(arguments['--n_cpus'])), len(jobs))
+    logger.info('Cleaning {} runs with {} processes'.format(len(jobs), n_cpus))
+    if n_cpus < 2:
+        results = [clean_batch_run(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(n_cpus) as pool:
+            results = pool.map(clean_batch_run, jobs, chunksize = 1)
+    failed = [result for result in results if result['status'] != 'succeeded']
+    logger.info('{} of {} runs were cleaned'.format(len(results) - len(failed), len(results)))
+    for result in failed:
+        logger.warning('Failed: {} ({})'.format(result['func'], result['error']))
+    if arguments['--profile']:
+        write_batch_profile(arguments['--batch-manifest'], results)
+    return 1 if failed else 0
+
+def write_batch_profile(manifest_tsv, results):
+    '''log the stage profiles summed over the batch runs and write them next to the manifest'''
+    summary = ciftify.utils.summarise_profiles(
+            [result['profile'] for result in results if 'profile' in result])
+    for name, stage in summary.items():
+        logger.info('{}: {} s wall, {} s cpu (total over {} runs), peak RSS {} MB'.format(
+            name, stage['wall_s'], stage['cpu_s'], stage['runs'], stage['peak_rss_mb']))
+    profile_json = '{}_profile.json'.format(os.path.splitext(manifest_tsv)[0])
+    try:
+        with open(profile_json, 'w') as fp:
+            json.dump({'stages': summary, 'runs': results}, fp, indent=4)
+    except OSError as err:
+        logger.warning('Could not write the batch profile {}: {}'.format(profile_json, err))
+
+def tr_window(settings, n_timepoints):
+    '''the slice of the TR's kept (by the settings) of a run of n_timepoints'''
+    stop = n_timepoints - settings.drop_trailing_trs
+    if stop - settings.start_from_tr < 2:
+        logger.critical("Fewer than 2 of {} TR's are kept after dropping {} dummy and "
+            "{} trailing TR's".format(n_timepoints, settings.start_from_tr,
+                                      settings.drop_trailing_trs))
+        sys.exit(1)
+    return slice(settings.start_from_tr, stop)
+
+@functools.lru_cache(maxsize = 64)
+def input_hash(path, mtime, size):
+    '''the hash of an input file (cached while its modification time and size are unchanged)'''
+    return ciftify.utils.file_hash(path)
+
+def hash_input(path):
+    '''the hash of an input file, None if there is no file'''
+    if not path:
+        return None
+    stat = os.stat(path)
+    return input_hash(os.path.abspath(path), stat.st_mtime, stat.st_size)
 
+def normalised_settings(settings):
+    '''
+    the settings that determine the cleaned output (parsed, so that config and
+    command line values compare equal), for the result cache key
+    '''
+    censor = None
+    if settings.censor:
+        censor = {'fd_col': settings.censor.fd_col,
+                  'fd_threshold': settings.censor.fd_threshold,
+                  'dvars_col': settings.censor.dvars_col,
+                  'dvars_threshold': settings.censor.dvars_threshold,
+                  'interpolation': settings.censor.interpolation,
+                  'drop': settings.censor.drop}
+    return {'func_type': settings.func.type,
+            'tr': settings.func.tr,
+            'start_from_tr': settings.start_from_tr,
+            'drop_trailing_trs': settings.drop_trailing_trs,
+            'cf_cols': settings.cf_cols,
+            'cf_sq_cols': settings.cf_sq_cols,
+            'cf_td_cols': settings.cf_td_cols,
+            'cf_sqtd_cols': settings.cf_sqtd_cols,
+            'detrend': bool(settings.detrend),
+            'standardize': bool(settings.standardize),
+            'high_pass': settings.high_pass,
+            'low_pass': settings.low_pass,
+            'censor': censor,
+            'chunked': bool(settings.chunk_size),
+            'smooth_fwhm': settings.smooth.fwhm,
+            'output_ext': output_extension(settings.output_func)}
+
+def output_extension(output_file):
+    '''the extension of an output (i.e. .dtseries.nii or .nii.gz)'''
+    out_type, outbase = ciftify.niio.determine_filetype(output_file)
+    return os.path.basename(output_file)[len(outbase):]
+
+def cache_key(settings):
+    '''the result cache key of the output of the settings'''
+    key = {'version': CACHE_VERSION,
+           'func': hash_input(settings.func.path),
+           'confounds': hash_input(settings.args['--confounds-tsv']),
+           'settings': normalised_settings(settings)}
+    if settings.smooth.fwhm > 0:
+        key['surfaces'] = [hash_input(settings.smooth.left_surface),
+                           hash_input(settings.smooth.right_surface)]
+    return hashlib.sha1(json.dumps(key, sort_keys = True).encode()).hexdigest()
+
+def cached_output_file(settings):
+    '''the result cache entry of the output of the settings'''
+    return os.path.join(settings.cache_dir, '{}{}'.format(cache_key(settings),
+                        output_extension(settings.output_func)))
+
+def link_or_copy(src, dst):
+    '''hardlink src to dst (replacing dst), copying it if it can not be linked'''
+    tmp_dst = '{}.{}.tmp'.format(dst, os.getpid())
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+def restore_cached_output(settings):
+    '''link the cached output of the settings to the output, False if there is none'''
+    cached_output = cached_output_file(settings)
+    if not os.path.exists(cached_output):
+        return False
+    logger.info('Reusing the cached output {}'.format(cached_output))
+    link_or_copy(cached_output, settings.output_func)
+    return True
+
+def unlink_output(output_file):
+    '''
+    remove an existing output before it is written again, so that writing it
+    does not truncate a result cache entry that it is hardlinked to
+    '''
+    if os.path.lexists(output_file):
+        os.remove(output_file)
+
+def store_cached_output(settings):
+    '''add the output of the settings to the result cache'''
+    ciftify.utils.make_dir(settings.cache_dir, suppress_exists_error = True)
+    try:
+        link_or_copy(settings.output_func, cached_output_file(settings))
+    except OSError as err:
+        logger.warning('Could not add {} to the result cache: {}'.format(
+                       settings.output_func, err))
+
+def func_n_timepoints(func):
+    '''the number of timepoints of a cifti or nifti input (read from its header)'''
+    func_shape = nib.load(func.path).shape
+    return func_shape[0] if func.type == "cifti" else func_shape[3]
+
+def clean_func(settings, tmpdir):
+    '''clean (and smooth) the input of the settings into its output (or segments)'''
+    segments = settings.segments()
+    if settings.segment_length:
+        n_timepoints = func_n_timepoints(settings.func)
+        settings.update_sidecar('segments', [{'output': segment.output_func,
+                'first_TR': segment.start_from_tr,
+                'last_TR': n_timepoints - segment.drop_trailing_trs - 1}
+                for segment in segments])
+    if settings.censor:
+        window = tr_window(settings, func_n_timepoints(settings.func))
+        censored = np.flatnonzero(settings.censor.censored(window)) + window.start
+        logger.info("Censoring {} TR's".format(len(censored)))
+        settings.update_sidecar('censored_TRs', [int(tr) for tr in censored])
+    for segment in segments:
+        if settings.cache_dir:
+            with profile_stage(settings, 'cache'):
+                if restore_cached_output(segment):
+                    continue
+        unlink_output(segment.output_func)
+        clean_tr_window(segment, tmpdir)
+        if settings.cache_dir:
+            with profile_stage(settings, 'cache'):
+                store_cached_output(segment)
+    if settings.profile:
+        settings.update_sidecar('profile', settings.profile.as_dict())
+
+def profile_stage(settings, name):
+    '''time a stage of the cleaning if --profile was given (a no-op otherwise)'''
+    if settings.profile is None:
+        return contextlib.nullcontext()
+    return settings.profile.stage(name)
+
+def clean_tr_window(settings, tmpdir):
+    '''clean (and smooth) the kept TR's of the input of the settings into its output'''
     # check the confounds define the true confounds for nilearn
-    confound_signals = mangle_confounds(settings)
+    with profile_stage(settings, 'confounds'):
+        confound_signals = mangle_confounds(settings)
 
-    # if input is cifti - we convert to fake nifti
-    ## convert to nifti
+    # if input is cifti - clean the greyordinates x time matrix directly
     if settings.func.type == "cifti":
-        input_nifti = os.path.join(tmpdir,'func_fnifti.nii.gz')
-        ciftify.utils.run(['wb_command','-cifti-convert','-to-nifti',settings.func.path, input_nifti])
-    else:
-        input_nifti = settings.func.path
+        clean_cifti(settings, confound_signals, tmpdir)
+        return
 
     # load image as nilearn image
-    nib_image = nilearn.image.load_img(input_nifti)
+    nib_image = nilearn.image.load_img(settings.func.path)
 
-    if settings.start_from_tr > 0:
-        trimmed_nifti = image_drop_dummy_trs(nib_image, settings.start_from_tr)
+    if use_signal_cleaner(confound_signals, settings):
+        with profile_stage(settings, 'clean'):
+            clean_output = clean_nifti_in_chunks(nib_image, confound_signals,
+                                                 settings, tmpdir)
     else:
-        trimmed_nifti = nib_image
+        with profile_stage(settings, 'load'):
+            trimmed_nifti = image_tr_window(nib_image,
+                                            tr_window(settings, nib_image.shape[3]))
 
-    # the nilearn cleaning step..
-    clean_output = clean_image_with_nilearn(trimmed_nifti, confound_signals, settings)
+        # the nilearn cleaning step..
+        with profile_stage(settings, 'clean'):
+            clean_output = clean_image_with_nilearn(trimmed_nifti, confound_signals, settings)
 
     # or nilearn image smooth if nifti input
-    if settings.func.type == "nifti":
-        if settings.smooth.fwhm > 0 :
-            smoothed_vol = nilearn.image.smooth_img(clean_output, settings.smooth.fwhm)
-            smoothed_vol.to_filename(settings.output_func)
-        else:
-            clean_output.to_filename(settings.output_func)
+    if settings.smooth.fwhm > 0 :
+        with profile_stage(settings, 'smooth'):
+            clean_output = nilearn.image.smooth_img(clean_output, settings.smooth.fwhm)
+    with profile_stage(settings, 'write'):
+        ciftify.niio.save_nifti(clean_output, settings.output_func)
 
-    # if input cifti - convert back to nifti
-    if settings.func.type == "cifti":
-        clean_output_nifti = os.path.join(tmpdir, 'clean_fnifti.nii.gz')
-        clean_output.to_filename(clean_output_nifti)
+def clean_cifti(settings, confound_signals, tmpdir):
+    '''
+    clean the (timepoints x greyordinates) data of a dtseries in memory and
+    write it to the output dtseries (smoothing each structure as it is cleaned
+    if asked for)
+    '''
+    cifti_img = nib.load(settings.func.path)
+    if settings.smooth.fwhm > 0:
+        clean_data = clean_and_smooth_cifti_data(cifti_img, confound_signals,
+                                                 settings, tmpdir)
+    elif use_signal_cleaner(confound_signals, settings):
+        with profile_stage(settings, 'clean'):
+            clean_data = clean_data_in_chunks(cifti_img.dataobj, confound_signals,
+                                              settings, tmpdir)
+    else:
+        window = tr_window(settings, cifti_img.shape[0])
+        with profile_stage(settings, 'load'):
+            func_data = np.asarray(cifti_img.dataobj[window, :], dtype = np.float32)
 
-        if settings.smooth.fwhm > 0:
-            clean_output_cifti = os.path.join(tmpdir, 'cleaned.dtseries.nii')
-        else:
-            clean_output_cifti = settings.output_func
-
-        ## convert back not need a template with the same dimensions as the output
-        ciftify.utils.run(['wb_command','-cifti-convert','-from-nifti',
-            clean_output_nifti,
-            settings.func.path,
-            clean_output_cifti,
-            '-reset-timepoints', str(settings.func.tr),
-            str(settings.start_from_tr)])
-
-        if settings.smooth.fwhm > 0:
-            ciftify.utils.run(['wb_command', '-cifti-smoothing',
-                clean_output_cifti,
-                str(settings.smooth.sigma),
-                str(settings.smooth.sigma),
-                'COLUMN',
-                settings.output_func,
-                '-left-surface', settings.smooth.left_surface,
-                '-right-surface', settings.smooth.right_surface])
+        # the nilearn cleaning step..
+        with profile_stage(settings, 'clean'):
+            clean_data = clean_data_with_nilearn(func_data, confound_signals, settings)
+
+    with profile_stage(settings, 'write'):
+        write_dtseries(clean_data, cifti_img, settings.output_func,
+                       settings.func.tr, settings.start_from_tr)
+
+def clean_and_smooth_cifti_data(cifti_img, confound_signals, settings, tmpdir):
+    '''
+    clean and smooth a dtseries one brain structure at a time (structures are
+    smoothed separately, so each is read, cleaned and smoothed in memory and
+    only the smoothed data is kept), with --chunk-size the output is a memory
+    map in the tmpdir
+    '''
+    window = tr_window(settings, cifti_img.shape[0])
+    n_timepoints = window.stop - window.start
+    index_map = cifti_img.header.get_index_map(1)
+    volume_affine = ciftify.smoothing.cifti_volume_affine(index_map)
+    surfaces = ciftify.smoothing.cifti_surfaces(settings.smooth.left_surface,
+                                                settings.smooth.right_surface)
+    cleaner = None
+    if use_signal_cleaner(confound_signals, settings):
+        with profile_stage(settings, 'clean'):
+            cleaner = signal_cleaner(window, confound_signals, settings)
+        n_timepoints = cleaner.n_output_timepoints
+    if settings.chunk_size:
+        clean_data = np.memmap(os.path.join(tmpdir, 'clean_data.dat'), dtype = np.float32,
+                               mode = 'w+', shape = (n_timepoints, cifti_img.shape[1]))
+    else:
+        clean_data = np.empty((n_timepoints, cifti_img.shape[1]), dtype = np.float32)
+    for brain_model in index_map.brain_models:
+        greyordinates = ciftify.smoothing.brain_model_slice(brain_model)
+        with profile_stage(settings, 'load'):
+            structure_data = np.asarray(cifti_img.dataobj[window, greyordinates],
+                                        dtype = np.float32)
+        with profile_stage(settings, 'clean'):
+            if cleaner:
+                structure_data = cleaner.clean_chunks(structure_data, settings.chunk_size)
+            else:
+                structure_data = clean_data_with_nilearn(structure_data, confound_signals,
+                                                         settings)
+        with profile_stage(settings, 'smooth'):
+            clean_data[:, greyordinates] = ciftify.smoothing.smooth_brain_model_data(
+                    structure_data, brain_model, volume_affine, settings.smooth.sigma,
+                    surfaces)
+    return clean_data
+
+def signal_cleaner(window, confound_signals, settings):
+    '''the ciftify.cleaning.SignalCleaner for the cleaning settings of a TR window'''
+    censoring = {}
+    if settings.censor:
+        censoring = {'sample_mask': ~settings.censor.censored(window),
+                     'interpolation': settings.censor.interpolation,
+                     'drop_censored': settings.censor.drop}
+    return ciftify.cleaning.SignalCleaner(window.stop - window.start, settings.func.tr,
+                confounds = confound_signals.values if confound_signals is not None else None,
+                detrend = settings.detrend,
+                standardize = settings.standardize,
+                low_pass = settings.low_pass,
+                high_pass = settings.high_pass,
+                **censoring)
+
+def clean_data_in_chunks(func_dataobj, confound_signals, settings, tmpdir):
+    '''
+    clean (timepoints x greyordinates) data (read lazily from the array proxy)
+    settings.chunk_size greyordinates at a time into a memory map in the tmpdir
+    '''
+    window = tr_window(settings, func_dataobj.shape[0])
+    cleaner = signal_cleaner(window, confound_signals, settings)
+    clean_data = np.memmap(os.path.join(tmpdir, 'clean_data.dat'), dtype = np.float32,
+                           mode = 'w+', shape = (cleaner.n_output_timepoints,
+                                                 func_dataobj.shape[1]))
+    return cleaner.clean_chunks(func_dataobj, settings.chunk_size,
+                                timepoints = window,
+                                out = clean_data)
+
+def clean_nifti_in_chunks(nib_image, confound_signals, settings, tmpdir):
+    '''
+    clean a 4D nifti image in slabs (along the last spatial axis, which is
+    slowest on disk) of about settings.chunk_size voxels into a memory map in
+    the tmpdir, a gzipped image is read into memory once (as every slab
+    read would decompress it from the start)
+    '''
+    dims = nib_image.shape
+    window = tr_window(settings, dims[3])
+    n_timepoints = window.stop - window.start
+    cleaner = signal_cleaner(window, confound_signals, settings)
+    clean_data = np.memmap(os.path.join(tmpdir, 'clean_data.dat'), dtype = np.float32,
+                           mode = 'w+', shape = dims[:3] + (cleaner.n_output_timepoints,))
+    func_data = nib_image.dataobj
+    if (nib_image.get_filename() or '').endswith('.gz'):
+        func_data = np.asarray(func_data[..., window])
+        window = slice(None)
+    slab_size = max(1, settings.chunk_size // (dims[0] * dims[1]))
+    for start in range(0, dims[2], slab_size):
+        slab = func_data[:, :, start:start + slab_size, window]
+        clean_slab = cleaner.clean(slab.reshape(-1, n_timepoints).T)
+        clean_data[:, :, start:start + slab_size] = clean_slab.T.reshape(
+                slab.shape[:3] + (cleaner.n_output_timepoints,))
+    return nilearn.image.new_img_like(nib_image, clean_data, nib_image.affine,
+                                      copy_header = True)
+
+def write_dtseries(data, template_img, output_file, tr, start):
+    '''
+    write (timepoints x greyordinates) data to a dtseries with the greyordinates
+    of the template cifti image, the given TR and start time (both in seconds,
+    as wb_command -cifti-convert -from-nifti -reset-timepoints)
+    '''
+    series = nib.cifti2.SeriesAxis(start = float(start), step = float(tr),
+                                   size = data.shape[0], unit = 'SECOND')
+    brain_models = template_img.header.get_axis(1)
+    header = nib.cifti2.Cifti2Header.from_axes((series, brain_models))
+    out_img = nib.Cifti2Image(np.asarray(data, dtype = np.float32), header = header)
+    out_img.nifti_header.set_intent('ConnDenseSeries')
+    out_img.to_filename(output_file)
 
 
 def merge(dict_1, dict_2):
@@ -291,44 +855,70 @@ def merge(dict_1, dict_2):
 
 def image_drop_dummy_trs(nib_image, start_from_tr):
     ''' use nilearn to drop the number of trs from the image'''
-    data_out = nib_image.get_data()[:,:,:, start_from_tr:]
+    return image_tr_window(nib_image, slice(start_from_tr, None))
+
+def image_tr_window(nib_image, window):
+    '''
+    the image of a slice of the TR's of a 4D image, only these TR's are read
+    from disk (and an in memory image's data is not copied)
+    '''
+    data_out = nib_image.dataobj[..., window]
     img_out = nilearn.image.new_img_like(nib_image, data_out, nib_image.affine, copy_header = True)
     return img_out
 
 def mangle_confounds(settings):
     '''mangle the confounds according to user settings
     insure that output matches length of func input and NA's are not present..'''
-    # square a column in pandas df['c'] = df['b']**2
-    # or np.square(x) (is faster) pandas.Series.diff for lags
-    # start by removing the tr's
     if settings.confounds is None:
         return None
-    start_tr = settings.start_from_tr
-    df = settings.confounds.iloc[start_tr:, :]
-    # then select the columns of interest
-    outdf = df.loc[:,settings.cf_cols]
-    # then add the squares
-    for colname in settings.cf_sq_cols:
-        outdf.loc[:,'{}_sq'.format(colname)] = df.loc[:,colname]**2
-    # then add the lags
-    for colname in settings.cf_td_cols:
-        outdf.loc[:,'{}_lag'.format(colname)] = df.loc[:,colname].diff().fillna(0)
-    # then add the squares of the lags
-    for colname in settings.cf_sqtd_cols:
-        x = df.loc[:,colname].diff().fillna(0)
-        outdf.loc[:,'{}_sqlag'.format(colname)] = x**2
-    outdf = outdf.fillna(0) # added at the request of Colin
-    return outdf
+    terms = ([(colname, 0, 1) for colname in settings.cf_cols] +
+             [(colname, 0, 2) for colname in settings.cf_sq_cols] +
+             [(colname, 1, 1) for colname in settings.cf_td_cols] +
+             [(colname, 1, 2) for colname in settings.cf_sqtd_cols])
+    # the terms are built from the rows of the kept tr's, NA's are set
+    # to 0 (added at the request of Colin)
+    window = tr_window(settings, len(settings.confounds))
+    design, names = ciftify.cleaning.expand_confounds(settings.confounds, terms,
+                                    start = window.start, stop = window.stop)
+    return pd.DataFrame(design, columns = names,
+                        index = settings.confounds.index[window])
+
+def use_signal_cleaner(confound_signals, settings):
+    '''
+    determine if the data is cleaned in chunks by ciftify.cleaning (always
+    the case for censoring, which nilearn does not interpolate)
+    '''
+    return bool(settings.chunk_size) and (settings.censor is not None or
+                                          cleaning_required(confound_signals, settings))
+
+def cleaning_required(confound_signals, settings):
+    '''determine if any filtering, detrending or confound regression was asked for'''
+    return any((settings.detrend == True,
+                settings.standardize == True,
+                confound_signals is not None,
+                settings.high_pass is not None,
+                settings.low_pass is not None))
+
+def clean_data_with_nilearn(func_data, confound_signals, settings):
+    '''clean (timepoints x greyordinates) data with nilearn.signal.clean()
+    (as nilearn.image.clean_img() would clean the fake nifti)
+    '''
+    if not cleaning_required(confound_signals, settings):
+        return func_data
+    return nilearn.signal.clean(func_data,
+                        detrend=settings.detrend,
+                        standardize=settings.standardize,
+                        confounds=confound_signals.values if confound_signals is not None else None,
+                        low_pass=settings.low_pass,
+                        high_pass=settings.high_pass,
+                        t_r=settings.func.tr,
+                        ensure_finite=False)
 
 def clean_image_with_nilearn(input_img, confound_signals, settings):
     '''clean the image with nilearn.image.clean()
     '''
     # first determiner if cleaning is required
-    if any((settings.detrend == True,
-           settings.standardize == True,
-           confound_signals is not None,
-           settings.high_pass is not None,
-           settings.low_pass is not None)):
+    if cleaning_required(confound_signals, settings):
 
         # the nilearn cleaning step..
         clean_output = nilearn.image.clean_img(input_img,
@@ -365,7 +955,10 @@ def main():
     with ciftify.utils.TempDir() as tmpdir:
         logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
                     os.uname()[1]))
-        ret = run_ciftify_clean_img(arguments, tmpdir)
+        if arguments['--batch-manifest']:
+            ret = run_batch(arguments)
+        else:
+            ret = run_ciftify_clean_img(arguments, tmpdir)
 
     logger.info(ciftify.utils.section_header('Done ciftify_clean_img'))
     sys.exit(ret)
@@ -207,7 +207,7 @@ def run_ciftify_peak_table(tmpdir):
     ## now to run FSL's cluster on the subcortical bits
     cinfo = ciftify.niio.cifti_info(data_file)
     if cinfo['maps_to_volume']:
-        subcortical_vol = os.path.join(tmpdir, 'subcortical.nii.gz')
+        subcortical_vol = ciftify.niio.temp_nifti(tmpdir, 'subcortical')
         run(['wb_command', '-cifti-separate', data_file, 'COLUMN', '-volume-all', subcortical_vol])
         fslcluster_cmd = ['cluster',
             '--in={}'.format(subcortical_vol),
@@ -15,6 +15,11 @@ Options:
   --surfR SURFACE            The right surface to to measure distances on (see details)
   --no-distance-calc         Will not calculate the distance from the template vertex
   --pvertex-col COLNAME      The column [default: pvertex] to read the personlized vertices
+  --n_threads INT            Number of threads reading the summary files [default: 8]
+  --parquet DIR              Also keep the concatenated outputs in this (append-only)
+                             parquet dataset, and only add the new subjects to it
+  --store FILE               Also add the summaries and meants of every subject to
+                             this (HDF5) PINT results store (see details)
   --debug                    Debug logging in Erin's very verbose style
   -n,--dry-run               Dry run
   --help                     Print help
@@ -26,13 +31,34 @@ HCP S1200 Average mid-surface.
 In old versions of PINT (2017 and earlier) the pvertex colname was "ivertex".
 Use the option "--pvertex-col ivertex" to process these files.
 
+Only the columns that are written out are read from the summary files (by a
+pool of --n_threads threads).
+
+With --parquet, summary files of subjects that are already in the parquet
+dataset are not read again, the new subjects (and their distances) are added
+to the dataset as a new file and the concatenated output is written for all
+of the subjects in the dataset. This lets the concatenated output be updated
+as new subjects finish without rebuilding it from scratch. Every update of a
+dataset has to use the same --pvertex-col and --no-distance-calc options (so
+that all of its files have the same columns). This requires the pyarrow package.
+
+With --store, the summary and the tvertex and pvertex meants of every subject
+(found next to its summary file) are added to a PINT results store (see
+ciftify.pint_store) that can be queried for group analysis and read by
+cifti_vis_PINT. Subjects already in the store are not added again, and
+subjects with missing meants (or meants that do not match their summary) are
+logged and skipped. This requires the h5py package.
+
 Written by Erin W Dickie, April 28, 2017
 """
 import os
 import sys
+import uuid
 import logging
 import logging.config
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from docopt import docopt
 
@@ -68,60 +94,182 @@ def main():
                 ciftify.utils.section_header("Starting ciftify_postPINT1_concat")))
     ciftify.utils.log_arguments(arguments)
 
-    ## read all the dfs into a tupley thing
-    all_dfs = (read_process_PINT_summary(f, pvertex_colname) for f in summary_csvs)
-    ## concatenate all the summarycvs
-    concatenated_df = pd.concat(all_dfs, ignore_index=True)
     concat_df_columns = ['subid', 'hemi','NETWORK', 'roiidx','tvertex',pvertex_colname,
                             'dist_49','vertex_48']
+    distance_col = 'std_distance'
+    if not NO_TVERTEX_MM:
+        concat_df_columns.append(distance_col)
+    parquet_dir = arguments['--parquet']
+    if parquet_dir:
+        check_parquet_columns(parquet_dir, concat_df_columns)
+        done_subids = read_parquet_subids(parquet_dir)
+        summary_csvs = [f for f in summary_csvs if summary_subid(f) not in done_subids]
+        logger.info('{} subjects already in {}, reading {} new summaries'.format(
+            len(done_subids), parquet_dir, len(summary_csvs)))
 
-    if NO_TVERTEX_MM:
-        ## if done, write to file
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
-    else:
+    if arguments['--store']:
+        add_to_pint_store(arguments['--store'], arguments['<PINT_summary.csv>'],
+                          pvertex_colname)
+
+    ## read and concatenate all the summarycsvs
+    concatenated_df = read_PINT_summaries(summary_csvs, pvertex_colname,
+                                          int(arguments['--n_threads']))
+
+    if not NO_TVERTEX_MM:
         ## define the surface fo measuring..
-        distance_col = 'std_distance'
         if not surfL:
             surfL = os.path.join(ciftify.config.find_HCP_S1200_GroupAvg(),
                 'S1200.L.midthickness_MSMAll.32k_fs_LR.surf.gii')
             surfR = os.path.join(ciftify.config.find_HCP_S1200_GroupAvg(),
                 'S1200.R.midthickness_MSMAll.32k_fs_LR.surf.gii')
 
-        ## for each roi, calculated the distance from the tvertex to the ivertex
-        concatenated_df[distance_col] = -99.0
-        for roi in concatenated_df.roiidx.unique():
-            hemi = concatenated_df.hemi[concatenated_df.roiidx==roi].unique()[0]
-            orig_vertex = concatenated_df.tvertex[concatenated_df.roiidx==roi].unique()[0]
-            if hemi == "L": surf = surfL
-            if hemi == "R": surf = surfR
-            roi_distances =  ciftify.niio.get_surf_distances(surf, orig_vertex)
-            roi_idx = concatenated_df.loc[concatenated_df.roiidx==roi].index
-            concatenated_df.loc[roi_idx,distance_col] = roi_distances[concatenated_df.loc[roi_idx,pvertex_colname].values]
-
-        ## replace any values where ivertex == tvertex with a 0 (tends to be -1)
-        concatenated_df.loc[concatenated_df.loc[:, pvertex_colname] == concatenated_df.tvertex,distance_col] = 0
-
-        ## write to file
-        concat_df_columns.append(distance_col)
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
+        ## calculate the distance from the tvertex to the pvertex of every row
+        concatenated_df[distance_col] = calc_std_distances(concatenated_df,
+                                            pvertex_colname, surfL, surfR)
+
+    if parquet_dir:
+        append_to_parquet(concatenated_df.loc[:, concat_df_columns], parquet_dir)
+        concatenated_df = pd.read_parquet(parquet_dir, columns = concat_df_columns)
+
+    ## write to file
+    concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
 
     logger.info(ciftify.utils.section_header('Done ciftify_postPINT1_concat'))
 
+def calc_std_distances(concatenated_df, pvertex_colname, surfL, surfR, limit = 100):
+    '''
+    the geodesic distance from the tvertex to the pvertex of every row, measured
+    with one multi-source distance calculation per hemisphere (for all of the
+    template vertices at once), -1 if the distance is over the limit (in mm)
+    '''
+    distances = pd.Series(-99.0, index = concatenated_df.index)
+    for hemi, hemi_df in concatenated_df.groupby('hemi'):
+        surf = surfL if hemi == "L" else surfR
+        hemi_distances = ciftify.geodesic.get_distances_from_sources(surf,
+                                hemi_df.tvertex.values,
+                                hemi_df.loc[:, pvertex_colname].values, limit)
+        hemi_distances[np.isinf(hemi_distances)] = -1
+        distances[hemi_df.index] = hemi_distances
+    return distances
+
+def summary_subid(inputcsv):
+    '''the subid (PINT output prefix) of a PINT summary csv'''
+    return os.path.basename(inputcsv).replace('_summary.csv','')
+
+def summary_dtypes(pvertex_colname):
+    '''
+    the dtypes of the columns read from the PINT summary csvs (NETWORK is
+    left to pandas, as templates may label their networks with strings)
+    '''
+    return {'hemi': str, 'NETWORK': None, 'roiidx': np.int64,
+            'tvertex': np.int64, pvertex_colname: np.int64,
+            'dist_49': np.float64, 'vertex_48': np.int64}
+
 def read_process_PINT_summary(inputcsv, pvertex_colname):
     '''
     reads in one PINT summary csv and does a little cleaning of the result..
     add an extra column that is only the PINT output prefix
     '''
-    thisdf = pd.read_csv(inputcsv)
-    this_subid = os.path.basename(inputcsv)
-    this_subid = this_subid.replace('_summary.csv','')
-    thisdf['subid'] = this_subid
+    dtypes = summary_dtypes(pvertex_colname)
+    thisdf = pd.read_csv(inputcsv, usecols = lambda col: col in dtypes,
+                         dtype = {col: dtype for col, dtype in dtypes.items()
+                                  if dtype is not None})
+    thisdf['subid'] = summary_subid(inputcsv)
     if 'dist_49' not in thisdf.columns:
-        thisdf['dist_49'] = 0
+        thisdf['dist_49'] = 0.0
         thisdf['vertex_48'] = thisdf.loc[:,pvertex_colname]
     output_df = thisdf.loc[:,('subid', 'hemi','NETWORK', 'roiidx','tvertex',pvertex_colname,'dist_49','vertex_48')]
     return(output_df)
 
+def read_PINT_summaries(summary_csvs, pvertex_colname, n_threads = 8):
+    '''
+    reads (with a pool of n_threads threads) and concatenates the PINT
+    summary csvs, in the order given
+    '''
+    if not summary_csvs:
+        return empty_PINT_summary(pvertex_colname)
+    with ThreadPoolExecutor(max_workers = n_threads) as executor:
+        all_dfs = list(executor.map(
+            lambda f: read_process_PINT_summary(f, pvertex_colname), summary_csvs))
+    return pd.concat(all_dfs, ignore_index=True)
+
+def empty_PINT_summary(pvertex_colname):
+    '''an empty dataframe with the columns of read_process_PINT_summary'''
+    dtypes = summary_dtypes(pvertex_colname)
+    empty_df = pd.DataFrame({col: pd.Series(dtype = dtype or object)
+                             for col, dtype in dtypes.items()})
+    empty_df['subid'] = pd.Series(dtype = str)
+    return empty_df.loc[:,('subid', 'hemi','NETWORK', 'roiidx','tvertex',pvertex_colname,'dist_49','vertex_48')]
+
+def add_to_pint_store(store_file, summary_csvs, pvertex_colname = 'pvertex'):
+    '''
+    adds the PINT outputs of the subjects not yet in the store, subjects whose
+    outputs do not match are logged and skipped
+    '''
+    with ciftify.pint_store.PINTStore(store_file, mode = 'a') as store:
+        new_summaries = [f for f in summary_csvs if summary_subid(f) not in store]
+        logger.info('Adding {} subjects to {}'.format(len(new_summaries), store_file))
+        for summary_csv in new_summaries:
+            try:
+                store.add_PINT_outputs(summary_csv.replace('_summary.csv', ''),
+                                       subid = summary_subid(summary_csv),
+                                       pvertex_col = pvertex_colname)
+            except (OSError, ValueError) as err:
+                logger.error('Skipping {}: {}'.format(summary_subid(summary_csv), err))
+
+def check_pyarrow():
+    '''exits if pyarrow (needed to read and write parquet files) is not installed'''
+    try:
+        import pyarrow
+    except ImportError:
+        logger.critical('The --parquet option requires the pyarrow package')
+        sys.exit(1)
+
+def parquet_parts(parquet_dir):
+    '''the files of a parquet dataset (none if it does not exist)'''
+    if not os.path.isdir(parquet_dir):
+        return []
+    return sorted(os.path.join(parquet_dir, f) for f in os.listdir(parquet_dir)
+                  if f.endswith('.parquet'))
+
+def check_parquet_columns(parquet_dir, columns):
+    '''
+    exits if the parquet dataset has other columns than those to be added (i.e.
+    it was written with another --pvertex-col or --no-distance-calc setting)
+    '''
+    check_pyarrow()
+    parts = parquet_parts(parquet_dir)
+    if not parts:
+        return
+    import pyarrow.parquet
+    dataset_columns = pyarrow.parquet.read_schema(parts[0]).names
+    if dataset_columns != columns:
+        logger.critical('The parquet dataset {} has the columns {}, but these runs '
+            'would add the columns {}. Use the same --pvertex-col and '
+            '--no-distance-calc options as the runs that wrote it.'.format(parquet_dir,
+            ', '.join(dataset_columns), ', '.join(columns)))
+        sys.exit(1)
+
+def read_parquet_subids(parquet_dir):
+    '''the subids already in a parquet dataset (none if it does not exist)'''
+    check_pyarrow()
+    if not os.path.isdir(parquet_dir) or not os.listdir(parquet_dir):
+        return set()
+    return set(pd.read_parquet(parquet_dir, columns = ['subid']).subid)
+
+def append_to_parquet(concatenated_df, parquet_dir):
+    '''
+    adds the rows to a parquet dataset as a new file (existing files are never
+    rewritten)
+    '''
+    if concatenated_df.empty:
+        return
+    ciftify.utils.make_dir(parquet_dir, suppress_exists_error = True)
+    part_file = os.path.join(parquet_dir,
+                             'part-{}.parquet'.format(uuid.uuid4().hex))
+    logger.info('Adding {} subjects to {}'.format(
+        concatenated_df.subid.nunique(), parquet_dir))
+    concatenated_df.to_parquet(part_file, index = False)
 
 
 if __name__ == '__main__':
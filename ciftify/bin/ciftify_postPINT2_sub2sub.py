@@ -14,6 +14,9 @@ Options:
   --surfR SURFACE        The right surface to to measure distances on (see details)
   --roiidx INT           Measure distances for only this roi (default will loop over all ROIs)
   --pvertex-col COLNAME  The column [default: pvertex] to read the personlized vertices
+  --condensed            Write the distances as condensed distance matrices (see details)
+  --n_cpus INT           Number of processes to measure ROIs in parallel
+                         (default will read from the OMP_NUM_THREADS environment variable)
   --debug                Debug logging in Erin's very verbose style
   -n,--dry-run           Dry run
   --help                 Print help
@@ -27,6 +30,16 @@ HCP S1200 Average mid-surface.
 
 Will output a csv with four columns. 'subid1', 'subid2', 'roiidx', 'distance'
 
+The distance field of each unique personalized vertex of an roi is calculated
+once (in one multi-source calculation), and gives the distances from every
+subject to all others (searching up to 100 mm from each vertex). Distances
+that cannot be measured, or are more than 100 mm, are -1.
+
+With --condensed, the output is instead a (numpy .npz) file with the arrays
+'subids', 'roiidx' and 'distances'. 'distances' has one row per roi holding the
+upper triangle of its subject by subject distance matrix (in the order of
+scipy.spatial.distance.squareform), NaN for subjects missing that roi.
+
 Written by Erin W Dickie, May 5, 2017
 """
 import random
@@ -34,6 +47,7 @@ import os
 import sys
 import logging
 import logging.config
+import multiprocessing
 
 import pandas as pd
 import numpy as np
@@ -46,6 +60,9 @@ config_path = os.path.join(os.path.dirname(__file__), "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
+## distances further than this (in mm) are not measured (and written as -1)
+MAX_DISTANCE = 100
+
 def main():
     global DEBUG
     global DRYRUN
@@ -79,60 +96,88 @@ def main():
     if roiidx:
         roiidx = int(roiidx)
         if roiidx in vertices_df.loc[:,'roiidx']:
-            result = calc_allroiidx_distances(vertices_df, roiidx, surfL, surfR, pvertex_colname)
+            all_rois = [roiidx]
         else:
             logger.critical("roiidx argument given is not in the concatenated df")
             sys.exit(1)
     else:
         all_rois = vertices_df.roiidx.unique()
-        all_sub2sub = (calc_allroiidx_distances(vertices_df, roi, surfL, surfR, pvertex_colname) for roi in all_rois)
-        result = pd.concat(all_sub2sub, ignore_index=True)
 
-    ### write out the resutls to a csv
+    n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
+    all_distances = calc_sub2sub_distances(vertices_df, all_rois, surfL, surfR,
+                                           pvertex_colname, n_cpus)
+
+    ### write out the resutls
+    if arguments['--condensed']:
+        write_condensed_sub2sub(output_sub2sub, vertices_df.subid.unique(),
+                                all_rois, all_distances)
+        return
+
+    all_sub2sub = (sub2sub_long_df(roi, subids, distances)
+                   for roi, (subids, distances) in zip(all_rois, all_distances))
+    result = pd.concat(all_sub2sub, ignore_index=True)
     result.to_csv(output_sub2sub,
                   columns = ['subid1','subid2','roiidx','distance'],
                   index = False)
 
-def calc_subdistances_distances(roidf, surf, subid, pvertex_colname):
+def calc_sub2sub_distances(vertices_df, rois, surfL, surfR, pvertex_colname, n_cpus = 1):
     '''
-    calculates all distances from one subject to the rest for one roi
-    returns a dataframe with columns: subid1, subid2, roiidx, distances'
+    the subject by subject distance matrix of each roi, measured by a pool of
+    n_cpus processes (one roi at a time) if n_cpus > 1
+    returns a list of (subids, distances) in the order of rois
     '''
-    ## read the subids vertex from the roidf
-    pvertex1 = int(roidf.loc[roidf.loc[:,'subid']==subid, pvertex_colname])
-
-    ## set up a new df
-    thisdf = roidf.rename(columns={'subid': 'subid2', pvertex_colname: 'pvertex2'})
-    thisdf['subid1'] = subid
-    thisdf['pvertex1'] = pvertex1
-
-    ## calculate the distances
-    distances = ciftify.niio.get_surf_distances(surf, pvertex1)
-    thisdf.loc[:,'distance'] =  distances[thisdf.loc[:,'pvertex2'],0]
-    ## set cases were ivertices are the same to distance 0
-    thisdf.loc[thisdf.loc[:,'pvertex2'] == thisdf.loc[:,'pvertex1'],'distance'] = 0
-
-    ## trim and return the result
-    result = thisdf.loc[:,['subid1','subid2','roiidx','distance']]
-    return(result)
-
-def calc_allroiidx_distances(vertices_df, roi, surfL, surfR, pvertex_colname):
+    jobs = [(vertices_df.loc[vertices_df.roiidx==roi,:], roi, surfL, surfR,
+             pvertex_colname) for roi in rois]
+    n_cpus = min(n_cpus, len(jobs))
+    if n_cpus < 2:
+        return [calc_roi_distance_matrix(*job) for job in jobs]
+    with multiprocessing.Pool(n_cpus) as pool:
+        return pool.starmap(calc_roi_distance_matrix, jobs)
+
+def calc_roi_distance_matrix(vertices_df, roi, surfL, surfR, pvertex_colname):
     '''
-    loop over all subjects calculating distances for one roi
+    calculates the distances between the personalized vertices of all subjects
+    for one roi, from one distance field per unique vertex
+    returns the subids and the (subjects x subjects) distance matrix
     '''
+    roidf = vertices_df.loc[vertices_df.roiidx==roi,:]
+
     ## determine the surface for measurment
-    hemi = vertices_df.loc[vertices_df.roiidx==roi,'hemi'].values[0]
+    hemi = roidf.hemi.values[0]
     if hemi == "L": surf = surfL
     if hemi == "R": surf = surfR
 
-    ## subset the dataframe
-    roidf = vertices_df.loc[vertices_df.roiidx==roi,:]
+    distances = ciftify.geodesic.get_pairwise_distances(surf,
+                    roidf.loc[:,pvertex_colname].values, limit = MAX_DISTANCE)
+    distances[np.isinf(distances)] = -1
+    return(roidf.subid.values, distances)
+
+def sub2sub_long_df(roi, subids, distances):
+    '''
+    the distance matrix of one roi as a dataframe with columns:
+    subid1, subid2, roiidx, distance
+    '''
+    num_subs = len(subids)
+    return pd.DataFrame({'subid1': np.repeat(subids, num_subs),
+                         'subid2': np.tile(subids, num_subs),
+                         'roiidx': roi,
+                         'distance': distances.reshape(-1)})
 
-    ## run all the subjects and return into a tupley thing of results
-    all_dfs = (calc_subdistances_distances(roidf, surf, subid, pvertex_colname) for subid in vertices_df.subid.unique())
-    ## concatenate all the results
-    roi_sub2sub = pd.concat(all_dfs, ignore_index=True)
-    return(roi_sub2sub)
+def write_condensed_sub2sub(output_file, subids, rois, all_distances):
+    '''
+    writes the distance matrix of each roi as a row of condensed (upper
+    triangle) distances between all subids, NaN for missing subjects
+    '''
+    rows, cols = np.triu_indices(len(subids), k = 1)
+    condensed = np.full((len(rois), len(rows)), np.nan)
+    for i, (roi_subids, distances) in enumerate(all_distances):
+        positions = pd.Index(subids).get_indexer(roi_subids)
+        full_matrix = np.full((len(subids), len(subids)), np.nan)
+        full_matrix[np.ix_(positions, positions)] = distances
+        condensed[i, :] = full_matrix[rows, cols]
+    with open(output_file, 'wb') as output:
+        np.savez_compressed(output, subids = np.asarray(subids).astype(str),
+                            roiidx = np.asarray(rois), distances = condensed)
 
 
 if __name__ == "__main__":
@@ -44,6 +44,9 @@ timepoints or to limit the calculation to a subsample of the timecourse
 (i.e. only the beggining or end). It expects a text file containing the integer numbers
 TRs to keep (where the first TR=1).
 
+Nifti outputs are gzipped at the zlib level given by the CIFTIFY_COMPRESSION_LEVEL
+environment variable, using CIFTIFY_COMPRESSION_THREADS threads (default 1).
+
 Written by Erin W Dickie
 """
 import os
@@ -158,7 +161,7 @@ def run_ciftify_seed_corr(settings, tempdir):
 
     ## convert to nifti
     if settings.func.type == "cifti":
-        func_fnifti = os.path.join(tempdir,'func.nii.gz')
+        func_fnifti = ciftify.niio.temp_nifti(tempdir, 'func')
         run(['wb_command','-cifti-convert','-to-nifti',settings.func.path, func_fnifti])
         func_data, outA, header, dims = ciftify.niio.load_nifti(func_fnifti)
 
@@ -168,7 +171,7 @@ def run_ciftify_seed_corr(settings, tempdir):
 
     if settings.mask:
         if settings.mask.type == "cifti":
-            mask_fnifti = os.path.join(tempdir,'mask.nii.gz')
+            mask_fnifti = ciftify.niio.temp_nifti(tempdir, 'mask')
             run(['wb_command','-cifti-convert','-to-nifti', settings.mask.path, mask_fnifti])
             mask_data, _, _, _ = ciftify.niio.load_nifti(mask_fnifti)
 
@@ -194,9 +197,11 @@ def run_ciftify_seed_corr(settings, tempdir):
     # create output array
     out = np.zeros([dims[0]*dims[1]*dims[2], 1])
 
-    # look through each time series, calculating r
-    for i in np.arange(len(idx_mask)):
-        out[idx_mask[i]] = np.corrcoef(seed_ts[TRs], func_data[idx_mask[i], TRs])[0][1]
+    # calculate r for each time series in the mask
+    if settings.TR_file:
+        func_data = func_data[:, TRs]
+    out[idx_mask, 0] = ciftify.compute.masked_corr(seed_ts[TRs], func_data,
+                                                   mask = idx_mask)
 
     # create the 3D volume and export
     out = out.reshape([dims[0], dims[1], dims[2], 1])
@@ -205,19 +210,19 @@ def run_ciftify_seed_corr(settings, tempdir):
     ## determine nifti filenames for the next two steps
     if settings.func.type == "nifti":
         if settings.fisher_z:
-            nifti_corr_output = os.path.join(tempdir, 'corr_out.nii.gz')
+            nifti_corr_output = ciftify.niio.temp_nifti(tempdir, 'corr_out')
             nifti_Zcorr_output = '{}.nii.gz'.format(settings.output_prefix)
         else:
            nifti_corr_output = '{}.nii.gz'.format(settings.output_prefix)
     if settings.func.type == "cifti":
-        nifti_corr_output = os.path.join(tempdir, 'corr_out.nii.gz')
+        nifti_corr_output = ciftify.niio.temp_nifti(tempdir, 'corr_out')
         if settings.fisher_z:
-            nifti_Zcorr_output = os.path.join(tempdir, 'corrZ_out.nii.gz')
+            nifti_Zcorr_output = ciftify.niio.temp_nifti(tempdir, 'corrZ_out')
         else:
             nifti_Zcorr_output = nifti_corr_output
 
     # write out nifti
-    out.to_filename(nifti_corr_output)
+    ciftify.niio.save_nifti(out, nifti_corr_output)
 
     # do fisher-z transform on values
     if settings.fisher_z:
@@ -282,7 +282,7 @@ def write_statclust_peaktable(data_file, clusters_dscalar, outputbase,
         ## now to run FSL's cluster on the subcortical bits
         cinfo = ciftify.niio.cifti_info(data_file)
         if cinfo['maps_to_volume']:
-            subcortical_vol = os.path.join(ex_tmpdir, 'subcortical.nii.gz')
+            subcortical_vol = ciftify.niio.temp_nifti(ex_tmpdir, 'subcortical')
             ciftify.utils.run(['wb_command', '-cifti-separate', data_file, 'COLUMN', '-volume-all', subcortical_vol])
             fslcluster_cmd = ['cluster',
                 '--in={}'.format(subcortical_vol),
@@ -535,13 +535,13 @@ def define_func_3D(settings, tmpdir):
 
     if settings.func_ref.mode == "first_vol":
         '''take the fist image (default)'''
-        native_func_3D = os.path.join(tmpdir, "native_func_first.nii.gz")
+        native_func_3D = ciftify.niio.temp_nifti(tmpdir, "native_func_first")
         run(['wb_command', '-volume-math "(x)"', native_func_3D,
                         '-var','x', settings.func_4D, '-subvolume', '1'])
 
     elif settings.func_ref.mode == "median":
         '''take the median over time, if indicated'''
-        native_func_3D = os.path.join(tmpdir, "native_func_median.nii.gz")
+        native_func_3D = ciftify.niio.temp_nifti(tmpdir, "native_func_median")
         run(['wb_command', '-volume-reduce',
             settings.func_4D, 'MEDIAN', native_func_3D])
 
@@ -561,7 +561,7 @@ def calc_sform_differences_via_anat(native_func_3D, settings, tmpdir):
     using nilearn resample to find and intermidiate
     """
     logger.info('---Adjusting for differences between underlying anatomical sforms---')
-    resampled_func_ref = os.path.join(tmpdir, 'func_ref_ranat.nii.gz')
+    resampled_func_ref = ciftify.niio.temp_nifti(tmpdir, 'func_ref_ranat')
     logger.info("Using nilearn to create resampled image {}".format(resampled_func_ref))
     resampled_ref_vol1 = nilearn.image.resample_to_img(
         source_img = native_func_3D,
@@ -604,7 +604,7 @@ def calc_sform_differences(native_func_3D, settings, tmpdir):
     using nilearn resample to find and intermidiate
     """
     logger.info('---Adjusting for differences between underlying sform---')
-    resampled_ref = os.path.join(tmpdir, 'vol_ref_rT1w.nii.gz')
+    resampled_ref = ciftify.niio.temp_nifti(tmpdir, 'vol_ref_rT1w')
     logger.info("Using nilearn to create resampled image {}".format(resampled_ref))
     resampled_ref_vol = nilearn.image.resample_to_img(
         source_img = native_func_3D,
@@ -92,7 +92,7 @@ def run_ciftify_vol_result(settings, tmpdir):
 
     ## if asked to resample the volume...do this step
     if settings.resample:
-        rinput_subcortical = os.path.join(tmpdir, 'input_nii_r.nii.gz')
+        rinput_subcortical = ciftify.niio.temp_nifti(tmpdir, 'input_nii_r')
         if settings.integer_labels:
             resample_method = 'ENCLOSING_VOXEL'
         else:
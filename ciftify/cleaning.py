@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Cleaning (detrending, filtering, confound regression and standardising) of
+(timepoints x signals) data, a block of signals at a time.
+
+The steps, and their order, are those of nilearn.signal.clean (as used by
+ciftify_clean_img): linear detrending of the signals and the confounds,
+butterworth filtering of both, projecting the signals onto the orthogonal
+complement of the (z-scored) confounds and z-scoring the signals. Censored
+(scrubbed) timepoints are left out of the fits and interpolated before the
+filtering (see SignalCleaner). Everything
+that depends only on the timepoints (the filter coefficients and the
+confound projector) is computed once by a SignalCleaner, so long runs can be
+streamed through it in blocks of greyordinates with bounded memory. The
+filter designs and linear trends are also cached (per process), so cleaning
+many runs with the same TR and length designs each of them only once.
+"""
+
+import logging
+import functools
+
+import numpy as np
+from scipy import interpolate, linalg, signal
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize = 32)
+def butterworth_coefficients(t_r, low_pass = None, high_pass = None, order = 5):
+    '''
+    the (b, a) coefficients of the butterworth filter nilearn.signal.butterworth
+    would use, None if no filtering is needed (cached, do not modify them)
+    '''
+    if low_pass is None and high_pass is None:
+        return None
+    if low_pass is not None and high_pass is not None and high_pass >= low_pass:
+        raise ValueError('High pass cutoff frequency ({}) is greater or equal '
+                         'to low pass filter frequency ({})'.format(high_pass, low_pass))
+    nyq = 0.5 / t_r
+    critical_freq = []
+    for btype, freq in [('high', high_pass), ('low', low_pass)]:
+        if freq is None:
+            continue
+        wn = freq / nyq
+        if wn >= 1:
+            wn = 1 - 10 * np.finfo(float).eps
+            logger.warning('The {}-pass cutoff is above the Nyquist frequency '
+                           'and was lowered to it'.format(btype))
+        elif wn <= 0:
+            wn = 10 * np.finfo(float).eps
+        critical_freq.append(wn)
+        filter_type = btype
+    if len(critical_freq) == 2:
+        if critical_freq[0] == critical_freq[1]:
+            logger.warning('The band-pass cutoffs are equal, the signals will '
+                           'not be filtered')
+            return None
+        filter_type = 'band'
+    else:
+        critical_freq = critical_freq[0]
+    return signal.butter(order, critical_freq, btype = filter_type, output = 'ba')
+
+@functools.lru_cache(maxsize = 32)
+def linear_trend(n_timepoints):
+    '''the unit norm, zero mean linear trend of n_timepoints (cached, do not modify it)'''
+    regressor = np.arange(n_timepoints, dtype = np.float64)
+    regressor -= regressor.mean()
+    regressor /= np.sqrt((regressor ** 2).sum())
+    return regressor
+
+def detrend(data, sample_mask = None):
+    '''
+    remove the mean and linear trend of each column of data (in place), fit
+    to the rows in the (boolean) sample_mask only, if given
+    '''
+    if sample_mask is None:
+        data -= data.mean(axis = 0)
+        if data.shape[0] > 1:
+            regressor = linear_trend(data.shape[0])
+            data -= np.outer(regressor, regressor.dot(data))
+        return data
+    regressor = np.arange(data.shape[0], dtype = np.float64)
+    regressor -= regressor[sample_mask].mean()
+    data -= data[sample_mask].mean(axis = 0)
+    norm = (regressor[sample_mask] ** 2).sum()
+    if norm > 0:
+        data -= np.outer(regressor, regressor[sample_mask].dot(data[sample_mask]) / norm)
+    return data
+
+def zscore(data, sample_mask = None):
+    '''
+    z-score each column of data (in place), constant columns are only
+    demeaned, with the mean and std of the rows in the sample_mask, if given
+    '''
+    kept = data if sample_mask is None else data[sample_mask]
+    mean = kept.mean(axis = 0)
+    std = kept.std(axis = 0)
+    std[std < np.finfo(np.float64).eps] = 1.
+    data -= mean
+    data /= std
+    return data
+
+INTERPOLATIONS = ('cubic', 'lombscargle')
+
+def lombscargle_matrix(times, sample_mask, oversampling = 8, max_frequency_factor = 1):
+    '''
+    the (all timepoints x kept timepoints) matrix that reconstructs a signal
+    at all times from the lomb-scargle periodogram of its (demeaned) values at
+    the kept times (Mathias et al. 2004, as used for scrubbing by Power et al.
+    2014), it only depends on the times, so is computed once per run
+    '''
+    kept_times = times[sample_mask]
+    span = kept_times[-1] - kept_times[0]
+    step = 1. / (span * oversampling)
+    frequencies = np.arange(step, max_frequency_factor * len(kept_times) / (2. * span) + step,
+                            step)
+    omega = 2. * np.pi * frequencies
+    tau = np.arctan2(np.sin(2. * np.outer(kept_times, omega)).sum(axis = 0),
+                     np.cos(2. * np.outer(kept_times, omega)).sum(axis = 0)) / (2. * omega)
+    kept_cos = np.cos(omega * (kept_times[:, None] - tau))
+    kept_sin = np.sin(omega * (kept_times[:, None] - tau))
+    all_cos = np.cos(omega * (times[:, None] - tau))
+    all_sin = np.sin(omega * (times[:, None] - tau))
+    return (all_cos / (kept_cos ** 2).sum(axis = 0)).dot(kept_cos.T) + \
+           (all_sin / (kept_sin ** 2).sum(axis = 0)).dot(kept_sin.T)
+
+def interpolate_censored(data, sample_mask, method = 'cubic', times = None,
+                         lombscargle = None):
+    '''
+    replace the censored rows (False in the sample_mask) of data (in place) by
+    interpolating the kept rows, with a cubic spline (censored rows before the
+    first or after the last kept row take its value) or the lomb-scargle
+    reconstruction (scaled to the variance of the kept rows), lombscargle is
+    the (cached) lombscargle_matrix of the times
+    '''
+    if times is None:
+        times = np.arange(data.shape[0], dtype = np.float64)
+    censored = ~sample_mask
+    if not censored.any():
+        return data
+    kept_times = times[sample_mask]
+    kept = data[sample_mask]
+    if method == 'cubic':
+        inside = censored & (times > kept_times[0]) & (times < kept_times[-1])
+        if inside.any():
+            data[inside] = interpolate.CubicSpline(kept_times, kept, axis = 0)(times[inside])
+        data[censored & (times < kept_times[0])] = kept[0]
+        data[censored & (times > kept_times[-1])] = kept[-1]
+        return data
+    if method != 'lombscargle':
+        raise ValueError('Unknown interpolation {}, expected one of {}'.format(
+                         method, ', '.join(INTERPOLATIONS)))
+    if lombscargle is None:
+        lombscargle = lombscargle_matrix(times, sample_mask)
+    mean = kept.mean(axis = 0)
+    reconstructed = lombscargle.dot(kept - mean)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        scale = kept.std(axis = 0) / reconstructed[sample_mask].std(axis = 0)
+    scale[~np.isfinite(scale)] = 0
+    data[censored] = reconstructed[censored] * scale + mean
+    return data
+
+class SignalCleaner(object):
+    '''
+    cleans (timepoints x signals) arrays the way nilearn.signal.clean does,
+    with the filter and the confound projector computed once
+
+    With a sample_mask (False for censored timepoints), the detrending,
+    confound regression and z-scoring are fit to the kept timepoints only,
+    the censored timepoints are interpolated (cubic or lombscargle) before
+    filtering, and dropped from the output if drop_censored.
+
+    filter_ba: the (b, a) butterworth coefficients (None for no filtering)
+    confound_basis: orthonormal (kept timepoints x rank) basis of the
+                    detrended, filtered and z-scored confounds (None for no confounds)
+    confound_weights: the (timepoints x rank) confounds that the coefficients
+                      of the basis are removed with (the basis itself if
+                      there is no censoring)
+    '''
+    def __init__(self, n_timepoints, t_r, confounds = None, detrend = False,
+                 standardize = False, low_pass = None, high_pass = None,
+                 sample_mask = None, interpolation = 'cubic', drop_censored = False):
+        self.n_timepoints = n_timepoints
+        self.detrend = detrend
+        self.standardize = standardize
+        self.filter_ba = butterworth_coefficients(t_r, low_pass, high_pass)
+        self.sample_mask = None
+        self.interpolation = interpolation
+        self.drop_censored = drop_censored
+        self._lombscargle = None
+        if sample_mask is not None and not np.all(sample_mask):
+            self.__set_sample_mask(np.asarray(sample_mask, dtype = bool))
+        self.confound_basis = None
+        self.confound_weights = None
+        if confounds is not None:
+            self.__set_confound_basis(confounds)
+
+    @property
+    def n_output_timepoints(self):
+        '''the number of timepoints of the cleaned arrays'''
+        if self.drop_censored and self.sample_mask is not None:
+            return int(self.sample_mask.sum())
+        return self.n_timepoints
+
+    def __set_sample_mask(self, sample_mask):
+        if sample_mask.shape != (self.n_timepoints,):
+            raise ValueError('The sample mask has {} timepoints, the signals have '
+                             '{}'.format(len(sample_mask), self.n_timepoints))
+        if sample_mask.sum() < 2:
+            raise ValueError('Fewer than 2 timepoints are left after censoring')
+        if self.interpolation not in INTERPOLATIONS:
+            raise ValueError('Unknown interpolation {}, expected one of {}'.format(
+                             self.interpolation, ', '.join(INTERPOLATIONS)))
+        self.sample_mask = sample_mask
+        if self.interpolation == 'lombscargle':
+            self._lombscargle = lombscargle_matrix(
+                    np.arange(self.n_timepoints, dtype = np.float64), sample_mask)
+
+    def __set_confound_basis(self, confounds):
+        confounds = np.array(confounds, dtype = np.float64)
+        if confounds.ndim == 1:
+            confounds = confounds.reshape(-1, 1)
+        if confounds.shape[0] != self.n_timepoints:
+            raise ValueError('Confound signal has an incorrect length, signal '
+                'length: {}, confound length: {}'.format(self.n_timepoints,
+                                                         confounds.shape[0]))
+        if not confounds.shape[1]:
+            return
+        confounds = self.__prepare(confounds)
+        confounds = zscore(confounds, self.sample_mask)
+        kept = confounds if self.sample_mask is None else confounds[self.sample_mask]
+        q, r, pivots = linalg.qr(kept, mode = 'economic', pivoting = True)
+        rank = int((np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100.).sum())
+        self.confound_basis = q[:, :rank]
+        if self.sample_mask is None:
+            self.confound_weights = self.confound_basis
+        else:
+            ## the confounds (at all timepoints) in the coordinates of the basis
+            self.confound_weights = linalg.solve_triangular(r[:rank, :rank],
+                    confounds[:, pivots[:rank]].T, trans = 'T').T
+
+    def __prepare(self, data):
+        '''detrend, interpolate the censored timepoints and filter'''
+        if self.detrend:
+            data = detrend(data, self.sample_mask)
+        if self.sample_mask is not None:
+            data = interpolate_censored(data, self.sample_mask, self.interpolation,
+                                        lombscargle = self._lombscargle)
+        if self.filter_ba is None:
+            return data
+        return signal.filtfilt(self.filter_ba[0], self.filter_ba[1], data, axis = 0)
+
+    def clean(self, signals):
+        '''the cleaned (float64) copy of a (timepoints x signals) array'''
+        signals = self.__prepare(np.array(signals, dtype = np.float64))
+        kept = slice(None) if self.sample_mask is None else self.sample_mask
+        if self.confound_basis is not None:
+            signals -= self.confound_weights.dot(self.confound_basis.T.dot(signals[kept]))
+        if self.standardize:
+            signals = zscore(signals, self.sample_mask)
+        if self.drop_censored and self.sample_mask is not None:
+            return signals[self.sample_mask]
+        return signals
+
+    def clean_chunks(self, data, chunk_size, timepoints = slice(None), out = None):
+        '''
+        clean the timepoints (a slice) of a (timepoints x signals) array, which
+        may be a memory map or a lazy nibabel array proxy, chunk_size signals
+        at a time, into out (a new float32 array if not given)
+        '''
+        n_signals = data.shape[1]
+        if out is None:
+            out = np.empty((self.n_output_timepoints, n_signals), dtype = np.float32)
+        for start in range(0, n_signals, chunk_size):
+            stop = min(start + chunk_size, n_signals)
+            out[:, start:stop] = self.clean(data[timepoints, start:stop])
+        return out
+
+def confound_term_name(column, derivative = 0, power = 1):
+    '''
+    the name of a confound term, as ciftify_clean_img has named them: the
+    column, its square (_sq), its temporal derivative (_lag) and the square of
+    its derivative (_sqlag), with the order appended for higher derivatives
+    and powers (for example x_pow3lag2)
+    '''
+    suffix = ''
+    if power == 2:
+        suffix += 'sq'
+    elif power > 2:
+        suffix += 'pow{}'.format(power)
+    if derivative == 1:
+        suffix += 'lag'
+    elif derivative > 1:
+        suffix += 'lag{}'.format(derivative)
+    return '{}_{}'.format(column, suffix) if suffix else column
+
+def expansion_terms(columns, max_derivative = 1, max_power = 2):
+    '''
+    the (column, derivative, power) terms of every derivative (up to
+    max_derivative) and power (up to max_power) of the columns, ordered by
+    derivative then power (max_derivative 1 and max_power 2 of the 6 motion
+    parameters is the 24 parameter model, of 9 signals the 36 parameter one)
+    '''
+    return [(column, derivative, power)
+            for derivative in range(max_derivative + 1)
+            for power in range(1, max_power + 1)
+            for column in columns]
+
+def expand_confounds(confounds, terms, start = 0, stop = None):
+    '''
+    the design matrix of the (column, derivative, power) terms of the rows
+    start to stop of a confounds dataframe, as a C contiguous (timepoints x
+    terms) float64 array and the list of term names
+
+    derivatives are backward differences taken within the rows start to stop
+    (the first derivative rows are 0) and missing values are set to 0
+    '''
+    terms = [(column, int(derivative), int(power)) for column, derivative, power in terms]
+    names = [confound_term_name(*term) for term in terms]
+    columns = list(dict.fromkeys(term[0] for term in terms))
+    data = confounds.loc[:, columns].iloc[start:stop, :].values.astype(np.float64)
+    n_timepoints = data.shape[0]
+    derivatives = [data]
+    for derivative in range(1, max([term[1] for term in terms] + [0]) + 1):
+        diff = np.zeros_like(data)
+        diff[derivative:] = derivatives[-1][derivative:] - derivatives[-1][derivative - 1:-1]
+        derivatives.append(diff)
+    design = np.empty((n_timepoints, len(terms)), dtype = np.float64)
+    column_index = {column: i for i, column in enumerate(columns)}
+    ## fill the terms one (derivative, power) group at a time
+    groups = {}
+    for i, (column, derivative, power) in enumerate(terms):
+        groups.setdefault((derivative, power), ([], []))
+        groups[(derivative, power)][0].append(i)
+        groups[(derivative, power)][1].append(column_index[column])
+    for (derivative, power), (term_index, data_index) in groups.items():
+        design[:, term_index] = derivatives[derivative][:, data_index] ** power
+    design[np.isnan(design)] = 0
+    return design, names
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+The numerical kernels shared by the ciftify commands (correlation of one
+timeseries with many, partial correlation and roi mean timeseries).
+
+Each kernel has a pure numpy implementation and, if numba is installed, a
+numba JIT compiled one that works row by row without allocating temporaries.
+The backend is chosen at runtime: by set_backend(), else by the
+CIFTIFY_COMPUTE_BACKEND environment variable, else numba if it can be
+imported and numpy otherwise. Both backends give the same results (to
+floating point precision).
+"""
+
+import logging
+
+import numpy as np
+from scipy import sparse
+
+import ciftify.config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numpy', 'numba')
+
+_BACKEND = {}
+
+def available_backends():
+    '''the backends that can be used in this environment'''
+    return [backend for backend in BACKENDS if backend == 'numpy' or numba]
+
+def set_backend(backend = None):
+    '''
+    choose the backend (None picks the CIFTIFY_COMPUTE_BACKEND environment
+    variable, or the fastest available), falls back to numpy if the
+    requested backend is not available
+    '''
+    if backend is None:
+        backend = ciftify.config.find_compute_backend()
+    if backend is None:
+        backend = 'numba' if numba else 'numpy'
+    if backend not in BACKENDS:
+        logger.warning('Unknown compute backend {}, using numpy'.format(backend))
+        backend = 'numpy'
+    if backend not in available_backends():
+        logger.warning('numba is not installed, using the numpy compute backend')
+        backend = 'numpy'
+    _BACKEND['name'] = backend
+    return backend
+
+def get_backend():
+    '''the name of the backend in use'''
+    if 'name' not in _BACKEND:
+        set_backend()
+    return _BACKEND['name']
+
+def _as_mask(mask, n_rows):
+    if mask is None:
+        return np.arange(n_rows)
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return np.flatnonzero(mask)
+    return mask.astype(np.int64)
+
+def masked_corr(x, data, mask = None, backend = None):
+    '''
+    the pearson correlation of the timeseries x with each row of data (only
+    the rows in mask, if given) as a 1D array
+    '''
+    mask = _as_mask(mask, data.shape[0])
+    if (backend or get_backend()) == 'numba':
+        return _numba_masked_corr(np.asarray(x, dtype = np.float64), data, mask)
+    return _numpy_masked_corr(x, data, mask)
+
+def partial_corr(x, data, confounds, mask = None, backend = None):
+    '''
+    the partial correlation of the timeseries x with each row of data (only
+    the rows in mask, if given), after regressing the confounds
+    (timepoints x confounds) from both, as a 1D array
+    '''
+    mask = _as_mask(mask, data.shape[0])
+    basis = _confound_basis(confounds)
+    x_res = _residualise(np.asarray(x, dtype = np.float64), basis)
+    if (backend or get_backend()) == 'numba':
+        return _numba_partial_corr(x_res, data, mask, basis)
+    return _numpy_masked_corr(x_res, _residualise(data[mask, :], basis),
+                              np.arange(len(mask)))
+
+def roi_means(data, labels, rois = None, backend = None):
+    '''
+    the mean timeseries (rows of data) of each roi of a label array (one label
+    per row, 0 is background), returns an (rois x timepoints) array in the
+    order of rois (default all non-zero labels, sorted), NaN for empty rois
+    '''
+    labels = np.asarray(labels).reshape(-1)
+    if rois is None:
+        rois = np.unique(labels)
+        rois = rois[rois != 0]
+    rois = np.asarray(rois)
+    if not rois.size:
+        return np.zeros((0, data.shape[1]))
+    ## the position of each row's roi in rois (-1 if it is not in one)
+    order = np.argsort(rois, kind = 'stable')
+    roi_of_row = order[np.minimum(np.searchsorted(rois, labels, sorter = order),
+                                  len(rois) - 1)]
+    roi_of_row[rois[roi_of_row] != labels] = -1
+    if (backend or get_backend()) == 'numba':
+        return _numba_roi_means(data, roi_of_row, len(rois))
+    rows = np.flatnonzero(roi_of_row >= 0)
+    members = sparse.csr_matrix((np.ones(len(rows)), (roi_of_row[rows], rows)),
+                                shape = (len(rois), data.shape[0]))
+    counts = np.asarray(members.sum(axis = 1)).reshape(-1, 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return members.dot(data) / counts
+
+def _numpy_masked_corr(x, data, mask):
+    x = np.asarray(x, dtype = np.float64)
+    x = x - x.mean()
+    y = np.asarray(data[mask, :], dtype = np.float64)
+    y = y - y.mean(axis = 1, keepdims = True)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return y.dot(x) / np.sqrt(np.sum(y * y, axis = 1) * x.dot(x))
+
+def _confound_basis(confounds):
+    '''an orthonormal basis (timepoints x rank) of the confounds'''
+    confounds = np.asarray(confounds, dtype = np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds.reshape(-1, 1)
+    u, s, _ = np.linalg.svd(confounds, full_matrices = False)
+    if not s.size:
+        return u
+    tol = s.max() * max(confounds.shape) * np.finfo(np.float64).eps
+    return u[:, s > tol]
+
+def _residualise(y, basis):
+    '''the residuals of y (timepoints, or signals x timepoints) after regressing the basis'''
+    return y - y.dot(basis).dot(basis.T)
+
+if numba:
+    ## compiled on first use, error_model numpy gives NaN (not an error) for 0/0
+    _jit = numba.njit(cache = True, error_model = 'numpy')
+
+    @_jit
+    def _numba_corr_row(x, sxx, row):
+        ## x is centred and sxx is its sum of squares
+        n = x.shape[0]
+        mean = 0.0
+        for t in range(n):
+            mean += row[t]
+        mean /= n
+        sxy = 0.0
+        syy = 0.0
+        for t in range(n):
+            y = row[t] - mean
+            sxy += x[t] * y
+            syy += y * y
+        return sxy / np.sqrt(sxx * syy)
+
+    @_jit
+    def _numba_masked_corr(x, data, mask):
+        x = x - x.mean()
+        sxx = np.sum(x * x)
+        out = np.empty(mask.shape[0])
+        row = np.empty(x.shape[0])
+        for k in range(mask.shape[0]):
+            for t in range(x.shape[0]):
+                row[t] = data[mask[k], t]
+            out[k] = _numba_corr_row(x, sxx, row)
+        return out
+
+    @_jit
+    def _numba_partial_corr(x_res, data, mask, basis):
+        n, p = basis.shape
+        x = x_res - x_res.mean()
+        sxx = np.sum(x * x)
+        out = np.empty(mask.shape[0])
+        coefs = np.empty(p)
+        row = np.empty(n)
+        for k in range(mask.shape[0]):
+            for j in range(p):
+                c = 0.0
+                for t in range(n):
+                    c += data[mask[k], t] * basis[t, j]
+                coefs[j] = c
+            for t in range(n):
+                r = data[mask[k], t]
+                for j in range(p):
+                    r -= coefs[j] * basis[t, j]
+                row[t] = r
+            out[k] = _numba_corr_row(x, sxx, row)
+        return out
+
+    @_jit
+    def _numba_roi_means(data, roi_of_row, n_rois):
+        out = np.zeros((n_rois, data.shape[1]))
+        counts = np.zeros(n_rois)
+        for i in range(data.shape[0]):
+            roi = roi_of_row[i]
+            if roi < 0:
+                continue
+            counts[roi] += 1
+            for t in range(data.shape[1]):
+                out[roi, t] += data[i, t]
+        for roi in range(n_rois):
+            for t in range(data.shape[1]):
+                out[roi, t] /= counts[roi]
+        return out
@@ -161,6 +161,43 @@ def find_work_dir():
             work_dir = None
     return work_dir
 
+def find_ciftify_cache():
+    """
+    Returns the directory to use for ciftify's on-disk caches (i.e. the
+    geodesic neighbourhood indices). If the shell variable CIFTIFY_CACHE
+    is set, uses that. Otherwise returns None, and callers fall back to
+    writing alongside their inputs (or to ~/.cache/ciftify).
+    """
+    cache_dir = os.getenv('CIFTIFY_CACHE')
+    return cache_dir
+
+def find_compute_backend():
+    """
+    Returns the name of the compute backend (i.e. 'numpy' or 'numba') given
+    by the shell variable CIFTIFY_COMPUTE_BACKEND, or None if it is not set
+    (then the fastest available backend is used).
+    """
+    backend = os.getenv('CIFTIFY_COMPUTE_BACKEND')
+    return backend
+
+def find_compression_level():
+    """
+    Returns the zlib level (0-9) used to write .nii.gz outputs given by the
+    shell variable CIFTIFY_COMPRESSION_LEVEL, or None if it is not set
+    (then nibabel's default level is used).
+    """
+    level = os.getenv('CIFTIFY_COMPRESSION_LEVEL')
+    return level
+
+def find_compression_threads():
+    """
+    Returns the number of threads used to gzip .nii.gz outputs given by the
+    shell variable CIFTIFY_COMPRESSION_THREADS, or None if it is not set
+    (then outputs are compressed in one thread).
+    """
+    threads = os.getenv('CIFTIFY_COMPRESSION_THREADS')
+    return threads
+
 def wb_command_version():
     '''
     Returns version info about wb_command.
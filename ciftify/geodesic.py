@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+In-process geodesic distance tools for surface meshes.
+
+Distances are measured with Dijkstra's algorithm on a graph of the mesh edges
+plus the "diagonal" paths that cross pairs of adjacent triangles (the same
+construction wb_command -surface-geodesic-distance uses). Neighbourhoods
+(all vertices within a radius of every vertex) are stored as sparse indices and
+cached on disk by surface hash, so that repeated ROI building does not need
+to call wb_command.
+"""
+
+import os
+import glob
+import heapq
+import math
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+
+import ciftify.config
+import ciftify.niio
+import ciftify.utils
+
+logger = logging.getLogger(__name__)
+
+## in memory caches, so that each surface is only read/built once per process
+_SURFACE_GRAPHS = {}
+_NEIGHBOURHOODS = {}
+
+class SurfaceGraph(object):
+    '''
+    The geodesic graph of one surface mesh
+
+    Attributes:
+      coords: the vertex coordinates (n_vertices x 3)
+      triangles: the mesh faces (n_triangles x 3)
+      graph: a symmetric scipy.sparse.csr_matrix of the edge lengths (mm)
+    '''
+    def __init__(self, coords, triangles):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        self.n_vertices = self.coords.shape[0]
+        self.graph = build_mesh_graph(self.coords, self.triangles)
+
+    @classmethod
+    def from_file(cls, surf):
+        '''read the graph from a .surf.gii file'''
+        return cls(ciftify.niio.load_surf_coords(surf),
+                   ciftify.niio.load_surf_triangles(surf))
+
+    def distances(self, sources, limit = np.inf):
+        '''
+        geodesic distances from each of the sources to every vertex
+        returns a (len(sources) x n_vertices) array, np.inf beyond the limit
+        '''
+        sources = np.atleast_1d(np.asarray(sources, dtype=np.int64))
+        return dijkstra(self.graph, directed = True,
+                        indices = sources, limit = float(limit))
+
+    def _adjacency(self):
+        '''the graph (and coordinates) as python lists for the A* search'''
+        if not hasattr(self, '_adjacency_lists'):
+            self._adjacency_lists = (self.graph.indptr.tolist(),
+                                     self.graph.indices.tolist(),
+                                     self.graph.data.tolist(),
+                                     self.coords.tolist())
+        return self._adjacency_lists
+
+    def vertex_distance(self, source, target, limit = np.inf):
+        '''
+        the geodesic distance from source to target (np.inf if it is more than limit)
+
+        Uses an A* search with the straight line distance to the target as the
+        heuristic (every path on the mesh is at least that long), so the search
+        stops as soon as the target is reached, or as soon as no path shorter
+        than limit is possible, instead of solving the whole distance field.
+        '''
+        source, target = int(source), int(target)
+        if source == target:
+            return 0.0
+        indptr, indices, weights, coords = self._adjacency()
+        tx, ty, tz = coords[target]
+        def to_target(v):
+            x, y, z = coords[v]
+            return math.sqrt((x - tx)**2 + (y - ty)**2 + (z - tz)**2)
+        settled = set()
+        best = {source: 0.0}
+        queue = [(to_target(source), 0.0, source)]
+        while queue:
+            estimate, dist, v = heapq.heappop(queue)
+            if estimate > limit:
+                break
+            if v == target:
+                return dist
+            if v in settled:
+                continue
+            settled.add(v)
+            for i in range(indptr[v], indptr[v + 1]):
+                u = indices[i]
+                new_dist = dist + weights[i]
+                if u not in settled and new_dist < best.get(u, np.inf):
+                    best[u] = new_dist
+                    heapq.heappush(queue, (new_dist + to_target(u), new_dist, u))
+        return np.inf
+
+    def vertex_distances(self, sources, targets, limit = np.inf):
+        '''the geodesic distance between each pair of sources and targets'''
+        return np.array([self.vertex_distance(source, target, limit)
+                         for source, target in zip(sources, targets)])
+
+def build_mesh_graph(coords, triangles):
+    '''
+    build the sparse geodesic graph of a mesh from the edges of each triangle
+    and the diagonals across every pair of triangles sharing an edge
+    (when the straight line between their far vertices crosses that edge)
+    '''
+    n_vertices = coords.shape[0]
+    ## each triangle contributes three edges, each with an opposite vertex
+    edge_a = np.concatenate((triangles[:,0], triangles[:,1], triangles[:,2]))
+    edge_b = np.concatenate((triangles[:,1], triangles[:,2], triangles[:,0]))
+    opposite = np.concatenate((triangles[:,2], triangles[:,0], triangles[:,1]))
+    lo = np.minimum(edge_a, edge_b)
+    hi = np.maximum(edge_a, edge_b)
+
+    ## sort the edges so that the two triangles sharing an edge are adjacent
+    order = np.lexsort((hi, lo))
+    lo, hi, opposite = lo[order], hi[order], opposite[order]
+    shared = np.where((lo[1:] == lo[:-1]) & (hi[1:] == hi[:-1]))[0]
+    a, b = lo[shared], hi[shared]
+    c, d = opposite[shared], opposite[shared + 1]
+
+    ## unfold the triangle pair into a plane along the shared edge a-b
+    edge = coords[b] - coords[a]
+    edge_len = np.linalg.norm(edge, axis = 1)
+    edge_len[edge_len == 0] = np.finfo(float).eps
+    unit = edge / edge_len[:, np.newaxis]
+    c_rel = coords[c] - coords[a]
+    d_rel = coords[d] - coords[a]
+    t_c = np.sum(c_rel * unit, axis = 1)
+    t_d = np.sum(d_rel * unit, axis = 1)
+    h_c = np.linalg.norm(c_rel - t_c[:, np.newaxis] * unit, axis = 1)
+    h_d = np.linalg.norm(d_rel - t_d[:, np.newaxis] * unit, axis = 1)
+    heights = h_c + h_d
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        crossing = t_c + (t_d - t_c) * h_c / heights
+    valid = (heights > 0) & (crossing > 0) & (crossing < edge_len)
+    diag_len = np.sqrt((t_c - t_d)**2 + heights**2)
+
+    ## stack the edges and valid diagonals (both directions)
+    edge_len = np.linalg.norm(coords[hi] - coords[lo], axis = 1)
+    c, d, diag_len = c[valid], d[valid], diag_len[valid]
+    rows = np.concatenate((lo, hi, c, d))
+    cols = np.concatenate((hi, lo, d, c))
+    data = np.concatenate((edge_len, edge_len, diag_len, diag_len))
+
+    ## remove duplicates (edges are listed once per triangle), keep the shortest
+    order = np.lexsort((data, cols, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    keep = np.ones(len(rows), dtype = bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    graph = sparse.csr_matrix((data[keep], (rows[keep], cols[keep])),
+                              shape = (n_vertices, n_vertices))
+    return graph
+
+class NeighbourhoodIndex(object):
+    '''
+    All vertices within a geodesic radius of every vertex of one surface.
+
+    Stored in compressed sparse row (CSR) form: the neighbours of vertex v are
+    indices[offsets[v]:offsets[v+1]], at distances[offsets[v]:offsets[v+1]]
+    (the vertex itself is included at distance 0).
+    '''
+    def __init__(self, offsets, indices, distances, radius, surface_hash = None):
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.indices = np.asarray(indices, dtype = np.int32)
+        self.distances = np.asarray(distances, dtype = np.float32)
+        self.radius = float(radius)
+        self.surface_hash = surface_hash
+
+    @property
+    def n_vertices(self):
+        return len(self.offsets) - 1
+
+    def neighbours(self, vertex):
+        '''the vertices within the radius of vertex'''
+        return self.indices[self.offsets[vertex]:self.offsets[vertex + 1]]
+
+    def neighbour_distances(self, vertex):
+        '''the distances to the vertices returned by neighbours(vertex)'''
+        return self.distances[self.offsets[vertex]:self.offsets[vertex + 1]]
+
+    def gather(self, vertices):
+        '''
+        positions (into indices/distances) of the neighbours of many vertices
+        returns the positions and the number of neighbours of each vertex
+        '''
+        vertices = np.asarray(vertices, dtype = np.int64)
+        starts = self.offsets[vertices]
+        counts = self.offsets[vertices + 1] - starts
+        firsts = np.cumsum(counts) - counts
+        positions = (np.arange(counts.sum()) - np.repeat(firsts, counts)
+                     + np.repeat(starts, counts))
+        return positions, counts
+
+    def restrict(self, radius):
+        '''return a new index for a smaller radius'''
+        radius = float(radius)
+        if radius > self.radius:
+            raise ValueError('Cannot restrict a {}mm neighbourhood index to {}mm'
+                ''.format(self.radius, radius))
+        keep = self.distances <= radius
+        kept_before = np.concatenate(([0], np.cumsum(keep)))
+        offsets = kept_before[self.offsets]
+        return NeighbourhoodIndex(offsets, self.indices[keep],
+                                  self.distances[keep], radius, self.surface_hash)
+
+    def roi_labels(self, vertices, labels, exclude_overlap = True):
+        '''
+        build a 1D label array of geodesic rois centred on vertices
+        if exclude_overlap, vertices in more than one roi are set to zero
+        (like wb_command -surface-geodesic-rois -overlap-logic EXCLUDE)
+        '''
+        labels = np.asarray(labels)
+        positions, counts = self.gather(vertices)
+        members = self.indices[positions]
+        rois = np.zeros(self.n_vertices, dtype = labels.dtype)
+        rois[members] = np.repeat(labels, counts)
+        if exclude_overlap:
+            overlap = np.bincount(members, minlength = self.n_vertices) > 1
+            rois[overlap] = 0
+        return rois
+
+    def save(self, filename):
+        '''write the index to an .npz file (atomically, as runs may share it)'''
+        tmp_file = '{}.{}.tmp.npz'.format(filename, os.getpid())
+        np.savez(tmp_file, offsets = self.offsets, indices = self.indices,
+                 distances = self.distances, radius = self.radius,
+                 surface_hash = str(self.surface_hash))
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as npz:
+            index = cls(npz['offsets'], npz['indices'], npz['distances'],
+                        float(npz['radius']), str(npz['surface_hash']))
+        return index
+
+    def to_shared_memory(self):
+        '''
+        copy the index into shared memory blocks (to pass to worker processes)
+        returns the blocks (the caller should close and unlink them when the
+        workers are finished) and a picklable description for from_shared_memory
+        '''
+        blocks = []
+        arrays = {}
+        for name in ['offsets', 'indices', 'distances']:
+            array = getattr(self, name)
+            block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[:] = array
+            blocks.append(block)
+            arrays[name] = (block.name, array.shape, array.dtype.str)
+        description = {'arrays': arrays,
+                       'radius': self.radius,
+                       'surface_hash': self.surface_hash}
+        return blocks, description
+
+    @classmethod
+    def from_shared_memory(cls, description):
+        '''attach (without copying) to an index shared with to_shared_memory'''
+        blocks = []
+        arrays = {}
+        for name, (block_name, shape, dtype) in description['arrays'].items():
+            block = shared_memory.SharedMemory(name = block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype = dtype, buffer = block.buf)
+        index = cls(arrays['offsets'], arrays['indices'], arrays['distances'],
+                    description['radius'], description['surface_hash'])
+        ## the blocks must stay open for as long as the index is used
+        index.shared_blocks = blocks
+        return index
+
+class GeodesicRois(object):
+    '''
+    Geodesic rois (of the radius of a NeighbourhoodIndex) centred on a set of
+    vertices, where vertices within the radius of more than one roi are
+    excluded from all of them.
+
+    The label array is updated in place as roi centres move, so the cost of a
+    move scales with the size of the rois rather than the size of the surface.
+    '''
+    def __init__(self, index, vertices, labels):
+        self.index = index
+        vertices = np.asarray(vertices, dtype = np.int64)
+        labels = np.asarray(labels, dtype = np.int64)
+        self.centres = dict(zip(labels.tolist(), vertices.tolist()))
+        ## how many rois claim each vertex, and the sum of their labels
+        positions, counts = index.gather(vertices)
+        members = index.indices[positions]
+        self.claims = np.bincount(members, minlength = index.n_vertices)
+        self.label_sums = np.bincount(members, weights = np.repeat(labels, counts),
+                                      minlength = index.n_vertices).astype(np.int64)
+        self.labels = np.where(self.claims == 1, self.label_sums, 0)
+
+    def move(self, label, vertex):
+        '''
+        move the centre of roi label to vertex
+        returns the vertices whose label may have changed
+        '''
+        old_vertex = self.centres[label]
+        if old_vertex == vertex:
+            return np.array([], dtype = np.int64)
+        old_members = self.index.neighbours(old_vertex)
+        new_members = self.index.neighbours(vertex)
+        self.claims[old_members] -= 1
+        self.label_sums[old_members] -= label
+        self.claims[new_members] += 1
+        self.label_sums[new_members] += label
+        touched = np.union1d(old_members, new_members)
+        self.labels[touched] = np.where(self.claims[touched] == 1,
+                                        self.label_sums[touched], 0)
+        self.centres[label] = vertex
+        return touched
+
+    def members(self, label):
+        '''the vertices that belong to roi label'''
+        neighbours = self.index.neighbours(self.centres[label])
+        return neighbours[self.labels[neighbours] == label]
+
+def build_neighbourhood_index(surface_graph, radius, chunk_size = 256):
+    '''
+    run a radius-limited Dijkstra from every vertex of a SurfaceGraph
+    and collect the results into a NeighbourhoodIndex
+    '''
+    radius = float(radius)
+    n_vertices = surface_graph.n_vertices
+    counts = np.zeros(n_vertices, dtype = np.int64)
+    all_indices = []
+    all_distances = []
+    for start in range(0, n_vertices, chunk_size):
+        sources = np.arange(start, min(n_vertices, start + chunk_size))
+        dists = surface_graph.distances(sources, limit = radius)
+        rows, cols = np.nonzero(dists <= radius)
+        counts[sources] = np.bincount(rows, minlength = len(sources))
+        all_indices.append(cols.astype(np.int32))
+        all_distances.append(dists[rows, cols].astype(np.float32))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return NeighbourhoodIndex(offsets, np.concatenate(all_indices),
+                              np.concatenate(all_distances), radius)
+
+def surface_hash(surf):
+    '''the sha1 hash of the contents of a surface file'''
+    return ciftify.utils.file_hash(surf)
+
+def get_surface_graph(surf):
+    '''read (once per process) the SurfaceGraph of a surface file'''
+    surf_hash = surface_hash(surf)
+    if surf_hash not in _SURFACE_GRAPHS:
+        _SURFACE_GRAPHS[surf_hash] = SurfaceGraph.from_file(surf)
+    return _SURFACE_GRAPHS[surf_hash]
+
+def get_vertex_distances(surf, sources, targets, limit = np.inf):
+    '''
+    the geodesic distances (np.inf beyond the limit) between pairs of vertices
+    of surf, without computing the full distance field of each source
+    '''
+    return get_surface_graph(surf).vertex_distances(sources, targets, limit)
+
+def get_distances_from_sources(surf, sources, targets, limit = np.inf,
+                               chunk_size = 256):
+    '''
+    the geodesic distances (np.inf beyond the limit) between pairs of vertices
+    of surf, from one multi-source Dijkstra over the unique sources (so this is
+    the fastest way to measure many pairs that share a few sources)
+    '''
+    graph = get_surface_graph(surf)
+    sources = np.asarray(sources, dtype = np.int64)
+    targets = np.asarray(targets, dtype = np.int64)
+    unique_sources, source_rows = np.unique(sources, return_inverse = True)
+    distances = np.empty(len(sources))
+    for start in range(0, len(unique_sources), chunk_size):
+        block = graph.distances(unique_sources[start:start + chunk_size], limit)
+        in_chunk = (source_rows >= start) & (source_rows < start + chunk_size)
+        distances[in_chunk] = block[source_rows[in_chunk] - start, targets[in_chunk]]
+    return distances
+
+def get_pairwise_distances(surf, vertices, limit = np.inf, chunk_size = 256):
+    '''
+    the (vertices x vertices) geodesic distances (np.inf beyond the limit)
+    between all pairs of vertices of surf, the distance field of each unique
+    vertex is computed once (chunk_size at a time)
+    '''
+    graph = get_surface_graph(surf)
+    unique_vertices, vertex_rows = np.unique(np.asarray(vertices, dtype = np.int64),
+                                             return_inverse = True)
+    unique_distances = np.empty((len(unique_vertices), len(unique_vertices)))
+    for start in range(0, len(unique_vertices), chunk_size):
+        block = graph.distances(unique_vertices[start:start + chunk_size], limit)
+        unique_distances[start:start + chunk_size, :] = block[:, unique_vertices]
+    return unique_distances[np.ix_(vertex_rows, vertex_rows)]
+
+def neighbourhood_cache_dirs(surf, cache_dir = None):
+    '''
+    the directories searched for cached neighbourhood indices, in order:
+    the cache_dir argument, the CIFTIFY_CACHE environment variable,
+    the directory of the surface and ~/.cache/ciftify
+    '''
+    if cache_dir:
+        return [cache_dir]
+    cache_dirs = [ciftify.config.find_ciftify_cache(),
+                  os.path.dirname(os.path.abspath(surf)),
+                  os.path.join(os.path.expanduser('~'), '.cache', 'ciftify')]
+    return [d for d in cache_dirs if d]
+
+def neighbourhood_cache_file(cache_dir, surf_hash, radius):
+    return os.path.join(cache_dir,
+        '{}_r{:g}mm.neighbours.npz'.format(surf_hash, float(radius)))
+
+def _find_cached_index(cache_dirs, surf_hash, radius):
+    '''find the smallest cached index with radius >= the one requested'''
+    found = []
+    for cache_dir in cache_dirs:
+        pattern = os.path.join(cache_dir, '{}_r*mm.neighbours.npz'.format(surf_hash))
+        for cache_file in glob.glob(pattern):
+            cached_radius = os.path.basename(cache_file).replace(
+                '{}_r'.format(surf_hash), '').replace('mm.neighbours.npz', '')
+            try:
+                cached_radius = float(cached_radius)
+            except ValueError:
+                continue
+            if cached_radius >= radius:
+                found.append((cached_radius, cache_file))
+    if not found:
+        return None
+    return min(found)[1]
+
+def _write_cached_index(index, cache_dirs):
+    '''write the index into the first writable cache directory'''
+    for cache_dir in cache_dirs:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            cache_file = neighbourhood_cache_file(cache_dir, index.surface_hash,
+                                                  index.radius)
+            index.save(cache_file)
+            logger.debug('Wrote neighbourhood index {}'.format(cache_file))
+            return cache_file
+        except OSError:
+            continue
+    logger.warning('Could not write the neighbourhood index to any of {}'
+        ''.format(cache_dirs))
+    return None
+
+def register_neighbourhood_index(index):
+    '''
+    add an index (i.e. one attached from shared memory) to the in memory cache
+    so that get_neighbourhood_index calls for its surface can use it
+    '''
+    _NEIGHBOURHOODS[(index.surface_hash, index.radius)] = index
+
+def get_neighbourhood_index(surf, radius, cache_dir = None):
+    '''
+    returns the NeighbourhoodIndex of surf for radius (in mm)
+
+    The index is read from memory or from the on disk cache when possible
+    (an index for a larger radius of the same surface is restricted to the
+    one requested). If no cached index exists, it is built and written to
+    the cache.
+    '''
+    radius = float(radius)
+    surf_hash = surface_hash(surf)
+    if (surf_hash, radius) in _NEIGHBOURHOODS:
+        return _NEIGHBOURHOODS[(surf_hash, radius)]
+
+    in_memory = [r for (h, r) in _NEIGHBOURHOODS if h == surf_hash and r > radius]
+    cache_dirs = neighbourhood_cache_dirs(surf, cache_dir)
+    if in_memory:
+        index = _NEIGHBOURHOODS[(surf_hash, min(in_memory))].restrict(radius)
+    else:
+        cache_file = _find_cached_index(cache_dirs, surf_hash, radius)
+        if cache_file:
+            logger.debug('Reading neighbourhood index {}'.format(cache_file))
+            index = NeighbourhoodIndex.load(cache_file)
+            if index.radius > radius:
+                _NEIGHBOURHOODS[(surf_hash, index.radius)] = index
+                index = index.restrict(radius)
+        else:
+            logger.info('Building {}mm geodesic neighbourhood index for {}'
+                ''.format(radius, surf))
+            index = build_neighbourhood_index(get_surface_graph(surf), radius)
+            index.surface_hash = surf_hash
+            _write_cached_index(index, cache_dirs)
+    _NEIGHBOURHOODS[(surf_hash, radius)] = index
+    return index
@@ -11,6 +11,7 @@ import numpy as np
 
 import ciftify.utils
 import ciftify.niio
+import ciftify.compute
 
 class NibInput(object):
     def __init__(self, path):
@@ -122,7 +123,7 @@ def load_data_as_numpy_arrays(settings, tempdir):
             verify_nifti_dimensions_match(settings.seed.path, settings.func.path)
             func_data, _, _, _ = ciftify.niio.load_nifti(settings.func.path)
         elif settings.func.type == 'cifti':
-            subcort_func = os.path.join(tempdir, 'subcort_func.nii.gz')
+            subcort_func = ciftify.niio.temp_nifti(tempdir, 'subcort_func')
             ciftify.utils.run(['wb_command',
               '-cifti-separate', settings.func.path, 'COLUMN',
               '-volume-all', subcort_func])
@@ -137,7 +138,7 @@ def load_data_as_numpy_arrays(settings, tempdir):
                 verify_nifti_dimensions_match(settings.func.path, settings.mask.path)
                 mask_data, _, _, _ = ciftify.niio.load_nifti(settings.mask.path)
             elif settings.mask.type == 'cifti':
-                subcort_mask = os.path.join(tempdir, 'subcort_mask.nii.gz')
+                subcort_mask = ciftify.niio.temp_nifti(tempdir, 'subcort_mask')
                 ciftify.utils.run(['wb_command',
                   '-cifti-separate', settings.mask.path, 'COLUMN',
                   '-volume-all', subcort_mask])
@@ -203,13 +204,10 @@ def calc_meants_with_numpy(settings, outputlabels = None):
                rois = [float(settings.roi_label)]
         else:
             rois = np.unique(seed_data)[1:]
-        out_data = np.zeros((len(rois), func_data.shape[1]))
-
-        # get mean seed dataistic from each, append to output
-        for i, roi in enumerate(rois):
-            idx = np.where(seed_data == roi)[0]
-            idxx = np.intersect1d(mask_indices, idx)
-            out_data[i,:] = np.mean(func_data[idxx, :], axis=0)
+        # get mean seed dataistic from each (only the voxels in the mask)
+        labels = np.zeros(func_data.shape[0], dtype = seed_data.dtype)
+        labels[mask_indices] = np.ravel(seed_data)[mask_indices]
+        out_data = ciftify.compute.roi_means(func_data, labels, rois)
 
     # write out csv
     if settings.outputcsv: np.savetxt(settings.outputcsv, out_data, delimiter=",")
@@ -2,18 +2,33 @@
 """
 A collection of utilities for ciftify functions mostly for
 loading data into numpy arrays
+
+Nifti outputs are written with save_nifti(), which honours the output
+compression policy (see set_compression). Temporary niftis (named with
+temp_nifti) are never compressed.
 """
 
 import os
 import sys
+import gzip
 import logging
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 import nibabel as nib
 import nibabel.gifti.giftiio
 
+import ciftify.config
 from ciftify.utils import run, get_stdout, TempDir
 
+## each thread of the parallel gzip writer compresses blocks of this size
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+_COMPRESSION = {}
+
 def cifti_info(filename):
     '''runs wb_command -file-information" to try to figure out what the file is made off'''
     c_info = get_stdout(['wb_command', '-file-information', filename, '-no-map-info'])
@@ -144,7 +159,7 @@ def load_cifti(filename):
     with TempDir() as tempdir:
         L_data_surf=os.path.join(tempdir, 'Ldata.func.gii')
         R_data_surf=os.path.join(tempdir, 'Rdata.func.gii')
-        vol_data_nii=os.path.join(tempdir,'vol.nii.gz')
+        vol_data_nii=temp_nifti(tempdir, 'vol')
         run(['wb_command','-cifti-separate', filename, 'COLUMN',
             '-metric', 'CORTEX_LEFT', L_data_surf,
             '-metric', 'CORTEX_RIGHT', R_data_surf,
@@ -270,6 +285,11 @@ def load_surf_coords(surf):
     coords = nibabel.gifti.giftiio.read(surf).getArraysFromIntent('NIFTI_INTENT_POINTSET')[0].data
     return coords
 
+def load_surf_triangles(surf):
+    '''load the triangles (faces) from a surface file'''
+    triangles = nibabel.gifti.giftiio.read(surf).getArraysFromIntent('NIFTI_INTENT_TRIANGLE')[0].data
+    return triangles
+
 
 def load_hemisphere_labels(filename, wb_structure, map_number = 1):
     '''separates dlabel file into left and right and loads label data'''
@@ -333,3 +353,98 @@ def determine_filetype(path):
         sys.exit(1)
 
     return(MR_type, MRbase)
+
+def _compression_setting(value, name, lowest, highest = None):
+    '''an int setting of at least lowest (and at most highest), or None if unset or invalid'''
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+    if value is None or value < lowest or (highest is not None and value > highest):
+        logger = logging.getLogger(__name__)
+        logger.warning('Invalid {}, using the default'.format(name))
+        return None
+    return value
+
+def set_compression(level = None, threads = None):
+    '''
+    set how .nii.gz outputs are written: the zlib level (0-9, None picks the
+    CIFTIFY_COMPRESSION_LEVEL environment variable, else nibabel's default)
+    and the number of threads compressing them (None picks the
+    CIFTIFY_COMPRESSION_THREADS environment variable, else 1), returns the
+    (level, threads) in use
+    '''
+    if level is None:
+        level = ciftify.config.find_compression_level()
+    if threads is None:
+        threads = ciftify.config.find_compression_threads()
+    level = _compression_setting(level, 'compression level', 0, 9)
+    if level is None:
+        level = nib.openers.ImageOpener.default_compresslevel
+    threads = _compression_setting(threads, 'number of compression threads', 1) or 1
+    _COMPRESSION.update(level = level, threads = threads)
+    return level, threads
+
+def get_compression():
+    '''the (level, threads) used to write .nii.gz outputs'''
+    if not _COMPRESSION:
+        set_compression()
+    return _COMPRESSION['level'], _COMPRESSION['threads']
+
+def temp_nifti(tmpdir, name):
+    '''
+    the path of the (uncompressed) temporary nifti called name in tmpdir,
+    a .nii.gz extension is replaced so that no time is spent compressing
+    files that are deleted at the end of the run
+    '''
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(tmpdir, '{}.nii'.format(name))
+
+def gzip_file(source, filename, level, threads, block_size = None):
+    '''
+    gzips source to filename with the blocks of source compressed by threads
+    in parallel, each block is a gzip member and every gzip reader
+    (nibabel, wb_command, FSL) reads the concatenated members as one file
+    '''
+    block_size = block_size or GZIP_BLOCK_SIZE
+    compress = functools.partial(gzip.compress, compresslevel = level, mtime = 0)
+    with open(source, 'rb') as src, open(filename, 'wb') as out, \
+            ThreadPoolExecutor(threads) as pool:
+        while True:
+            blocks = [block for block in (src.read(block_size)
+                      for _ in range(threads)) if block]
+            if not blocks:
+                break
+            for member in pool.map(compress, blocks):
+                out.write(member)
+
+def save_nifti(nib_image, filename):
+    '''
+    writes a nifti (or cifti) image, a .nii.gz is compressed at the level and
+    with the number of threads set by set_compression
+    '''
+    if not filename.endswith('.gz'):
+        nib_image.to_filename(filename)
+        return
+    level, threads = get_compression()
+    if threads > 1:
+        handle, uncompressed = tempfile.mkstemp(suffix = '.nii',
+                dir = os.path.dirname(os.path.abspath(filename)))
+        os.close(handle)
+        try:
+            nib_image.to_filename(uncompressed)
+            gzip_file(uncompressed, filename, level, threads)
+        finally:
+            os.remove(uncompressed)
+        return
+    opener = nib.openers.ImageOpener
+    default_level = opener.default_compresslevel
+    opener.default_compresslevel = level
+    try:
+        nib_image.to_filename(filename)
+    finally:
+        opener.default_compresslevel = default_level
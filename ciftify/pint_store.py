@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+A consolidated (HDF5) store of the outputs of ciftify_PINT_vertices for many
+subjects, so that group analyses can read slices (for example all pvertex
+meants of the DM network) without parsing every subject's text outputs.
+
+The store is written by ciftify_postPINT1_concat --store and has one group per
+subject (the PINT output prefix):
+
+    /subjects/<subid>/summary/<column>   the columns of the _summary.csv (the
+                                         name of the pvertex column is kept in
+                                         the pvertex_col attribute)
+    /subjects/<subid>/roiidx             the roiidx of each meants row
+    /subjects/<subid>/tvertex_meants     (rois x timepoints, chunked by roi)
+    /subjects/<subid>/pvertex_meants     (rois x timepoints, chunked by roi)
+
+Reading and writing a store requires the h5py package.
+"""
+
+import os
+import sys
+import logging
+
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+logger = logging.getLogger(__name__)
+
+VERTEX_TYPES = ('tvertex', 'pvertex')
+
+## the (Yeo 7) networks of the PINT template, with the roi and view shown
+## for each in the cifti_vis_PINT qc pages
+PINT_NETWORKS = [{ 'NETWORK': 2, 'network':'VI', 'roiidx': 72, 'best_view': "APDV", 'Order': 6},
+                 { 'NETWORK': 3, 'network': 'DA', 'roiidx': 2, 'best_view': "APDV", 'Order': 1},
+                 { 'NETWORK': 4, 'network': 'VA', 'roiidx': 44, 'best_view': "LM", 'Order': 4},
+                 { 'NETWORK': 5, 'network': 'SM', 'roiidx': 62, 'best_view': "LM", 'Order': 5},
+                 { 'NETWORK': 6, 'network': 'FP', 'roiidx': 28, 'best_view': "LM", 'Order': 3},
+                 { 'NETWORK': 7, 'network': 'DM', 'roiidx': 14, 'best_view': "LM", 'Order': 2}]
+
+## the NETWORK number of each network name
+NETWORK_NAMES = {net['network']: net['NETWORK'] for net in PINT_NETWORKS}
+
+def is_pint_store(filename):
+    '''True if the filename is (named as) an HDF5 PINT store'''
+    return filename.endswith(('.h5', '.hdf5'))
+
+def PINT_output_files(output_prefix):
+    '''the summary and the tvertex and pvertex meants csvs of one PINT output'''
+    outputs = {'summary': '{}_summary.csv'.format(output_prefix)}
+    for vertex_type in VERTEX_TYPES:
+        outputs[vertex_type] = '{}_{}_meants.csv'.format(output_prefix, vertex_type)
+    return outputs
+
+def read_PINT_outputs(output_prefix):
+    '''
+    reads the summary dataframe and the tvertex and pvertex meants
+    (rois x timepoints arrays) of one PINT output, raises a FileNotFoundError
+    if any of them is missing
+    '''
+    outputs = PINT_output_files(output_prefix)
+    for output in outputs.values():
+        if not os.path.exists(output):
+            raise FileNotFoundError("{} not found".format(output))
+    summary_df = pd.read_csv(outputs['summary'])
+    meants = {vertex_type: np.loadtxt(outputs[vertex_type], delimiter = ',', ndmin = 2)
+              for vertex_type in VERTEX_TYPES}
+    return summary_df, meants['tvertex'], meants['pvertex']
+
+def network_number(network):
+    '''the NETWORK number of a network name (or number)'''
+    if network in NETWORK_NAMES:
+        return NETWORK_NAMES[network]
+    try:
+        return int(network)
+    except ValueError:
+        logger.critical('Unknown network {}, expected a NETWORK number or one '
+                        'of {}'.format(network, ', '.join(NETWORK_NAMES)))
+        sys.exit(1)
+
+class PINTStore(object):
+    '''
+    The PINT outputs of many subjects in one HDF5 file, open with mode 'r'
+    to read or 'a' to add subjects (use as a context manager)
+    '''
+    def __init__(self, filename, mode = 'r'):
+        if h5py is None:
+            logger.critical('Reading or writing a PINT store requires the h5py package')
+            sys.exit(1)
+        if mode == 'r' and not os.path.exists(filename):
+            logger.critical("{} not found".format(filename))
+            sys.exit(1)
+        self.filename = filename
+        self.h5 = h5py.File(filename, mode)
+        if mode != 'r':
+            self.h5.require_group('subjects')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    @property
+    def subjects(self):
+        '''the subids in the store (sorted)'''
+        return sorted(self.h5.get('subjects', {}).keys())
+
+    def __contains__(self, subid):
+        return subid in self.h5.get('subjects', {})
+
+    def __subject_group(self, subid):
+        if subid not in self:
+            logger.critical('Subject {} is not in {}'.format(subid, self.filename))
+            sys.exit(1)
+        return self.h5['subjects'][subid]
+
+    def add_subject(self, subid, summary_df, tvertex_meants, pvertex_meants,
+                    overwrite = False, pvertex_col = 'pvertex'):
+        '''
+        adds the summary dataframe (with its final vertices in the pvertex_col
+        column) and the meants (rois x timepoints, in order of roiidx) of one
+        subject, an existing subject is kept unless overwrite, raises a
+        ValueError if the meants do not match the summary
+        '''
+        if subid in self:
+            if not overwrite:
+                logger.info('{} is already in {}'.format(subid, self.filename))
+                return
+            del self.h5['subjects'][subid]
+        roiidx = np.sort(summary_df.roiidx.values)
+        for meants in (tvertex_meants, pvertex_meants):
+            if meants.shape[0] != len(roiidx):
+                raise ValueError('The meants of {} have {} rows, but there are {} rois '
+                        'in its summary'.format(subid, meants.shape[0], len(roiidx)))
+        group = self.h5['subjects'].create_group(subid)
+        summary = group.create_group('summary')
+        summary.attrs['pvertex_col'] = pvertex_col
+        for column in summary_df.columns:
+            values = summary_df[column].values
+            if values.dtype == object:
+                values = values.astype('S')
+            summary.create_dataset(column, data = values)
+        summary.attrs['columns'] = [str(column) for column in summary_df.columns]
+        group.create_dataset('roiidx', data = roiidx)
+        for vertex_type, meants in zip(VERTEX_TYPES, (tvertex_meants, pvertex_meants)):
+            group.create_dataset('{}_meants'.format(vertex_type),
+                    data = meants.astype(np.float32),
+                    chunks = (1, meants.shape[1]) if meants.size else None,
+                    compression = 'gzip')
+
+    def add_PINT_outputs(self, output_prefix, subid = None, overwrite = False,
+                         pvertex_col = 'pvertex'):
+        '''
+        adds the text outputs of one ciftify_PINT_vertices run, the subid
+        defaults to the basename of the output prefix
+        '''
+        if subid is None:
+            subid = os.path.basename(output_prefix)
+        if subid in self and not overwrite:
+            return
+        self.add_subject(subid, *read_PINT_outputs(output_prefix),
+                         overwrite = overwrite, pvertex_col = pvertex_col)
+
+    def summary(self, subids = None, network = None, roiidx = None):
+        '''
+        the summary of the subjects (default all) as one dataframe with a subid
+        column, optionally only the rois of one network (name or number) or
+        of a list of roiidx
+        '''
+        summaries = []
+        for subid in self.__select_subjects(subids):
+            summary = self.__subject_group(subid)['summary']
+            subject_df = pd.DataFrame({column: self.__read_column(summary[column])
+                                       for column in summary.attrs['columns']})
+            subject_df.insert(0, 'subid', subid)
+            summaries.append(subject_df.loc[self.__roi_mask(subject_df, network, roiidx), :])
+        if not summaries:
+            return pd.DataFrame()
+        return pd.concat(summaries, ignore_index = True)
+
+    def vertex_trajectories(self, subid):
+        '''
+        the vertex of every roi (rows, indexed by roiidx) at every iteration
+        (columns) as stored in the summary (all iterations if PINT was run with
+        --outputall, otherwise the tvertex, the second last vertex and pvertex)
+        '''
+        subject_df = self.summary([subid])
+        pvertex_col = self.__subject_group(subid)['summary'].attrs.get('pvertex_col',
+                                                                       'pvertex')
+        vertex_cols = [col for col in subject_df.columns if col.startswith('vertex_')]
+        vertex_cols = sorted(vertex_cols, key = lambda col: int(col.split('_')[1]))
+        trajectories = subject_df.loc[:, ['tvertex'] + vertex_cols + [pvertex_col]]
+        trajectories.index = subject_df.roiidx
+        return trajectories
+
+    def meants(self, vertex_type = 'pvertex', subids = None, network = None,
+               roiidx = None):
+        '''
+        the tvertex or pvertex meants of the subjects (default all) as a dict
+        of subid to (rois x timepoints) dataframes indexed by roiidx, optionally
+        only of the rois of one network (name or number) or of a list of roiidx
+        (only these rows are read from the store)
+        '''
+        if vertex_type not in VERTEX_TYPES:
+            logger.critical('vertex_type must be one of {}'.format(', '.join(VERTEX_TYPES)))
+            sys.exit(1)
+        all_meants = {}
+        for subid in self.__select_subjects(subids):
+            group = self.__subject_group(subid)
+            subject_roiidx = group['roiidx'][()]
+            if network is None:
+                keep = np.ones(len(subject_roiidx), dtype = bool)
+            else:
+                summary = self.summary([subid], network = network)
+                keep = np.isin(subject_roiidx, summary.roiidx.values)
+            if roiidx is not None:
+                keep &= np.isin(subject_roiidx, roiidx)
+            rows = np.flatnonzero(keep)
+            meants = group['{}_meants'.format(vertex_type)]
+            data = meants[rows, :] if len(rows) else np.zeros((0, meants.shape[1]))
+            all_meants[subid] = pd.DataFrame(data, index = pd.Index(
+                                    subject_roiidx[rows], name = 'roiidx'))
+        return all_meants
+
+    def __read_column(self, dataset):
+        values = dataset[()]
+        if values.dtype.kind == 'S':
+            values = values.astype(str).astype(object)
+        return values
+
+    def __select_subjects(self, subids):
+        if subids is None:
+            return self.subjects
+        if isinstance(subids, str):
+            return [subids]
+        return list(subids)
+
+    def __roi_mask(self, subject_df, network, roiidx):
+        mask = np.ones(len(subject_df), dtype = bool)
+        if network is not None:
+            mask &= (subject_df.NETWORK == network_number(network)).values
+        if roiidx is not None:
+            mask &= subject_df.roiidx.isin(roiidx).values
+        return mask
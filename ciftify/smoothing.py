@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+In-process gaussian smoothing of surface and cifti data.
+
+Surface data are smoothed with a geodesic gaussian kernel weighted by vertex
+area (like the default GEO_GAUSS_AREA method of wb_command -metric-smoothing).
+The kernel of each surface and sigma is built once, from the cached geodesic
+neighbourhood index of the surface, as a sparse matrix. Smoothing a time series
+is then one sparse x dense product per chunk of timepoints, with no GIFTI
+files written or read.
+"""
+
+import logging
+
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+import ciftify.geodesic
+import ciftify.niio
+
+logger = logging.getLogger(__name__)
+
+## the kernels are truncated at this many sigma
+KERNEL_SIGMAS = 4
+
+## in memory cache of the surface operators, keyed by (surface hash, sigma)
+_SURFACE_OPERATORS = {}
+
+class SmoothingOperator(object):
+    '''
+    A sparse (n x n) smoothing kernel, row i holds the (unnormalised) weights
+    of the vertices (or voxels) that are smoothed into vertex i.
+
+    The rows are normalised when the operator is applied, so that vertices
+    outside of an roi (i.e. the medial wall) can be dropped from the kernel.
+    '''
+    def __init__(self, kernel, sigma):
+        self.kernel = sparse.csr_matrix(kernel)
+        self.sigma = sigma
+        self._normalised = {}
+
+    @property
+    def n_vertices(self):
+        return self.kernel.shape[0]
+
+    def normalised(self, roi = None):
+        '''
+        the kernel with only the columns inside the roi, with rows that sum to
+        one (rows outside of the roi are all zero)
+        '''
+        if roi is None:
+            key = None
+            mask = np.ones(self.n_vertices)
+        else:
+            mask = (np.asarray(roi).reshape(-1) > 0).astype(np.float64)
+            key = mask.tobytes()
+        if key not in self._normalised:
+            masked = self.kernel.dot(sparse.diags(mask))
+            weights = np.asarray(masked.sum(axis = 1)).reshape(-1)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                row_scale = np.where(weights > 0, mask / weights, 0)
+            normalised = sparse.diags(row_scale).dot(masked).tocsr()
+            normalised.eliminate_zeros()
+            ## only keep the most recent roi (one per func file in practice)
+            self._normalised = {key: normalised}
+        return self._normalised[key]
+
+    def apply(self, data, roi = None, chunk_size = 128):
+        '''
+        smooth data (vertices x timepoints, or a 1D array of vertices)
+
+        If an roi is given, only the vertices inside it are used and the
+        output is zero outside of it (the -roi option of -metric-smoothing).
+        '''
+        data = np.asarray(data)
+        if data.shape[0] != self.n_vertices:
+            raise ValueError('Data has {} rows, the smoothing kernel has {} '
+                'vertices'.format(data.shape[0], self.n_vertices))
+        operator = self.normalised(roi)
+        if data.ndim == 1:
+            return operator.dot(data)
+        out = np.zeros(data.shape, dtype = np.result_type(data.dtype, np.float32))
+        for start in range(0, data.shape[1], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            out[:, chunk] = operator.dot(data[:, chunk])
+        return out
+
+def vertex_areas(coords, triangles):
+    '''the area of each vertex (a third of the area of every triangle it is in)'''
+    coords = np.asarray(coords, dtype = np.float64)
+    triangles = np.asarray(triangles, dtype = np.int64)
+    cross = np.cross(coords[triangles[:,1]] - coords[triangles[:,0]],
+                     coords[triangles[:,2]] - coords[triangles[:,0]])
+    triangle_areas = np.linalg.norm(cross, axis = 1) / 2
+    areas = np.bincount(triangles.ravel(), weights = np.repeat(triangle_areas, 3),
+                        minlength = coords.shape[0])
+    return areas / 3
+
+def build_surface_operator(index, areas, sigma):
+    '''
+    the SmoothingOperator of a surface from its NeighbourhoodIndex
+    (of radius >= KERNEL_SIGMAS * sigma) and vertex areas
+    '''
+    if index.radius > KERNEL_SIGMAS * sigma:
+        index = index.restrict(KERNEL_SIGMAS * sigma)
+    weights = np.exp(-index.distances.astype(np.float64)**2 / (2 * sigma**2))
+    weights *= areas[index.indices]
+    kernel = sparse.csr_matrix((weights, index.indices, index.offsets),
+                               shape = (index.n_vertices, index.n_vertices))
+    return SmoothingOperator(kernel, sigma)
+
+def get_surface_operator(surf, sigma, cache_dir = None):
+    '''
+    returns the SmoothingOperator of surf for a gaussian kernel of sigma (in mm)
+
+    The operator is built once per process from the (disk cached)
+    neighbourhood index of the surface and kept in memory.
+    '''
+    sigma = float(sigma)
+    surf_hash = ciftify.geodesic.surface_hash(surf)
+    if (surf_hash, sigma) not in _SURFACE_OPERATORS:
+        ## round the kernel radius up to a whole mm so that indices are reused
+        radius = np.ceil(KERNEL_SIGMAS * sigma)
+        index = ciftify.geodesic.get_neighbourhood_index(surf, radius, cache_dir)
+        areas = vertex_areas(ciftify.niio.load_surf_coords(surf),
+                             ciftify.niio.load_surf_triangles(surf))
+        _SURFACE_OPERATORS[(surf_hash, sigma)] = build_surface_operator(index,
+                                                        areas, sigma)
+    return _SURFACE_OPERATORS[(surf_hash, sigma)]
+
+def smooth_surface_data(data, surf, sigma, roi = None):
+    '''smooth surface data (vertices x timepoints) with a geodesic gaussian'''
+    if sigma <= 0:
+        return data
+    return get_surface_operator(surf, sigma).apply(data, roi)
+
+def build_volume_operator(ijk, affine, sigma):
+    '''
+    the SmoothingOperator of a set of voxels (indices ijk, n x 3) for a
+    gaussian kernel of sigma (in mm)
+    '''
+    xyz = nib.affines.apply_affine(affine, np.asarray(ijk))
+    pairs = cKDTree(xyz).query_pairs(KERNEL_SIGMAS * sigma, output_type = 'ndarray')
+    n_voxels = xyz.shape[0]
+    distances = np.linalg.norm(xyz[pairs[:,0]] - xyz[pairs[:,1]], axis = 1)
+    weights = np.exp(-distances**2 / (2 * sigma**2))
+    rows = np.concatenate((pairs[:,0], pairs[:,1], np.arange(n_voxels)))
+    cols = np.concatenate((pairs[:,1], pairs[:,0], np.arange(n_voxels)))
+    kernel = sparse.csr_matrix((np.concatenate((weights, weights, np.ones(n_voxels))),
+                               (rows, cols)), shape = (n_voxels, n_voxels))
+    return SmoothingOperator(kernel, sigma)
+
+def smooth_cifti_data(data, brain_models, volume_affine, sigma,
+                      left_surface, right_surface):
+    '''
+    smooth dense cifti data (timepoints x grayordinates) the way
+    wb_command -cifti-smoothing does: surface structures with a geodesic
+    gaussian limited to the vertices in the file and each volume structure
+    separately (subcortical structures are not smoothed into each other)
+    '''
+    surfaces = cifti_surfaces(left_surface, right_surface)
+    out = np.array(data, dtype = np.result_type(data.dtype, np.float32))
+    for brain_model in brain_models:
+        grayordinates = brain_model_slice(brain_model)
+        out[:, grayordinates] = smooth_brain_model_data(data[:, grayordinates],
+                                    brain_model, volume_affine, sigma, surfaces)
+    return out
+
+def cifti_surfaces(left_surface, right_surface):
+    '''the surface file of each cortical cifti structure'''
+    return {'CIFTI_STRUCTURE_CORTEX_LEFT': left_surface,
+            'CIFTI_STRUCTURE_CORTEX_RIGHT': right_surface}
+
+def brain_model_slice(brain_model):
+    '''the slice of the grayordinates of a brain model'''
+    return slice(brain_model.index_offset,
+                 brain_model.index_offset + brain_model.index_count)
+
+def cifti_volume_affine(index_map):
+    '''the voxel to mm affine of a brain models index map (None if it has no volume)'''
+    if index_map.volume is None:
+        return None
+    return index_map.volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+
+def smooth_brain_model_data(data, brain_model, volume_affine, sigma, surfaces):
+    '''
+    smooth the (timepoints x grayordinates) data of one brain model, a surface
+    structure with a geodesic gaussian limited to its vertices in the file and
+    a volume structure with a gaussian over its own voxels
+    '''
+    out_dtype = np.result_type(data.dtype, np.float32)
+    if brain_model.model_type == 'CIFTI_MODEL_TYPE_SURFACE':
+        surf = surfaces.get(brain_model.brain_structure)
+        if not surf:
+            logger.warning('No surface given for {}, it will not be smoothed'
+                ''.format(brain_model.brain_structure))
+            return np.array(data, dtype = out_dtype)
+        vertices = np.asarray(brain_model.vertex_indices)
+        surface_data = np.zeros((brain_model.surface_number_of_vertices,
+                                 data.shape[0]), dtype = out_dtype)
+        surface_data[vertices, :] = data.T
+        roi = np.zeros(brain_model.surface_number_of_vertices)
+        roi[vertices] = 1
+        smoothed = smooth_surface_data(surface_data, surf, sigma, roi)
+        return smoothed[vertices, :].T
+    operator = build_volume_operator(brain_model.voxel_indices_ijk,
+                                     volume_affine, sigma)
+    return operator.apply(np.asarray(data).T).T
+
+def smooth_cifti(cifti_in, cifti_out, sigma, left_surface, right_surface):
+    '''
+    in-process replacement of wb_command -cifti-smoothing (COLUMN direction,
+    with the same sigma for the surface and volume)
+    '''
+    img = nib.load(cifti_in)
+    index_map = img.header.get_index_map(1)
+    brain_models = list(index_map.brain_models)
+    volume_affine = cifti_volume_affine(index_map)
+    data = img.get_data()
+    smoothed = smooth_cifti_data(data, brain_models, volume_affine, sigma,
+                                 left_surface, right_surface)
+    out_img = nib.Cifti2Image(smoothed, header = img.header,
+                              nifti_header = img.nifti_header)
+    out_img.to_filename(cifti_out)
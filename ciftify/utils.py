@@ -13,6 +13,10 @@ import tempfile
 import shutil
 import logging
 import math
+import hashlib
+import time
+import resource
+import contextlib
 import yaml
 
 import ciftify
@@ -96,6 +100,14 @@ def check_input_readable(path, exit_on_error = True):
             sys.exit(1)
     return(path)
 
+def file_hash(path):
+    '''the sha1 hash (hex digest) of the contents of a file'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
 def log_arguments(arguments):
     '''send a formatted version of the arguments to the logger'''
     logger = logging.getLogger(__name__)
@@ -443,6 +455,68 @@ class cd(object):
     def __exit__(self, e, value, traceback):
         os.chdir(self.old_path)
 
+class StageProfiler(object):
+    """
+    Records the wall time, cpu time (of the process and its child processes)
+    and peak resident memory of named stages of a command. Use the stage()
+    context manager around each stage; repeated stages are summed.
+
+    The peak RSS is the high-water mark of the process at the end of the
+    stage (it includes the stages before it).
+    """
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = self.__cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0,
+                                                  'peak_rss_mb': 0.0, 'calls': 0})
+            stage['wall_s'] += time.perf_counter() - wall_start
+            stage['cpu_s'] += self.__cpu_time() - cpu_start
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], self.__peak_rss_mb())
+            stage['calls'] += 1
+
+    def as_dict(self):
+        """the stages (in the order they were first run), times rounded to ms"""
+        return {name: {key: round(value, 3) for key, value in stage.items()}
+                for name, stage in self.stages.items()}
+
+    def __cpu_time(self):
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                     resource.RUSAGE_CHILDREN)]
+        return sum(u.ru_utime + u.ru_stime for u in usage)
+
+    def __peak_rss_mb(self):
+        ## ru_maxrss is in kilobytes on linux (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak = peak / 1024
+        return peak / 1024
+
+def summarise_profiles(profiles):
+    """
+    the total wall and cpu time and the largest peak RSS of each stage of
+    a list of StageProfiler.as_dict() profiles
+    """
+    summary = {}
+    for profile in profiles:
+        for name, stage in profile.items():
+            total = summary.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0,
+                                              'peak_rss_mb': 0.0, 'runs': 0})
+            total['wall_s'] += stage['wall_s']
+            total['cpu_s'] += stage['cpu_s']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], stage['peak_rss_mb'])
+            total['runs'] += 1
+    for total in summary.values():
+        total['mean_wall_s'] = total['wall_s'] / total['runs']
+    return {name: {key: round(value, 3) for key, value in total.items()}
+            for name, total in summary.items()}
+
 def get_stdout(cmd_list, echo=True):
    ''' run the command given from the cmd list and report the stdout result
 
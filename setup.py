@@ -63,5 +63,9 @@ setup(
             'nilearn',
             'sklearn',
             'pybids'],
+    extras_require={
+            'numba': ['numba'],
+            'parquet': ['pyarrow'],
+            'hdf5': ['h5py']},
     include_package_data=True,
 )
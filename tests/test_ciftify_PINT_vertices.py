@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+from nose.tools import raises
+
+import ciftify.bin.ciftify_PINT_vertices as ciftify_PINT_vertices
+from ciftify.utils import TempDir
+
+logging.disable(logging.CRITICAL)
+
+def template_df():
+    return pd.DataFrame({'hemi': ['L', 'R', 'L', 'R'],
+                         'NETWORK': [2, 2, 7, 7],
+                         'roiidx': [1, 2, 3, 4],
+                         'tvertex': [10, 20, 30, 40]})
+
+class TestPINTState(unittest.TestCase):
+
+    def test_rois_hold_the_template(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex')
+        assert list(state.rois['vertex']) == [10, 20, 30, 40]
+        assert list(state.rois['hemi']) == ['L', 'R', 'L', 'R']
+        assert list(state.networks) == [2, 7]
+        assert list(state.network_rows[1]) == [2, 3]
+
+    def test_dataframe_has_last_distance_and_previous_vertex(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex')
+        state.record_iteration(np.array([11, 20, 30, 40]), np.array([2.0, 0, 0, 0]))
+        state.record_iteration(np.array([12, 20, 30, 40]), np.array([1.0, 0, 0, 0]))
+        df = state.to_dataframe()
+        assert state.vertex_history is None
+        assert list(df.vertex_0) == [11, 20, 30, 40]
+        assert list(df.dist_1) == [1.0, 0, 0, 0]
+        assert list(df.pvertex) == [12, 20, 30, 40]
+        assert 'vertex_1' not in df.columns
+
+    def test_history_is_kept_as_an_int32_array(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex',
+                                                keep_history = True)
+        state.record_iteration(np.array([11, 20, 30, 40]), np.array([2.0, 0, 0, 0]))
+        state.record_iteration(np.array([12, 20, 30, 40]), np.array([1.0, 0, 0, 0]))
+        assert state.vertex_history.shape == (2, 4)
+        assert state.vertex_history.dtype == np.int32
+        df = state.to_dataframe()
+        assert list(df.columns[4:]) == ['vertex_0', 'dist_0', 'vertex_1', 'dist_1',
+                                        'pvertex', 'distance']
+
+class TestPINTTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.vertices = np.array([10, 20, 30, 40])
+
+    def record_cycle(self, trace, iterations):
+        '''roi 1 cycles between vertices 10 and 11, the others stay put'''
+        for i in range(iterations):
+            new_vertices = self.vertices.copy()
+            new_vertices[0] = 11 if self.vertices[0] == 10 else 10
+            distances = np.array([1.5, 0, 0, 0])
+            record = trace.record(self.vertices, new_vertices, distances, {'rois': 0.1})
+            self.vertices = new_vertices
+        return record
+
+    def test_oscillating_rois_are_detected(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex')
+        trace = ciftify_PINT_vertices.PINTTrace(state)
+        record = self.record_cycle(trace, 3)
+        assert trace.iterations[0]['oscillating'] == 0
+        assert record['oscillating_rois'] == [1]
+        assert record['vertices_moved'] == 1
+        assert record['distance_histogram'] == [3, 1, 0, 0, 0, 0, 0]
+        assert record['rois_seconds'] == 0.1
+
+    def test_stops_after_oscillating_iterations(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex')
+        trace = ciftify_PINT_vertices.PINTTrace(state, stop_oscillating = 3)
+        self.record_cycle(trace, 3)
+        assert trace.check_stop() is None
+        self.record_cycle(trace, 1)
+        assert trace.check_stop() == 'oscillating'
+
+    def test_stops_on_plateau(self):
+        state = ciftify_PINT_vertices.PINTState(template_df(), 'tvertex')
+        trace = ciftify_PINT_vertices.PINTTrace(state, stop_plateau = 2)
+        self.record_cycle(trace, 2)
+        assert trace.check_stop() is None
+        self.record_cycle(trace, 1)
+        assert trace.check_stop() == 'plateau'
+
+class TestReadSweepGrid(unittest.TestCase):
+
+    class settings(object):
+        sampling_radius = 6.0
+        search_radius = 6.0
+        padding_radius = 12.0
+
+    def test_missing_radii_come_from_settings(self):
+        with TempDir() as tmpdir:
+            sweep_csv = os.path.join(tmpdir, 'sweep.csv')
+            pd.DataFrame({'search_radius': [6, 8, 8]}).to_csv(sweep_csv, index = False)
+            grid = ciftify_PINT_vertices.read_sweep_grid(sweep_csv, self.settings)
+        assert list(grid.config) == ['sampling6_search6_padding12',
+                                     'sampling6_search8_padding12']
+        assert list(grid.padding_radius) == [12.0, 12.0]
+
+    @raises(SystemExit)
+    def test_exits_on_unknown_columns(self):
+        with TempDir() as tmpdir:
+            sweep_csv = os.path.join(tmpdir, 'sweep.csv')
+            pd.DataFrame({'search_radii': [6, 8]}).to_csv(sweep_csv, index = False)
+            ciftify_PINT_vertices.read_sweep_grid(sweep_csv, self.settings)
+
+class TestBatch(unittest.TestCase):
+
+    def test_default_outputprefix_is_the_func_basename(self):
+        with TempDir() as tmpdir:
+            manifest = os.path.join(tmpdir, 'manifest.csv')
+            pd.DataFrame({'func': ['sub-01/rest.dtseries.nii',
+                                   'sub-02/task.dtseries.nii']}).to_csv(manifest, index = False)
+            batch_df = ciftify_PINT_vertices.read_batch_manifest(manifest, 'out')
+        assert list(batch_df.outputprefix) == ['out/rest', 'out/task']
+
+    @raises(SystemExit)
+    def test_exits_if_func_basenames_collide(self):
+        with TempDir() as tmpdir:
+            manifest = os.path.join(tmpdir, 'manifest.csv')
+            pd.DataFrame({'func': ['sub-01/rest.dtseries.nii',
+                                   'sub-02/rest.dtseries.nii']}).to_csv(manifest, index = False)
+            ciftify_PINT_vertices.read_batch_manifest(manifest, 'out')
+
+    def test_unwritable_outputprefix_fails_only_its_run(self):
+        with TempDir() as tmpdir:
+            not_a_dir = os.path.join(tmpdir, 'file')
+            open(not_a_dir, 'w').close()
+            output_prefix = os.path.join(not_a_dir, 'sub-01', 'rest')
+            result = ciftify_PINT_vertices.run_batch_subject(('rest.dtseries.nii',
+                                                              output_prefix))
+        assert result[2] == 'failed'
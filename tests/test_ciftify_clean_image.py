@@ -16,7 +16,11 @@ from nibabel import Nifti1Image
 import numpy as np
 import nilearn.image
 
+import nibabel as nib
+
 import ciftify.bin.ciftify_clean_img as ciftify_clean_img
+import ciftify.smoothing
+from ciftify.utils import TempDir
 
 logging.disable(logging.CRITICAL)
 
@@ -31,6 +35,8 @@ class TestUserSettings(unittest.TestCase):
       '--output-file': None,
       '--clean-config': None,
       '--drop-dummy-TRs': None,
+      '--drop-trailing-TRs': None,
+      '--segment-length': None,
       '--no-cleaning': False,
       '--detrend': False,
       '--standardize': False,
@@ -42,9 +48,20 @@ class TestUserSettings(unittest.TestCase):
       '--low-pass': None,
       '--high-pass': None,
       '--tr': '2.0',
+      '--chunk-size': None,
+      '--cache-dir': None,
+      '--profile': False,
+      '--censor-fd': None,
+      '--censor-dvars': None,
+      '--fd-col': None,
+      '--dvars-col': None,
+      '--interpolation': None,
+      '--drop-censored-TRs': False,
       '--smooth-fwhm': None,
       '--left-surface': None,
-      '--right-surface': None }
+      '--right-surface': None,
+      '--batch-manifest': None,
+      '--n_cpus': None }
     json_config = '''
     {
       "--detrend": true,
@@ -246,6 +263,7 @@ class TestMangleConfounds(unittest.TestCase):
         def __init__(self, start_from, confounds,
             cf_cols, cf_sq_cols, cf_td_cols, cf_sqtd_cols):
             self.start_from_tr = start_from
+            self.drop_trailing_trs = 0
             self.confounds = confounds
             self.cf_cols = cf_cols
             self.cf_sq_cols = cf_sq_cols
@@ -362,6 +380,312 @@ class TestCleanImage(unittest.TestCase):
 
         nilearn_clean.assert_not_called()
 
+def write_test_dtseries(filename, n_timepoints = 40, seed = 0):
+    '''a small random dtseries (10 surface vertices and 8 voxels) with a TR of 2'''
+    brain_models = (nib.cifti2.BrainModelAxis.from_mask(np.ones(10, bool), name = 'CortexLeft') +
+        nib.cifti2.BrainModelAxis.from_mask(np.ones((2, 2, 2), bool),
+                                            name = 'thalamus_left', affine = np.eye(4)))
+    series = nib.cifti2.SeriesAxis(0, 2.0, n_timepoints)
+    data = np.random.RandomState(seed).randn(n_timepoints, 18).astype(np.float32) + 100
+    header = nib.cifti2.Cifti2Header.from_axes((series, brain_models))
+    nib.Cifti2Image(data, header = header).to_filename(filename)
+    return data
+
+class CleaningSettingsStub(object):
+    def __init__(self, func_path, output_func, confounds = None):
+        self.func = ciftify_clean_img.NibInput(func_path)
+        self.func.tr = 2.0
+        self.output_func = output_func
+        self.start_from_tr = 2
+        self.drop_trailing_trs = 0
+        self.censor = None
+        self.profile = None
+        self.detrend = True
+        self.standardize = True
+        self.high_pass = 0.01
+        self.low_pass = 0.1
+        self.confounds = confounds
+        self.cf_cols = ['x'] if confounds is not None else []
+        self.cf_sq_cols = []
+        self.cf_td_cols = []
+        self.cf_sqtd_cols = []
+        self.smooth = ciftify_clean_img.Smoothing(None, 'cifti', None, None)
+        self.chunk_size = None
+
+class TestCleanCifti(unittest.TestCase):
+
+    confounds = pd.DataFrame({'x': np.random.RandomState(1).randn(40)})
+
+    def test_matches_cleaning_the_fake_nifti(self):
+        with TempDir() as tmpdir:
+            func = os.path.join(tmpdir, 'func.dtseries.nii')
+            data = write_test_dtseries(func)
+            settings = CleaningSettingsStub(func, os.path.join(tmpdir, 'clean.dtseries.nii'),
+                                            self.confounds)
+            confound_signals = ciftify_clean_img.mangle_confounds(settings)
+            ciftify_clean_img.clean_cifti(settings, confound_signals, tmpdir)
+            output = nib.load(settings.output_func)
+            clean_data = output.get_fdata()
+            series = output.header.get_axis(0)
+
+        fake_nifti = Nifti1Image(data[2:, :].T.reshape(18, 1, 1, 38), affine = np.eye(4))
+        expected = nilearn.image.clean_img(fake_nifti, detrend = True, standardize = True,
+                        confounds = confound_signals.values, low_pass = 0.1,
+                        high_pass = 0.01, t_r = 2.0)
+        assert np.allclose(clean_data, expected.get_fdata().reshape(18, 38).T, atol = 1e-5)
+        assert series.size == 38
+        assert series.step == 2.0
+        assert series.start == 2.0
+
+    def test_chunked_cleaning_matches_cleaning_at_once(self):
+        outputs = []
+        with TempDir() as tmpdir:
+            func = os.path.join(tmpdir, 'func.dtseries.nii')
+            write_test_dtseries(func)
+            for chunk_size in (None, 4):
+                settings = CleaningSettingsStub(func,
+                        os.path.join(tmpdir, 'clean{}.dtseries.nii'.format(chunk_size)),
+                        self.confounds)
+                settings.chunk_size = chunk_size
+                confound_signals = ciftify_clean_img.mangle_confounds(settings)
+                ciftify_clean_img.clean_cifti(settings, confound_signals, tmpdir)
+                outputs.append(nib.load(settings.output_func).get_fdata())
+        assert outputs[1].shape == (38, 18)
+        ## nilearn cleans the float32 data in float32, the chunks are cleaned in float64
+        assert np.allclose(outputs[0], outputs[1], atol = 1e-4)
+
+    @patch('ciftify.smoothing.get_surface_operator')
+    def test_fused_smoothing_matches_smoothing_the_cleaned_output(self, mock_operator):
+        kernel = np.exp(-np.abs(np.subtract.outer(np.arange(10), np.arange(10))))
+        mock_operator.return_value = ciftify.smoothing.SmoothingOperator(kernel, 1.0)
+        with TempDir() as tmpdir:
+            func = os.path.join(tmpdir, 'func.dtseries.nii')
+            write_test_dtseries(func)
+            settings = CleaningSettingsStub(func, os.path.join(tmpdir, 'clean.dtseries.nii'),
+                                            self.confounds)
+            confound_signals = ciftify_clean_img.mangle_confounds(settings)
+            ciftify_clean_img.clean_cifti(settings, confound_signals, tmpdir)
+            cleaned = nib.load(settings.output_func)
+            settings.smooth = ciftify_clean_img.Smoothing(None, 'cifti', 'L.surf.gii', None)
+            settings.smooth.fwhm, settings.smooth.sigma = 2.0, 0.85
+            settings.output_func = os.path.join(tmpdir, 'clean_s2.dtseries.nii')
+            ciftify_clean_img.clean_cifti(settings, confound_signals, tmpdir)
+            smoothed = nib.load(settings.output_func).get_fdata()
+            index_map = cleaned.header.get_index_map(1)
+            expected = ciftify.smoothing.smooth_cifti_data(cleaned.get_fdata(),
+                    list(index_map.brain_models), np.eye(4), 0.85, 'L.surf.gii', None)
+        assert np.allclose(smoothed, expected, atol = 1e-5)
+        assert not np.allclose(smoothed, cleaned.get_fdata(), atol = 1e-3)
+
+class TestCleanNiftiInChunks(unittest.TestCase):
+
+    confounds = pd.DataFrame({'x': np.arange(40.0) ** 0.5})
+
+    def test_chunked_cleaning_matches_cleaning_at_once(self):
+        data = np.random.RandomState(0).randn(5, 4, 3, 40).astype(np.float32) + 100
+        with TempDir() as tmpdir:
+            for func in ('func.nii', 'func.nii.gz'):
+                func = os.path.join(tmpdir, func)
+                Nifti1Image(data, affine = np.eye(4)).to_filename(func)
+                settings = CleaningSettingsStub(func, None, self.confounds)
+                settings.chunk_size = 20
+                confound_signals = ciftify_clean_img.mangle_confounds(settings)
+                nib_image = nib.load(func)
+                chunked = ciftify_clean_img.clean_nifti_in_chunks(nib_image,
+                        confound_signals, settings, tmpdir)
+                expected = ciftify_clean_img.clean_image_with_nilearn(
+                        ciftify_clean_img.image_drop_dummy_trs(nib_image, 2),
+                        confound_signals, settings)
+                assert chunked.shape == (5, 4, 3, 38)
+                assert np.allclose(chunked.get_fdata(), expected.get_fdata(), atol = 1e-4)
+
+class TestTRWindows(unittest.TestCase):
+
+    def run_clean_img(self, tmpdir, **options):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments['<func_input>'] = os.path.join(tmpdir, 'func.dtseries.nii')
+        arguments['--detrend'] = True
+        arguments.update(options)
+        write_test_dtseries(arguments['<func_input>'])
+        ciftify_clean_img.run_ciftify_clean_img(arguments, tmpdir)
+
+    def test_trailing_TRs_are_dropped(self):
+        with TempDir() as tmpdir:
+            self.run_clean_img(tmpdir, **{'--drop-dummy-TRs': '2',
+                                          '--drop-trailing-TRs': '5'})
+            output = nib.load(os.path.join(tmpdir, 'func_clean_s0.dtseries.nii'))
+            series = output.header.get_axis(0)
+        assert series.size == 33
+        assert series.start == 2.0
+
+    def test_segments_are_cleaned_separately(self):
+        with TempDir() as tmpdir:
+            self.run_clean_img(tmpdir, **{'--drop-dummy-TRs': '2',
+                                          '--drop-trailing-TRs': '3',
+                                          '--segment-length': '20'})
+            series = [nib.load(os.path.join(tmpdir,
+                        'func_clean_s0_seg-{}.dtseries.nii'.format(n))).header.get_axis(0)
+                      for n in (1, 2)]
+            sidecar = ciftify_clean_img.load_json_file(
+                    os.path.join(tmpdir, 'func_clean_s0.json'))
+        assert [axis.size for axis in series] == [20, 15]
+        assert [axis.start for axis in series] == [2.0, 22.0]
+        assert sidecar['segments'][1]['first_TR'] == 22
+        assert sidecar['segments'][1]['last_TR'] == 36
+
+    def test_a_last_single_TR_is_merged_into_the_segment_before(self):
+        with TempDir() as tmpdir:
+            self.run_clean_img(tmpdir, **{'--drop-dummy-TRs': '2',
+                                          '--drop-trailing-TRs': '1',
+                                          '--segment-length': '12'})
+            outputs = sorted(name for name in os.listdir(tmpdir) if '_seg-' in name)
+            series = [nib.load(os.path.join(tmpdir, output)).header.get_axis(0)
+                      for output in outputs]
+        assert len(outputs) == 3
+        assert [axis.size for axis in series] == [12, 12, 13]
+
+    def test_censored_TRs_are_dropped(self):
+        with TempDir() as tmpdir:
+            confounds = os.path.join(tmpdir, 'confounds.tsv')
+            fd = np.zeros(40)
+            fd[[1, 10, 11, 25]] = 0.9
+            fd[0] = np.nan
+            pd.DataFrame({'framewise_displacement': fd,
+                          'x': np.random.RandomState(1).randn(40)}).to_csv(
+                    confounds, sep = '\t', index = False)
+            self.run_clean_img(tmpdir, **{'--drop-dummy-TRs': '2',
+                    '--confounds-tsv': confounds, '--cf-cols': 'x',
+                    '--low-pass': '0.1', '--censor-fd': '0.5',
+                    '--drop-censored-TRs': True})
+            output = nib.load(os.path.join(tmpdir, 'func_clean_s0.dtseries.nii'))
+            sidecar = ciftify_clean_img.load_json_file(
+                    os.path.join(tmpdir, 'func_clean_s0.json'))
+        assert sidecar['censored_TRs'] == [10, 11, 25]
+        assert output.shape == (35, 18)
+
+    def test_confounds_are_windowed(self):
+        settings = TestMangleConfounds.SettingsStub(start_from = 1,
+                confounds = TestMangleConfounds.input_signals, cf_cols = ['x'],
+                cf_sq_cols = [], cf_td_cols = ['x'], cf_sqtd_cols = [])
+        settings.drop_trailing_trs = 1
+        confound_signals = ciftify_clean_img.mangle_confounds(settings)
+        assert list(confound_signals['x']) == [2, 3, 4]
+        assert list(confound_signals['x_lag']) == [0, 1, 1]
+
+class TestResultCache(unittest.TestCase):
+
+    def clean_img(self, tmpdir, output, **options):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments.update({'<func_input>': os.path.join(tmpdir, 'func.dtseries.nii'),
+                          '--output-file': os.path.join(tmpdir, output),
+                          '--cache-dir': os.path.join(tmpdir, 'cache'),
+                          '--detrend': True})
+        arguments.update(options)
+        ciftify_clean_img.run_ciftify_clean_img(arguments, tmpdir)
+        return arguments['--output-file']
+
+    def test_identical_requests_reuse_the_cached_output(self):
+        with TempDir() as tmpdir:
+            write_test_dtseries(os.path.join(tmpdir, 'func.dtseries.nii'))
+            first = self.clean_img(tmpdir, 'first.dtseries.nii')
+            with patch('ciftify.bin.ciftify_clean_img.clean_tr_window') as mock_clean:
+                second = self.clean_img(tmpdir, 'second.dtseries.nii',
+                                        **{'--tr': '2', '--verbose': True})
+                mock_clean.assert_not_called()
+            assert os.path.samefile(first, second)
+            assert len(os.listdir(os.path.join(tmpdir, 'cache'))) == 1
+
+    def test_changed_settings_are_cleaned_again(self):
+        with TempDir() as tmpdir:
+            write_test_dtseries(os.path.join(tmpdir, 'func.dtseries.nii'))
+            first = self.clean_img(tmpdir, 'first.dtseries.nii')
+            second = self.clean_img(tmpdir, 'second.dtseries.nii',
+                                    **{'--standardize': True})
+            assert not os.path.samefile(first, second)
+            assert len(os.listdir(os.path.join(tmpdir, 'cache'))) == 2
+
+    def test_rerun_to_the_same_output_keeps_the_cached_output(self):
+        with TempDir() as tmpdir:
+            write_test_dtseries(os.path.join(tmpdir, 'func.dtseries.nii'))
+            output = self.clean_img(tmpdir, 'clean.dtseries.nii')
+            detrended = nib.load(output).get_fdata()
+            self.clean_img(tmpdir, 'clean.dtseries.nii', **{'--standardize': True})
+            assert not np.allclose(nib.load(output).get_fdata(), detrended)
+            with patch('ciftify.bin.ciftify_clean_img.clean_tr_window') as mock_clean:
+                self.clean_img(tmpdir, 'clean.dtseries.nii')
+                mock_clean.assert_not_called()
+            assert np.allclose(nib.load(output).get_fdata(), detrended)
+
+class TestBatch(unittest.TestCase):
+
+    def test_failed_runs_do_not_stop_the_batch(self):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments.update({'<func_input>': None, '--detrend': True,
+                          '--drop-dummy-TRs': '2', '--chunk-size': '4'})
+        with TempDir() as tmpdir:
+            funcs = [os.path.join(tmpdir, 'sub-{}.dtseries.nii'.format(sub))
+                     for sub in ('01', '02')]
+            write_test_dtseries(funcs[0])
+            confounds = os.path.join(tmpdir, 'confounds.tsv')
+            pd.DataFrame({'x': np.random.RandomState(1).randn(40)}).to_csv(
+                    confounds, sep = '\t', index = False)
+            arguments['--batch-manifest'] = os.path.join(tmpdir, 'manifest.tsv')
+            arguments['--cf-cols'] = 'x'
+            pd.DataFrame({'func': funcs, 'confounds': [confounds, confounds]}).to_csv(
+                    arguments['--batch-manifest'], sep = '\t', index = False)
+            ret = ciftify_clean_img.run_batch(arguments)
+            output = os.path.join(tmpdir, 'sub-01_clean_s0.dtseries.nii')
+            assert os.path.exists(output)
+            assert nib.load(output).shape == (38, 18)
+            sidecar = ciftify_clean_img.load_json_file(
+                    os.path.join(tmpdir, 'sub-01_clean_s0.json'))
+        assert ret == 1
+        assert sidecar['batch']['status'] == 'succeeded'
+        assert sidecar['--confounds-tsv'] == confounds
+
+    def test_empty_confounds_cells_mean_no_confounds(self):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments.update({'<func_input>': None, '--detrend': True})
+        with TempDir() as tmpdir:
+            funcs = [os.path.join(tmpdir, 'sub-{}.dtseries.nii'.format(sub))
+                     for sub in ('01', '02')]
+            for func in funcs:
+                write_test_dtseries(func)
+            confounds = os.path.join(tmpdir, 'confounds.tsv')
+            pd.DataFrame({'x': np.random.RandomState(1).randn(40)}).to_csv(
+                    confounds, sep = '\t', index = False)
+            arguments['--confounds-tsv'] = confounds
+            arguments['--cf-cols'] = 'x'
+            arguments['--batch-manifest'] = os.path.join(tmpdir, 'manifest.tsv')
+            pd.DataFrame({'func': funcs, 'confounds': [confounds, None]}).to_csv(
+                    arguments['--batch-manifest'], sep = '\t', index = False)
+            ret = ciftify_clean_img.run_batch(arguments)
+            sidecars = [ciftify_clean_img.load_json_file(os.path.join(tmpdir,
+                            'sub-{}_clean_s0.json'.format(sub))) for sub in ('01', '02')]
+        assert ret == 0
+        assert sidecars[0]['--confounds-tsv'] == confounds
+        assert sidecars[1]['--confounds-tsv'] is None
+
+    def test_profiles_are_summarised_over_the_batch(self):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments.update({'<func_input>': None, '--detrend': True, '--profile': True})
+        with TempDir() as tmpdir:
+            funcs = [os.path.join(tmpdir, 'sub-{}.dtseries.nii'.format(sub))
+                     for sub in ('01', '02')]
+            for func in funcs:
+                write_test_dtseries(func)
+            arguments['--batch-manifest'] = os.path.join(tmpdir, 'manifest.tsv')
+            pd.DataFrame({'func': funcs}).to_csv(arguments['--batch-manifest'],
+                                                 sep = '\t', index = False)
+            ciftify_clean_img.run_batch(arguments)
+            sidecar = ciftify_clean_img.load_json_file(
+                    os.path.join(tmpdir, 'sub-01_clean_s0.json'))
+            summary = ciftify_clean_img.load_json_file(
+                    os.path.join(tmpdir, 'manifest_profile.json'))
+        assert sorted(sidecar['profile']) == ['clean', 'confounds', 'write']
+        assert summary['stages']['clean']['runs'] == 2
+        assert summary['stages']['write']['peak_rss_mb'] > 0
+
 def test_drop_image():
     img1 = Nifti1Image(np.ones((2, 2, 2, 1)), affine=np.eye(4))
     img2 = Nifti1Image(np.ones((2, 2, 2, 1)) + 1, affine=np.eye(4))
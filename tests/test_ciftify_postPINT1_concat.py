@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import pandas as pd
+from nose.tools import raises
+
+import ciftify.bin.ciftify_postPINT1_concat as concat
+from ciftify.utils import TempDir
+
+logging.disable(logging.CRITICAL)
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ['subid', 'hemi', 'NETWORK', 'roiidx', 'tvertex', 'pvertex',
+           'dist_49', 'vertex_48', 'std_distance']
+
+def concat_df(subid):
+    return pd.DataFrame([[subid, 'L', 7, 1, 10, 12, 1.5, 11, 2.0]], columns = COLUMNS)
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestParquetColumns(unittest.TestCase):
+
+    def test_matching_columns_can_be_appended(self):
+        with TempDir() as tmpdir:
+            parquet_dir = os.path.join(tmpdir, 'concat')
+            concat.append_to_parquet(concat_df('sub-01'), parquet_dir)
+            concat.check_parquet_columns(parquet_dir, COLUMNS)
+            concat.append_to_parquet(concat_df('sub-02'), parquet_dir)
+            assert concat.read_parquet_subids(parquet_dir) == {'sub-01', 'sub-02'}
+
+    @raises(SystemExit)
+    def test_exits_if_distances_were_not_calculated_for_the_dataset(self):
+        with TempDir() as tmpdir:
+            parquet_dir = os.path.join(tmpdir, 'concat')
+            concat.append_to_parquet(concat_df('sub-01').drop(columns = 'std_distance'),
+                                     parquet_dir)
+            concat.check_parquet_columns(parquet_dir, COLUMNS)
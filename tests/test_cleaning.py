@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+import nilearn.signal
+from nose.tools import raises
+
+import ciftify.cleaning as cleaning
+
+logging.disable(logging.CRITICAL)
+
+class TestSignalCleaner(unittest.TestCase):
+
+    rng = np.random.RandomState(3)
+    signals = rng.randn(60, 25) + np.linspace(0, 5, 60).reshape(-1, 1)
+    confounds = rng.randn(60, 3)
+
+    def check_matches_nilearn(self, detrend = False, standardize = False, **kwargs):
+        kwargs.update(detrend = detrend, standardize = standardize)
+        expected = nilearn.signal.clean(self.signals.copy(), t_r = 2.0,
+                                        ensure_finite = False, **kwargs)
+        cleaner = cleaning.SignalCleaner(60, 2.0, **kwargs)
+        assert np.allclose(cleaner.clean(self.signals), expected)
+        assert np.allclose(cleaner.clean_chunks(self.signals, 7), expected, atol = 1e-5)
+
+    def test_matches_nilearn_with_all_steps(self):
+        self.check_matches_nilearn(confounds = self.confounds, detrend = True,
+                                   standardize = True, low_pass = 0.1, high_pass = 0.01)
+
+    def test_matches_nilearn_with_only_confounds(self):
+        self.check_matches_nilearn(confounds = self.confounds)
+
+    def test_matches_nilearn_with_repeated_confounds(self):
+        confounds = np.hstack((self.confounds, self.confounds[:, :1]))
+        self.check_matches_nilearn(confounds = confounds, detrend = True,
+                                   high_pass = 0.01)
+
+    def test_chunks_of_a_timepoint_window(self):
+        cleaner = cleaning.SignalCleaner(50, 2.0, detrend = True, low_pass = 0.1)
+        result = cleaner.clean_chunks(self.signals, 10, timepoints = slice(10, None))
+        assert result.shape == (50, 25)
+        assert np.allclose(result, cleaner.clean(self.signals[10:, :]), atol = 1e-5)
+
+    def test_no_filter_without_cutoffs(self):
+        assert cleaning.butterworth_coefficients(2.0) is None
+
+    @raises(ValueError)
+    def test_high_pass_above_low_pass_raises(self):
+        cleaning.butterworth_coefficients(2.0, low_pass = 0.01, high_pass = 0.1)
+
+class TestCensoring(unittest.TestCase):
+
+    rng = np.random.RandomState(4)
+    signals = rng.randn(60, 5)
+    confounds = rng.randn(60, 2)
+    sample_mask = np.ones(60, dtype = bool)
+    sample_mask[[0, 10, 11, 30, 59]] = False
+
+    def test_confounds_are_regressed_from_the_kept_timepoints(self):
+        cleaner = cleaning.SignalCleaner(60, 2.0, confounds = self.confounds,
+                                         sample_mask = self.sample_mask)
+        kept_confounds = self.confounds[self.sample_mask]
+        kept_confounds = (kept_confounds - kept_confounds.mean(axis = 0)) / kept_confounds.std(axis = 0)
+        betas = np.linalg.lstsq(kept_confounds, self.signals[self.sample_mask], rcond = None)[0]
+        expected = self.signals[self.sample_mask] - kept_confounds.dot(betas)
+        assert np.allclose(cleaner.clean(self.signals)[self.sample_mask], expected)
+
+    def test_censored_timepoints_are_dropped(self):
+        cleaner = cleaning.SignalCleaner(60, 2.0, detrend = True, low_pass = 0.1,
+                        sample_mask = self.sample_mask, drop_censored = True)
+        assert cleaner.n_output_timepoints == 55
+        assert cleaner.clean_chunks(self.signals, 2).shape == (55, 5)
+
+    def test_cubic_interpolation_of_a_smooth_signal(self):
+        times = np.arange(60, dtype = float)
+        data = np.vstack((np.sin(times / 5.), np.cos(times / 7.))).T
+        interpolated = cleaning.interpolate_censored(data.copy(), self.sample_mask)
+        assert np.allclose(interpolated[1:59], data[1:59], atol = 1e-3)
+        assert np.allclose(interpolated[0], data[1])
+
+    def test_lombscargle_interpolation_only_replaces_censored_timepoints(self):
+        data = self.signals + 3
+        interpolated = cleaning.interpolate_censored(data.copy(), self.sample_mask,
+                                                     method = 'lombscargle')
+        assert np.allclose(interpolated[self.sample_mask], data[self.sample_mask])
+        censored = interpolated[~self.sample_mask]
+        assert np.all(censored >= data[self.sample_mask].min(axis = 0))
+        assert np.all(censored <= data[self.sample_mask].max(axis = 0))
+
+class TestExpandConfounds(unittest.TestCase):
+
+    confounds = pd.DataFrame({'x': [1., 2., 4., 7., np.nan, 16.],
+                              'y': [0., 1., 0., 1., 0., 1.]})
+
+    def test_matches_pandas_expansion(self):
+        terms = cleaning.expansion_terms(['x', 'y'])
+        design, names = cleaning.expand_confounds(self.confounds, terms, start = 1)
+        df = self.confounds.iloc[1:, :]
+        expected = pd.concat([df, df ** 2, df.diff(), df.diff() ** 2], axis = 1).fillna(0)
+        assert names == ['x', 'y', 'x_sq', 'y_sq', 'x_lag', 'y_lag', 'x_sqlag', 'y_sqlag']
+        assert design.flags['C_CONTIGUOUS']
+        assert np.allclose(design, expected.values)
+
+    def test_higher_derivatives_and_powers(self):
+        design, names = cleaning.expand_confounds(self.confounds,
+                                                  [('x', 2, 1), ('x', 0, 3)])
+        assert names == ['x_lag2', 'x_pow3']
+        assert np.allclose(design[:, 0], [0, 0, 1, 1, 0, 0])
+        assert np.allclose(design[:, 1], [1, 8, 64, 343, 0, 4096])
+
+    def test_expansion_terms_of_the_24_parameter_model(self):
+        terms = cleaning.expansion_terms(['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ'])
+        assert len(terms) == 24
+        assert terms[-1] == ('RotZ', 1, 2)
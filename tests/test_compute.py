@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import unittest
+import logging
+
+import numpy as np
+from mock import patch
+
+import ciftify.compute as compute
+
+logging.disable(logging.CRITICAL)
+
+def lstsq_partial_corr(x, data, confounds):
+    '''the partial correlation as it was calculated before ciftify.compute'''
+    pre_res = np.vstack((x, data))
+    res_by_z = np.zeros(pre_res.shape)
+    for i in range(pre_res.shape[0]):
+        betas = np.linalg.lstsq(confounds, pre_res[i,:], rcond = None)[0]
+        res_by_z[i,:] = pre_res[i,:] - confounds.dot(betas)
+    return np.corrcoef(res_by_z)[0, 1:]
+
+class TestKernels(unittest.TestCase):
+
+    rng = np.random.RandomState(42)
+    data = rng.randn(50, 30).astype(np.float32)
+    x = rng.randn(30)
+    confounds = rng.randn(30, 4)
+    mask = np.array([3, 7, 8, 20, 41])
+
+    def test_masked_corr_matches_corrcoef(self):
+        expected = np.corrcoef(self.x, self.data[self.mask, :])[0, 1:]
+        for backend in compute.available_backends():
+            result = compute.masked_corr(self.x, self.data, self.mask, backend = backend)
+            assert np.allclose(result, expected), backend
+
+    def test_masked_corr_of_constant_row_is_nan(self):
+        data = self.data.copy()
+        data[3, :] = 1
+        for backend in compute.available_backends():
+            result = compute.masked_corr(self.x, data, self.mask, backend = backend)
+            assert np.isnan(result[0]), backend
+            assert not np.any(np.isnan(result[1:])), backend
+
+    def test_partial_corr_matches_lstsq_residuals(self):
+        expected = lstsq_partial_corr(self.x, self.data[self.mask, :], self.confounds)
+        for backend in compute.available_backends():
+            result = compute.partial_corr(self.x, self.data, self.confounds,
+                                          self.mask, backend = backend)
+            assert np.allclose(result, expected), backend
+
+    def test_partial_corr_with_repeated_confounds(self):
+        confounds = np.hstack((self.confounds, self.confounds[:, :1]))
+        expected = lstsq_partial_corr(self.x, self.data[self.mask, :], confounds)
+        for backend in compute.available_backends():
+            result = compute.partial_corr(self.x, self.data, confounds,
+                                          self.mask, backend = backend)
+            assert np.allclose(result, expected), backend
+
+    def test_roi_means_match_numpy_means(self):
+        labels = self.rng.randint(0, 4, 50)
+        labels[labels == 2] = 0
+        for backend in compute.available_backends():
+            result = compute.roi_means(self.data, labels, [3, 1, 2], backend = backend)
+            assert np.allclose(result[0], self.data[labels == 3].mean(axis = 0)), backend
+            assert np.allclose(result[1], self.data[labels == 1].mean(axis = 0)), backend
+            assert np.all(np.isnan(result[2])), backend
+
+    def test_roi_means_default_to_sorted_nonzero_labels(self):
+        labels = np.zeros(50)
+        labels[:5] = 7
+        labels[5:10] = 2
+        for backend in compute.available_backends():
+            result = compute.roi_means(self.data, labels, backend = backend)
+            assert result.shape == (2, 30)
+            assert np.allclose(result[0], self.data[5:10].mean(axis = 0)), backend
+
+class TestSetBackend(unittest.TestCase):
+
+    def tearDown(self):
+        compute._BACKEND.clear()
+
+    def test_unknown_backend_falls_back_to_numpy(self):
+        assert compute.set_backend('cuda') == 'numpy'
+
+    @patch('ciftify.compute.numba', None)
+    def test_numba_falls_back_to_numpy_if_not_installed(self):
+        assert compute.set_backend('numba') == 'numpy'
+
+    @patch('ciftify.config.find_compute_backend', return_value = 'numpy')
+    def test_backend_read_from_environment(self, mock_env):
+        assert compute.get_backend() == 'numpy'
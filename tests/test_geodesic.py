@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+from mock import patch
+
+import ciftify.geodesic as geodesic
+from ciftify.utils import TempDir
+
+logging.disable(logging.CRITICAL)
+
+def flat_grid_mesh(n = 11):
+    '''a flat n x n grid of vertices 1mm apart, two triangles per square'''
+    xs, ys = np.meshgrid(np.arange(n), np.arange(n))
+    coords = np.column_stack((xs.ravel(), ys.ravel(), np.zeros(n * n)))
+    triangles = []
+    for i in range(n - 1):
+        for j in range(n - 1):
+            v = i * n + j
+            triangles.append([v, v + 1, v + n + 1])
+            triangles.append([v, v + n + 1, v + n])
+    return coords, np.array(triangles)
+
+def write_surface(filename, coords, triangles):
+    '''write a mesh to a .surf.gii file'''
+    img = nib.gifti.GiftiImage()
+    img.add_gifti_data_array(nib.gifti.GiftiDataArray(
+        coords.astype(np.float32), intent = 'NIFTI_INTENT_POINTSET'))
+    img.add_gifti_data_array(nib.gifti.GiftiDataArray(
+        triangles.astype(np.int32), intent = 'NIFTI_INTENT_TRIANGLE'))
+    nib.save(img, filename)
+
+class TestSurfaceGraph(unittest.TestCase):
+
+    coords, triangles = flat_grid_mesh()
+
+    def test_edge_distances_are_euclidean(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        distances = graph.distances([0])[0]
+        assert np.isclose(distances[1], 1)
+        assert np.isclose(distances[10], 10)
+
+    def test_diagonals_across_triangle_pairs_are_straight(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        distances = graph.distances([0])[0]
+        # vertex (x=1, y=2) is only reached in a straight line across two triangles
+        assert np.isclose(distances[2 * 11 + 1], np.sqrt(5))
+        assert np.isclose(distances[11 * 11 - 1], np.sqrt(2) * 10)
+
+    def test_limit_returns_inf_beyond_radius(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        distances = graph.distances([0], limit = 3)[0]
+        assert np.isinf(distances[10])
+
+    def test_vertex_distances_match_distance_fields(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        sources, targets = [0, 5, 60, 60], [120, 27, 61, 60]
+        expected = [graph.distances([s])[0][t] for s, t in zip(sources, targets)]
+        assert np.allclose(graph.vertex_distances(sources, targets), expected)
+
+    def test_vertex_distance_beyond_limit_is_inf(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        assert np.isinf(graph.vertex_distance(0, 10, limit = 3))
+        assert np.isclose(graph.vertex_distance(0, 3, limit = 3), 3)
+
+class TestNeighbourhoodIndex(unittest.TestCase):
+
+    coords, triangles = flat_grid_mesh()
+
+    def test_neighbours_include_vertex_itself(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        assert 60 in index.neighbours(60)
+        assert np.all(index.neighbour_distances(60) <= 2)
+
+    def test_restrict_matches_index_built_at_smaller_radius(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index3 = geodesic.build_neighbourhood_index(graph, 3)
+        index2 = geodesic.build_neighbourhood_index(graph, 2)
+        restricted = index3.restrict(2)
+        assert np.array_equal(restricted.offsets, index2.offsets)
+        assert np.array_equal(restricted.indices, index2.indices)
+
+    def test_roi_labels_exclude_overlapping_vertices(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        rois = index.roi_labels([60, 62], [1, 2])
+        # vertex 61 is 1mm from both centres
+        assert rois[61] == 0
+        assert rois[59] == 1
+        assert rois[63] == 2
+
+    def test_save_and_load_round_trip(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        index.surface_hash = 'abc'
+        with TempDir() as tmpdir:
+            index_file = os.path.join(tmpdir, 'index.npz')
+            index.save(index_file)
+            loaded = geodesic.NeighbourhoodIndex.load(index_file)
+        assert loaded.radius == 2
+        assert loaded.surface_hash == 'abc'
+        assert np.array_equal(loaded.indices, index.indices)
+        assert np.allclose(loaded.distances, index.distances)
+
+    def test_shared_memory_round_trip(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        blocks, description = index.to_shared_memory()
+        try:
+            shared = geodesic.NeighbourhoodIndex.from_shared_memory(description)
+            assert np.array_equal(shared.offsets, index.offsets)
+            assert np.array_equal(shared.indices, index.indices)
+            assert np.allclose(shared.distances, index.distances)
+            for block in shared.shared_blocks:
+                block.close()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+class TestGeodesicRois(unittest.TestCase):
+
+    coords, triangles = flat_grid_mesh()
+
+    def test_initial_labels_match_roi_labels(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        rois = geodesic.GeodesicRois(index, [12, 60, 62], [1, 2, 3])
+        assert np.array_equal(rois.labels, index.roi_labels([12, 60, 62], [1, 2, 3]))
+
+    def test_labels_after_move_match_rebuilt_rois(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        rois = geodesic.GeodesicRois(index, [12, 60, 62], [1, 2, 3])
+        touched = rois.move(3, 98)
+        assert 61 in touched
+        assert np.array_equal(rois.labels, index.roi_labels([12, 60, 98], [1, 2, 3]))
+        assert 61 in rois.members(2)
+
+    def test_move_to_same_vertex_touches_nothing(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        index = geodesic.build_neighbourhood_index(graph, 2)
+        rois = geodesic.GeodesicRois(index, [12, 60], [1, 2])
+        assert rois.move(2, 60).size == 0
+
+class TestGetNeighbourhoodIndex(unittest.TestCase):
+
+    coords, triangles = flat_grid_mesh()
+
+    def setUp(self):
+        geodesic._NEIGHBOURHOODS.clear()
+
+    def test_index_is_cached_on_disk_and_reused(self):
+        with TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'grid.surf.gii')
+            write_surface(surf, self.coords, self.triangles)
+            index = geodesic.get_neighbourhood_index(surf, 3, cache_dir = tmpdir)
+            cache_file = geodesic.neighbourhood_cache_file(tmpdir,
+                                geodesic.surface_hash(surf), 3)
+            assert os.path.exists(cache_file)
+
+            geodesic._NEIGHBOURHOODS.clear()
+            with patch('ciftify.geodesic.build_neighbourhood_index') as mock_build:
+                cached = geodesic.get_neighbourhood_index(surf, 2, cache_dir = tmpdir)
+            mock_build.assert_not_called()
+        assert cached.radius == 2
+        assert np.array_equal(cached.indices, index.restrict(2).indices)
+
+    def test_copies_of_a_surface_share_the_cached_index(self):
+        with TempDir() as tmpdir:
+            surf1 = os.path.join(tmpdir, 'grid1.surf.gii')
+            surf2 = os.path.join(tmpdir, 'grid2.surf.gii')
+            write_surface(surf1, self.coords, self.triangles)
+            write_surface(surf2, self.coords, self.triangles)
+            index1 = geodesic.get_neighbourhood_index(surf1, 2, cache_dir = tmpdir)
+            index2 = geodesic.get_neighbourhood_index(surf2, 2, cache_dir = tmpdir)
+        assert index1 is index2
+
+class TestGetDistancesFromSources(unittest.TestCase):
+
+    coords, triangles = flat_grid_mesh()
+
+    def test_pair_distances_match_distance_fields(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        sources, targets = [60, 0, 60, 5, 0], [61, 120, 60, 27, 10]
+        expected = [graph.distances([s])[0][t] for s, t in zip(sources, targets)]
+        with TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'grid.surf.gii')
+            write_surface(surf, self.coords, self.triangles)
+            distances = geodesic.get_distances_from_sources(surf, sources, targets,
+                                                            chunk_size = 2)
+            limited = geodesic.get_distances_from_sources(surf, [0], [10], limit = 3)
+        assert np.allclose(distances, expected)
+        assert np.isinf(limited[0])
+
+    def test_pairwise_distances_repeat_duplicate_vertices(self):
+        graph = geodesic.SurfaceGraph(self.coords, self.triangles)
+        vertices = [60, 0, 60, 120]
+        expected = np.array([[graph.distances([s])[0][t] for t in vertices]
+                             for s in vertices])
+        with TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'grid.surf.gii')
+            write_surface(surf, self.coords, self.triangles)
+            distances = geodesic.get_pairwise_distances(surf, vertices, chunk_size = 2)
+        assert np.allclose(distances, expected)
+        assert distances[0, 2] == 0
@@ -5,10 +5,13 @@ import logging
 import shutil
 import random
 
+import numpy as np
+import nibabel as nib
 from nose.tools import raises
 from mock import patch
 
 import ciftify.niio as niio
+from ciftify.utils import TempDir
 
 logging.disable(logging.CRITICAL)
 
@@ -117,3 +120,40 @@ class TestLoadGiiData(unittest.TestCase):
 
         niio.load_gii_data(path)
         assert False
+
+class TestSaveNifti(unittest.TestCase):
+
+    image = nib.Nifti1Image(np.arange(4000, dtype = np.float32).reshape(10, 20, 20),
+                            np.eye(4))
+
+    def tearDown(self):
+        niio._COMPRESSION.clear()
+
+    def test_temp_niftis_are_uncompressed(self):
+        assert niio.temp_nifti('/tmp/dir', 'func.nii.gz') == '/tmp/dir/func.nii'
+        assert niio.temp_nifti('/tmp/dir', 'mask') == '/tmp/dir/mask.nii'
+
+    def test_compression_level_changes_output_size(self):
+        sizes = []
+        with TempDir() as tmpdir:
+            for level in (0, 9):
+                niio.set_compression(level = level)
+                output = os.path.join(tmpdir, 'level{}.nii.gz'.format(level))
+                niio.save_nifti(self.image, output)
+                sizes.append(os.path.getsize(output))
+                assert np.array_equal(nib.load(output).get_data(), self.image.get_data())
+        assert sizes[1] < sizes[0]
+
+    @patch('ciftify.niio.GZIP_BLOCK_SIZE', 1000)
+    def test_threaded_gzip_output_reads_as_the_image(self):
+        niio.set_compression(level = 6, threads = 3)
+        with TempDir() as tmpdir:
+            output = os.path.join(tmpdir, 'threaded.nii.gz')
+            niio.save_nifti(self.image, output)
+            assert os.listdir(tmpdir) == ['threaded.nii.gz']
+            assert np.array_equal(nib.load(output).get_data(), self.image.get_data())
+
+    @patch('ciftify.config.find_compression_threads', return_value = 'four')
+    @patch('ciftify.config.find_compression_level', return_value = '3')
+    def test_compression_read_from_environment(self, mock_level, mock_threads):
+        assert niio.get_compression() == (3, 1)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+from nose.tools import raises
+
+import ciftify.pint_store as pint_store
+import ciftify.bin.ciftify_postPINT1_concat as concat
+from ciftify.utils import TempDir
+
+logging.disable(logging.CRITICAL)
+
+def summary_df(pvertices):
+    return pd.DataFrame({'hemi': ['L', 'R', 'L'],
+                         'NETWORK': [2, 7, 7],
+                         'roiidx': [1, 2, 3],
+                         'tvertex': [10, 20, 30],
+                         'pvertex': pvertices,
+                         'vertex_0': [11, 20, 31],
+                         'vertex_1': [12, 21, 31]})
+
+@unittest.skipIf(pint_store.h5py is None, 'h5py is not installed')
+class TestPINTStore(unittest.TestCase):
+
+    meants = np.arange(30, dtype = float).reshape(3, 10)
+
+    def make_store(self, tmpdir):
+        store_file = os.path.join(tmpdir, 'pint.h5')
+        with pint_store.PINTStore(store_file, mode = 'a') as store:
+            store.add_subject('sub-01', summary_df([12, 21, 31]), self.meants,
+                              self.meants + 100)
+            store.add_subject('sub-02', summary_df([13, 22, 30]), self.meants,
+                              self.meants + 200)
+        return store_file
+
+    def test_summary_of_a_network_across_subjects(self):
+        with TempDir() as tmpdir:
+            with pint_store.PINTStore(self.make_store(tmpdir)) as store:
+                summary = store.summary(network = 'DM')
+        assert list(summary.subid) == ['sub-01', 'sub-01', 'sub-02', 'sub-02']
+        assert list(summary.roiidx) == [2, 3, 2, 3]
+        assert list(summary.hemi) == ['R', 'L', 'R', 'L']
+
+    def test_meants_of_a_network_across_subjects(self):
+        with TempDir() as tmpdir:
+            with pint_store.PINTStore(self.make_store(tmpdir)) as store:
+                meants = store.meants('pvertex', network = 7)
+        assert sorted(meants) == ['sub-01', 'sub-02']
+        assert list(meants['sub-02'].index) == [2, 3]
+        assert np.allclose(meants['sub-02'].values, self.meants[1:] + 200)
+
+    def test_vertex_trajectories_are_ordered_by_iteration(self):
+        with TempDir() as tmpdir:
+            with pint_store.PINTStore(self.make_store(tmpdir)) as store:
+                trajectories = store.vertex_trajectories('sub-01')
+        assert list(trajectories.columns) == ['tvertex', 'vertex_0', 'vertex_1', 'pvertex']
+        assert list(trajectories.loc[1]) == [10, 11, 12, 12]
+
+    def test_existing_subjects_are_not_replaced(self):
+        with TempDir() as tmpdir:
+            store_file = self.make_store(tmpdir)
+            with pint_store.PINTStore(store_file, mode = 'a') as store:
+                store.add_subject('sub-01', summary_df([1, 2, 3]), self.meants,
+                                  self.meants)
+                assert list(store.summary('sub-01').pvertex) == [12, 21, 31]
+
+    def test_trajectories_end_with_the_stored_pvertex_column(self):
+        summary = summary_df([12, 21, 31]).rename(columns = {'pvertex': 'pvertex_final'})
+        with TempDir() as tmpdir:
+            with pint_store.PINTStore(os.path.join(tmpdir, 'pint.h5'), mode = 'a') as store:
+                store.add_subject('sub-01', summary, self.meants, self.meants,
+                                  pvertex_col = 'pvertex_final')
+                trajectories = store.vertex_trajectories('sub-01')
+        assert list(trajectories.columns)[-1] == 'pvertex_final'
+        assert list(trajectories.loc[2]) == [20, 20, 21, 21]
+
+    @raises(ValueError)
+    def test_raises_if_meants_do_not_match_summary(self):
+        with TempDir() as tmpdir:
+            with pint_store.PINTStore(os.path.join(tmpdir, 'pint.h5'), mode = 'a') as store:
+                store.add_subject('sub-01', summary_df([12, 21, 31]), self.meants[:2],
+                                  self.meants)
+
+    def test_concat_skips_subjects_with_missing_outputs(self):
+        with TempDir() as tmpdir:
+            summary_csvs = []
+            for subid in ('sub-01', 'sub-02'):
+                prefix = os.path.join(tmpdir, subid)
+                summary_df([12, 21, 31]).to_csv('{}_summary.csv'.format(prefix), index = False)
+                np.savetxt('{}_tvertex_meants.csv'.format(prefix), self.meants, delimiter = ',')
+                summary_csvs.append('{}_summary.csv'.format(prefix))
+            np.savetxt(os.path.join(tmpdir, 'sub-02_pvertex_meants.csv'), self.meants,
+                       delimiter = ',')
+            store_file = os.path.join(tmpdir, 'pint.h5')
+            concat.add_to_pint_store(store_file, summary_csvs)
+            with pint_store.PINTStore(store_file) as store:
+                assert store.subjects == ['sub-02']
+
+class TestNetworkNames(unittest.TestCase):
+
+    def test_network_names_match_the_PINT_networks(self):
+        assert pint_store.network_number('DM') == 7
+        assert len(pint_store.NETWORK_NAMES) == len(pint_store.PINT_NETWORKS)
+
+    @raises(FileNotFoundError)
+    def test_missing_PINT_outputs_raise(self):
+        pint_store.read_PINT_outputs('/some/path/sub-01')
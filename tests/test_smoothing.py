@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+
+import ciftify.geodesic as geodesic
+import ciftify.smoothing as smoothing
+from ciftify.utils import TempDir
+
+from tests.test_geodesic import flat_grid_mesh, write_surface
+
+logging.disable(logging.CRITICAL)
+
+def grid_operator(sigma = 1.0):
+    coords, triangles = flat_grid_mesh()
+    graph = geodesic.SurfaceGraph(coords, triangles)
+    index = geodesic.build_neighbourhood_index(graph, smoothing.KERNEL_SIGMAS * sigma)
+    areas = smoothing.vertex_areas(coords, triangles)
+    return smoothing.build_surface_operator(index, areas, sigma)
+
+class TestVertexAreas(unittest.TestCase):
+
+    def test_areas_sum_to_surface_area(self):
+        coords, triangles = flat_grid_mesh()
+        areas = smoothing.vertex_areas(coords, triangles)
+        assert np.isclose(areas.sum(), 100)
+
+class TestSurfaceOperator(unittest.TestCase):
+
+    def test_constant_data_stays_constant(self):
+        operator = grid_operator()
+        smoothed = operator.apply(np.ones((121, 3)) * 5)
+        assert np.allclose(smoothed, 5)
+
+    def test_spike_is_spread_to_neighbours(self):
+        operator = grid_operator()
+        data = np.zeros(121)
+        data[60] = 1
+        smoothed = operator.apply(data)
+        assert smoothed[60] < 1
+        assert smoothed[61] > 0
+        assert np.isclose(smoothed[61], smoothed[59])
+        assert smoothed[61] > smoothed[62]
+
+    def test_vertices_outside_roi_are_not_used_and_set_to_zero(self):
+        operator = grid_operator()
+        data = np.ones(121)
+        roi = np.ones(121)
+        roi[:11] = 0
+        data[:11] = 100
+        smoothed = operator.apply(data, roi)
+        assert np.all(smoothed[:11] == 0)
+        assert np.allclose(smoothed[11:], 1)
+
+    def test_timeseries_are_smoothed_in_chunks(self):
+        operator = grid_operator()
+        data = np.random.RandomState(0).randn(121, 10)
+        assert np.allclose(operator.apply(data, chunk_size = 3),
+                           operator.apply(data, chunk_size = 100))
+
+    def test_operator_is_cached_per_surface_and_sigma(self):
+        coords, triangles = flat_grid_mesh()
+        with TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'grid.surf.gii')
+            write_surface(surf, coords, triangles)
+            operator = smoothing.get_surface_operator(surf, 1.0, cache_dir = tmpdir)
+            assert smoothing.get_surface_operator(surf, 1.0) is operator
+            assert smoothing.get_surface_operator(surf, 0.5, cache_dir = tmpdir) is not operator
+
+class TestVolumeOperator(unittest.TestCase):
+
+    def test_constant_data_stays_constant(self):
+        ijk = np.array([[i, j, k] for i in range(4) for j in range(4) for k in range(2)])
+        operator = smoothing.build_volume_operator(ijk, np.diag([2, 2, 2, 1]), 2.0)
+        assert np.allclose(operator.apply(np.ones((32, 2))), 1)
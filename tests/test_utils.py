@@ -257,3 +257,24 @@ class TestWorkFlowSettings(unittest.TestCase):
 
         settings = utils.WorkFlowSettings(args_copy)
         assert False
+
+class TestStageProfiler(unittest.TestCase):
+
+    def test_repeated_stages_are_summed(self):
+        profiler = utils.StageProfiler()
+        for i in range(2):
+            with profiler.stage('load'):
+                pass
+        with profiler.stage('clean'):
+            sum(range(10000))
+        profile = profiler.as_dict()
+        assert list(profile) == ['load', 'clean']
+        assert profile['load']['calls'] == 2
+        assert profile['clean']['peak_rss_mb'] > 0
+
+    def test_summary_totals_runs(self):
+        run = {'clean': {'wall_s': 1.0, 'cpu_s': 2.0, 'peak_rss_mb': 10.0, 'calls': 1}}
+        bigger_run = {'clean': {'wall_s': 3.0, 'cpu_s': 2.0, 'peak_rss_mb': 30.0, 'calls': 1}}
+        summary = utils.summarise_profiles([run, bigger_run])
+        assert summary['clean'] == {'wall_s': 4.0, 'cpu_s': 4.0, 'peak_rss_mb': 30.0,
+                                    'runs': 2, 'mean_wall_s': 2.0}